@@ -1,4 +1,6 @@
 # Expose modules in namespace (easier relative imports)
 
 from . import auxiliary
+from . import memory
 from . import repository
+from . import spool
@@ -6,13 +6,23 @@ providing a single repository of generally handy snippets that can be imported
 by every other repository.
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from copy import deepcopy
 from functools import reduce  # Python 3
 
 from operator import xor
 
+import binascii
+import bson
+import hashlib
+import io
+
+from bson.decimal128 import Decimal128
+from bson.errors import InvalidBSON
+from pymongo import ASCENDING
+
 
 # -----------------------------------------------------------------------------
 # Dictionaries
@@ -38,6 +48,29 @@ def merge(*args):
     return d
 
 
+def merge_nested(*args):
+    """Merges an arbitrary number of nested dictionaries sequentially.
+
+    Args:
+        *args (dict): arbitrary number of dictionaries
+
+    Returns:
+        dict: merged dictionary
+
+    Unlike :func:`merge`, nested dictionaries are merged recursively (rather
+    than replaced), and are copied so the arguments are never modified.
+    """
+
+    d = {}
+    for arg in args:
+        for key, value in arg.items():
+            if isinstance(value, dict):
+                value = merge_nested(
+                    d[key] if isinstance(d.get(key), dict) else {}, value)
+            d[key] = value
+    return d
+
+
 def subset(d, keys, keep=1):
     """Subset a dictionary based on a list of keys.
 
@@ -226,13 +259,15 @@ def deep_diff(
 # Lists
 # -----------------------------------------------------------------------------
 
-def pivot_list_to_dict(s, pivots, types=None):
-    """Convert a list of dictionaries to a nested dictionary recursively.
+def pivot_list_to_dict(s, pivots, types=None, copy=True):
+    """Convert a list of dictionaries to a nested dictionary in a single pass.
 
     Args:
-        s (list): iterable of dictionaries
+        s (iterable): iterable of dictionaries (e.g. a generator)
         pivots (list): ordered list of keys to pivot by sequentially
         types (list): ordered list of types to convert pivots
+        copy (bool): copy each dictionary without the pivot keys, otherwise
+            the pivot keys are removed from each dictionary in place
 
     Returns:
         dict: nested dictionary
@@ -244,21 +279,39 @@ def pivot_list_to_dict(s, pivots, types=None):
     if not isinstance(types, list):
         types = [types for pivot in pivots]
 
-    key = pivots[0]
+    levels = list(zip(pivots[:-1], types[:-1]))
+    key, type_ = pivots[-1], types[-1]
+    keys = set(pivots)
 
     d = {}
+    leaves = []
     for i in s:
-        v = types[0](i[key]) if types else i[key]
-        if v not in d:
-            d[v] = []
-        d[v].append(subset(i, key, 0))
-    for k, v in d.items():
-        if len(pivots) > 1:
-            d[k] = pivot_list_to_dict(
-                v, pivots[1:], types[1:] if types else None)
+        # Walk (or build) the nested dictionary down to the last pivot
+        node = d
+        for pivot, t in levels:
+            v = t(i[pivot]) if t else i[pivot]
+            child = node.get(v)
+            if child is None:
+                child = node[v] = {}
+            node = child
+        v = type_(i[key]) if type_ else i[key]
+
+        if copy:
+            i = {k: w for k, w in i.items() if k not in keys}
         else:
-            if len(d[k]) == 1:
-                d[k] = d[k][0]
+            for pivot in pivots:
+                del i[pivot]
+
+        leaf = node.get(v)
+        if leaf is None:
+            leaf = node[v] = []
+            leaves.append((node, v))
+        leaf.append(i)
+
+    # Unwrap leaves containing a single dictionary
+    for node, v in leaves:
+        if len(node[v]) == 1:
+            node[v] = node[v][0]
 
     return d
 
@@ -351,7 +404,8 @@ def sort_list_diff(old, new):
 
 def dict_list_diff(
         old, new, pivots, choices={'deleted', 'changed', 'created'},
-        options={'deleted', 'updated', 'created'}, grab=[], keep=0):
+        options={'deleted', 'updated', 'created'}, grab=[], keep=0,
+        fingerprint=None, exclude=['_id']):
     """Computes deep difference between two lists of dictionaries recursively.
 
     Args:
@@ -362,6 +416,10 @@ def dict_list_diff(
         options (set): specifies categories of dict difference to find
         grab (list): keys
         keep (int): binary flag to keep (1) or ignore (0) the keys specified
+        fingerprint (str): key of stored fingerprints (see
+            :func:`get_fingerprint`), compared first so dictionaries with
+            matching fingerprints are unchanged without a deep difference
+        exclude (list): keys excluded from fingerprints (computed if missing)
 
     Returns:
         list: difference summary
@@ -389,6 +447,16 @@ def dict_list_diff(
     old = sorted(old, key=lambda x: getitems(x, pivots))
     new = sorted(new, key=lambda x: getitems(x, pivots))
 
+    if fingerprint is not None:
+        exclude = exclude + [fingerprint]
+        if not keep:
+            grab = grab + [fingerprint]  # Not a difference
+
+        def unchanged(old, new):
+            old_hash = old.get(fingerprint) or get_fingerprint(old, exclude)
+            new_hash = new.get(fingerprint) or get_fingerprint(new, exclude)
+            return old_hash == new_hash
+
     deleted = []
     changed = []
     created = []
@@ -401,9 +469,12 @@ def dict_list_diff(
         new_values = getitems(new[j], pivots)
 
         if old_values == new_values:  # unchanged or changed
-            diff = deep_diff(old[i], new[j], options, grab, keep)
+            if fingerprint is not None and unchanged(old[i], new[j]):
+                diff = None
+            else:
+                diff = deep_diff(old[i], new[j], options, grab, keep)
             if diff and 'changed' in choices:  # changed
-                changed.append(merge(diff, {'new': new[i]}))
+                changed.append(merge(diff, {'new': new[j]}))
             i += 1
             j += 1
         elif old_values < new_values:  # deleted
@@ -431,6 +502,32 @@ def dict_list_diff(
     return summary
 
 
+def get_fingerprint(d, exclude=['_id']):
+    """Computes a stable content hash of a dictionary.
+
+    The hash is computed over canonical BSON (with keys sorted recursively),
+    so dictionaries which are equal (excluding the keys specified) have the
+    same fingerprint, regardless of key order.
+
+    Args:
+        d (dict): dictionary
+        exclude (list): keys excluded (at the top level)
+
+    Returns:
+        bytes: fingerprint (16 bytes)
+    """
+
+    def canonical(value):
+        if isinstance(value, dict):
+            return {key: canonical(value[key]) for key in sorted(value)}
+        elif isinstance(value, (list, tuple)):
+            return [canonical(child) for child in value]
+        return value
+
+    doc = {key: canonical(d[key]) for key in sorted(d) if key not in exclude}
+    return hashlib.blake2b(bson.encode(doc), digest_size=16).digest()
+
+
 # -----------------------------------------------------------------------------
 # Other
 # -----------------------------------------------------------------------------
@@ -481,6 +578,365 @@ def get_uri(config):
     return host_uri
 
 
+def encode_token(values):
+    """Encodes a list of values as an opaque (URL safe) continuation token.
+
+    Args:
+        values (list): values to encode (anything BSON serializable)
+
+    Returns:
+        str: opaque continuation token
+    """
+
+    return urlsafe_b64encode(bson.BSON.encode({'v': values})).decode('ascii')
+
+
+def decode_token(token):
+    """Decodes an opaque continuation token produced by :func:`encode_token`.
+
+    Args:
+        token (str): opaque continuation token
+
+    Returns:
+        list: decoded values
+
+    Raises:
+        ValueError: if the token is malformed (e.g. supplied by a client)
+    """
+
+    try:
+        values = bson.BSON(
+            urlsafe_b64decode(token.encode('ascii'))).decode()['v']
+    except (binascii.Error, InvalidBSON, UnicodeError, KeyError,
+            AttributeError):
+        raise ValueError('Invalid page token')
+    if not isinstance(values, list):
+        raise ValueError('Invalid page token')
+    return values
+
+
+def get_keyset_query(query, sort_key, values, direction=1):
+    """Extends a query with range conditions continuing after a sort position.
+
+    Args:
+        query (dict): query
+        sort_key (str): sort key (possibly dotted), tie-broken by _id
+        values (list): sort key and _id values of the last document seen
+        direction (int): sort direction, ascending (1) or descending (-1)
+
+    Returns:
+        dict: extended query
+
+    Example::
+
+        query = get_keyset_query({'a': 0}, 'b', [5, ObjectId(...)])
+    """
+
+    op = '$gt' if direction > 0 else '$lt'
+    value, _id = values
+
+    # Null (or missing) sort keys sort before all other values, but range
+    # conditions on null match nothing, so they are handled explicitly
+    if sort_key == '_id':
+        condition = {'_id': {op: _id}}
+    elif value is None:
+        condition = {sort_key: None, '_id': {op: _id}}
+        if direction > 0:
+            condition = {'$or': [condition, {sort_key: {'$ne': None}}]}
+    else:
+        condition = {'$or': [
+            {sort_key: {op: value}},
+            {sort_key: value, '_id': {op: _id}},
+        ]}
+        if direction < 0:
+            condition['$or'].append({sort_key: None})
+
+    return {'$and': [query, condition]} if query else condition
+
+
+def get_query_shape(query=None, sort=None, projection=None):
+    """Normalizes a query into its shape (fields used, ignoring values).
+
+    Filter fields are split into equality and range fields, as this is what
+    matters when choosing an index (equality, then sort, then range). Fields
+    nested under logical operators other than $and are treated as range.
+
+    Args:
+        query (dict): query
+        sort (list): list of (key, direction) pairs
+        projection (dict): projection
+
+    Returns:
+        tuple: hashable query shape (equality, sort, range, projection)
+
+    Example::
+
+        shape = get_query_shape({'a': 0, 'b': {'$gt': 1}}, [('c', -1)])
+    """
+
+    equality = set()
+    range_ = set()
+
+    def walk(query, nested):
+        for key, value in (query or {}).items():
+            if key == '$and':
+                for child in value:
+                    walk(child, nested)
+            elif key in ('$or', '$nor'):
+                for child in value:
+                    walk(child, True)
+            elif key.startswith('$'):
+                continue  # e.g. $text, $where, $expr (not index prefixes)
+            elif nested or (isinstance(value, dict) and any(
+                    k.startswith('$') and k not in ('$eq', '$in')
+                    for k in value)):
+                range_.add(key)
+            else:
+                equality.add(key)
+
+    walk(query, False)
+
+    if isinstance(sort, str):
+        sort = [(sort, 1)]
+    if isinstance(projection, dict):
+        projection = projection.keys()
+
+    return (tuple(sorted(equality)),
+            tuple((key, direction) for key, direction in (sort or [])),
+            tuple(sorted(range_ - equality)),
+            tuple(sorted(projection or [])))
+
+
+def get_index_keys(shape):
+    """Computes recommended index keys for a query shape.
+
+    Follows the equality, sort, range rule, omitting fields already covered,
+    so that the resulting index supports both the filter and the sort.
+
+    Args:
+        shape (tuple): query shape from :func:`get_query_shape`
+
+    Returns:
+        list: list of (key, direction) pairs (empty if no index is useful)
+    """
+
+    equality, sort, range_, projection = shape
+
+    keys = [(key, 1) for key in equality]
+    seen = set(equality)
+    for key, direction in list(sort) + [(key, 1) for key in range_]:
+        if key not in seen:
+            keys.append((key, direction))
+            seen.add(key)
+
+    return keys
+
+
+def get_keyset_projection(projection, sort_key):
+    """Extends a projection to include the sort key and _id, so the sort
+    position of each document is known (see :func:`get_keyset_query`).
+
+    Args:
+        projection (dict): projection (or list of keys to include, or None)
+        sort_key (str): sort key (possibly dotted), tie-broken by _id
+
+    Returns:
+        tuple: extended projection, and keys (possibly dotted) to remove
+        from documents (as they were not projected originally)
+
+    Example::
+
+        projection, hidden = get_keyset_projection({'a': 1, '_id': 0}, 'b')
+    """
+
+    if projection is None:
+        return None, []
+    if not isinstance(projection, dict):
+        projection = {key: 1 for key in projection}
+    projection = dict(projection)
+
+    hidden = []
+    if '_id' in projection and not projection['_id']:
+        del projection['_id']
+        hidden.append('_id')
+    if any(value for key, value in projection.items() if key != '_id'):
+        # Inclusion (unless the sort key or a parent is included)
+        if sort_key != '_id' and not any(
+                value and (sort_key == key or sort_key.startswith(key + '.'))
+                for key, value in projection.items()):
+            projection[sort_key] = 1
+            hidden.append(sort_key)
+    else:  # Exclusion (of the sort key, a parent, or a child)
+        for key in list(projection):
+            if (key == sort_key or sort_key.startswith(key + '.') or
+                    key.startswith(sort_key + '.')):
+                del projection[key]
+                hidden.append(key)
+    return projection or None, hidden
+
+
+def get_pivot_pipeline(query, pivots, projection=None):
+    """Compiles a pivot (see :func:`pivot_list_to_dict`) into a pipeline.
+
+    Objects are sorted by the values of all pivots (rather than grouped with
+    $group, which would be limited to 16MB per group), so objects with equal
+    pivot values are consecutive and can be grouped while streaming.
+
+    Args:
+        query (dict): query
+        pivots (list): ordered list of keys to pivot by sequentially
+        projection (dict): projection applied to each object (pivots are
+            always included)
+
+    Returns:
+        list: aggregation pipeline
+    """
+
+    if not isinstance(pivots, list):
+        pivots = [pivots]
+
+    pipeline = [
+        {'$match': query or {}},
+        {'$sort': {pivot: ASCENDING for pivot in pivots}},
+    ]
+    if projection:
+        projection = dict(projection)
+        if any(v for k, v in projection.items() if k != '_id'):
+            projection.update({pivot: 1 for pivot in pivots})
+        else:
+            for pivot in pivots:
+                projection.pop(pivot, None)
+        if projection:
+            pipeline.append({'$project': projection})
+    return pipeline
+
+
+def get_naive_utc(time):
+    """Converts a time to naive UTC (as returned by :mod:`pymongo`).
+
+    Args:
+        time (datetime.datetime): time (naive times are taken as UTC)
+
+    Returns:
+        datetime.datetime: naive UTC time
+    """
+
+    if time.tzinfo is not None:
+        time = time.astimezone(timezone.utc).replace(tzinfo=None)
+    return time
+
+
+def get_bucket_start(time, window):
+    """Gets the start of the time window (bucket) containing a time.
+
+    Args:
+        time (datetime.datetime): time (naive times are taken as UTC, as
+            returned by :mod:`pymongo`)
+        window (float): window size in seconds (windows are aligned to epoch)
+
+    Returns:
+        datetime.datetime: start of the window (naive UTC)
+    """
+
+    time = get_naive_utc(time)
+    return time - (time - datetime(1970, 1, 1)) % timedelta(seconds=window)
+
+
+def get_bucket_update(event, time, stats=()):
+    """Compiles an event append into a bucket update.
+
+    The event is pushed to 'events', the bucket size 'n' is incremented (not
+    'count', which :class:`minimongo.Model` attribute access would hide),
+    and the minimum and maximum of the time and stats keys are kept in 'min'
+    and 'max' respectively.
+
+    Args:
+        event (dict): event
+        time (str): time key
+        stats (list): numeric keys to keep the minimum and maximum of
+
+    Returns:
+        dict: update
+    """
+
+    keys = [time] + [key for key in stats if key in event]
+    return {
+        '$push': {'events': event},
+        '$inc': {'n': 1},
+        '$min': {'min.' + key: event[key] for key in keys},
+        '$max': {'max.' + key: event[key] for key in keys},
+    }
+
+
+def get_shard_value(value):
+    """Canonical value of a shard key, so equal values are routed together.
+
+    Numbers are compared by value in MongoDB regardless of type, so integral
+    floats (and :class:`bson.int64.Int64`) are converted to int, recursively
+    for dictionaries and lists (booleans are not numbers in BSON).
+
+    Args:
+        value (object): shard key value
+
+    Returns:
+        object: canonical value
+    """
+
+    if isinstance(value, bool):
+        return value
+    elif isinstance(value, int):
+        return int(value)
+    elif isinstance(value, float) and value.is_integer():
+        return int(value)
+    elif isinstance(value, Decimal128):
+        return get_shard_value(float(value.to_decimal()))
+    elif isinstance(value, dict):
+        return {key: get_shard_value(child) for key, child in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [get_shard_value(child) for child in value]
+    return value
+
+
+def get_bson_offsets(data):
+    """Gets the offsets of concatenated BSON documents using length prefixes.
+
+    Args:
+        data (bytes): concatenated BSON documents (or a buffer, e.g. mmap)
+
+    Yields:
+        tuple: offset and length of each BSON document
+    """
+
+    offset = 0
+    while offset < len(data):
+        length = int.from_bytes(data[offset:offset + 4], 'little')
+        if length < 5 or offset + length > len(data):
+            raise ValueError(
+                'Truncated BSON document at offset {}'.format(offset))
+        yield offset, length
+        offset += length
+
+
+def split_bson(data):
+    """Splits concatenated BSON documents using their length prefix.
+
+    Documents are views of the buffer (never copied or decoded), which are
+    released when the next document is read (or the generator is closed), so
+    the buffer (e.g. mmap) can be closed. Use bytes(document) to keep one.
+
+    Args:
+        data (bytes): concatenated BSON documents (or a buffer, e.g. mmap)
+
+    Yields:
+        memoryview: BSON document
+    """
+
+    with memoryview(data) as view:
+        for offset, length in get_bson_offsets(view):
+            with view[offset:offset + length] as document:
+                yield document
+
+
 def get_update(
         old, new, options={'deleted', 'updated', 'created'}, grab=['_id'],
         keep=0):
@@ -551,6 +1007,93 @@ def get_update(
     return update
 
 
+def get_each(value):
+    """Gets the list of values pushed by a '$push' update operator.
+
+    Args:
+        value (object): value of a '$push' update operator
+
+    Returns:
+        list: values pushed (None if modifiers other than '$each' are used)
+    """
+
+    if isinstance(value, dict) and any(k.startswith('$') for k in value):
+        return list(value['$each']) if list(value) == ['$each'] else None
+    return [value]
+
+
+def merge_update(old, new):
+    """Merges two MongoDB updates (applied sequentially) into one update.
+
+    Only the '$set', '$unset', '$inc', and '$push' update operators are
+    considered, and successive operations on the same key are combined (e.g.
+    '$inc' after '$set' increments the value set).
+
+    Args:
+        old (dict): update applied first
+        new (dict): update applied second
+
+    Returns:
+        dict: merged update (None if the updates can not be merged, e.g. for
+            operations on overlapping keys such as 'a' and 'a.b')
+
+    Example::
+
+        old = {'$set': {'a': 0}, '$inc': {'b': 1}}
+        new = {'$inc': {'a': 1, 'b': 1}, '$unset': {'c': ''}}
+
+        update = merge_update(old, new)
+    """
+
+    merged = {op: dict(fields) for op, fields in old.items()}
+
+    for op, fields in new.items():
+        for key, value in fields.items():
+            for k in (k for f in merged.values() for k in f):
+                if k.startswith(key + '.') or key.startswith(k + '.'):
+                    return None  # Overlapping keys
+            current = next((o for o, f in merged.items() if key in f), None)
+
+            if op in ('$set', '$unset'):
+                if current:
+                    del merged[current][key]
+                merged.setdefault(op, {})[key] = value
+            elif op == '$inc':
+                if current in (None, '$inc'):
+                    inc = merged.setdefault('$inc', {})
+                    inc[key] = inc.get(key, 0) + value
+                elif current == '$set' and isinstance(
+                        merged['$set'][key], (int, float)):
+                    merged['$set'][key] += value
+                elif current == '$unset':
+                    del merged['$unset'][key]
+                    merged.setdefault('$set', {})[key] = value
+                else:
+                    return None
+            elif op == '$push':
+                values = get_each(value)
+                if values is None:
+                    return None  # Modifiers (e.g. $slice) are not merged
+                if current in (None, '$push'):
+                    push = merged.setdefault('$push', {})
+                    each = get_each(push[key]) if key in push else []
+                    if each is None:
+                        return None
+                    push[key] = {'$each': each + values}
+                elif current == '$set' and isinstance(
+                        merged['$set'][key], list):
+                    merged['$set'][key] = merged['$set'][key] + values
+                elif current == '$unset':
+                    del merged['$unset'][key]
+                    merged.setdefault('$set', {})[key] = values
+                else:
+                    return None
+            else:
+                return None
+
+    return {op: fields for op, fields in merged.items() if fields}
+
+
 # -----------------------------------------------------------------------------
 # Printing
 # -----------------------------------------------------------------------------
@@ -563,25 +1106,36 @@ class Pretty(object):
     indenting. Custom formatters are already specified for :class:`dict`,
     :class:`list`, and :class:`tuple` objects, giving a generic line feed
     scaffold, and a default formatter for :class:`object` is included.
+
+    Output is written incrementally (see :meth:`write`), without recursion,
+    so huge objects can be written to a file without building the string.
     """
 
-    def __init__(self, htchar='  ', lfchar='\n', indent=0):
+    def __init__(self, htchar='  ', lfchar='\n', indent=0, max_depth=None,
+                 sort_keys=True):
         """Return an instance of Pretty.
 
         Args:
             htchar (str): horizontal tab string
             lfchar (str): line feed string
             indent (int): number of htchar to prepend to output (entirety)
+            max_depth (int): depth of nested containers written in full
+                (deeper containers are abbreviated, None for no limit)
+            sort_keys (bool): write dictionary keys sorted (otherwise in
+                insertion order, streamed without collecting the keys)
         """
         self.htchar = htchar
         self.lfchar = lfchar
         self.indent = indent
+        self.max_depth = max_depth
+        self.sort_keys = sort_keys
         self.types = {
             object: self.__class__.object_formatter,
             dict: self.__class__.dict_formatter,
             list: self.__class__.list_formatter,
             tuple: self.__class__.tuple_formatter,
         }
+        self.cache = {}  # Formatters by exact type (see get_formatter)
 
     def __call__(self, value, **kwargs):
         """Allows class instance to be invoked as a function for formatting.
@@ -593,9 +1147,62 @@ class Pretty(object):
         Returns:
             str: pretty formatted string ready to be printed
         """
-        for key, value in kwargs.items():
-            setattr(self, key, value)
-        return self.get_formatter(value)(self, value, self.indent)
+        f = io.StringIO()
+        self.write(value, f, **kwargs)
+        return f.getvalue()
+
+    def write(self, value, f, **kwargs):
+        """Writes formatted object to a file-like object incrementally.
+
+        Containers formatted by the default :class:`dict`, :class:`list`, and
+        :class:`tuple` formatters are written item by item using an explicit
+        stack (rather than recursion), and other objects are written using
+        their formatters.
+
+        Args:
+            value (object): object to be formatted
+            f (file): file-like object with a write method
+            **kwargs: named arguments to be assigned as attributes
+        """
+        for key, arg in kwargs.items():
+            setattr(self, key, arg)
+
+        containers = {
+            Pretty.dict_formatter: ('{', '}', lambda value: (
+                (repr(key) + ': ', item)
+                for key, item in self.dict_items(value))),
+            Pretty.list_formatter: ('[', ']', lambda value: (
+                ('', item) for item in value)),
+            Pretty.tuple_formatter: ('(', ')', lambda value: (
+                ('', item) for item in value)),
+        }
+        stack = []  # Containers being written, [items, indent, close, first]
+
+        def start(value, indent):
+            formatter = self.get_formatter(value)
+            if formatter not in containers:
+                f.write(formatter(self, value, indent))
+                return
+            open_, close, items = containers[formatter]
+            if self.max_depth is not None and len(stack) >= self.max_depth:
+                f.write(open_ + '...' + close)
+                return
+            f.write(open_)
+            stack.append([items(value), indent, close, True])
+
+        start(value, self.indent)
+        while stack:
+            frame = stack[-1]
+            items, indent, close, first = frame
+            item = next(items, None)
+            if item is None:
+                stack.pop()
+                f.write(self.lfchar + self.htchar * indent + close)
+                continue
+            frame[3] = False
+            f.write(('' if first else ',') + self.lfchar +
+                    self.htchar * (indent + 1) + item[0])
+            start(item[1], indent + 1)
 
     def add_formatter(self, obj, formatter):
         """Adds a custom formatter for an arbitrary object type.
@@ -606,29 +1213,48 @@ class Pretty(object):
                 formatter(value, indent)
         """
         self.types[obj] = formatter
+        self.cache.clear()
 
     def get_formatter(self, obj):
         """Retrieves the custom formatter for the object type (or default).
+
+        Formatters are found by the type MRO (falling back to isinstance, e.g.
+        for abstract base classes), and are cached by exact type.
         """
-        for type_ in self.types:
-            if isinstance(obj, type_):
-                return self.types[type_]
-        return self.types[object]
+        type_ = type(obj)
+        try:
+            return self.cache[type_]
+        except KeyError:
+            pass
+
+        formatter = next((self.types[base] for base in type_.__mro__
+                          if base is not object and base in self.types), None)
+        if formatter is None:
+            formatter = next((self.types[t] for t in self.types
+                              if t is not object and isinstance(obj, t)),
+                             self.types[object])
+        self.cache[type_] = formatter
+        return formatter
 
     def object_formatter(self, value, indent):
         """Default object formatter.
         """
         return repr(value)
 
+    def dict_items(self, value):
+        """Dictionary items in output order (see sort_keys), as a generator.
+        """
+        keys = sorted(value) if self.sort_keys else value
+        return ((key, value[key]) for key in keys)
+
     def dict_formatter(self, value, indent):
         """Dictionary formatter.
         """
-        items = []
-        for key in sorted(value.keys()):
-            s = (self.lfchar + self.htchar * (indent + 1) + repr(key) + ': ' +
-                 self.get_formatter(value[key])(self, value[key], indent + 1))
-            items.append(s)
-
+        items = (
+            self.lfchar + self.htchar * (indent + 1) + repr(key) + ': ' +
+            self.get_formatter(item)(self, item, indent + 1)
+            for key, item in self.dict_items(value)
+        )
         return '{%s}' % (','.join(items) + self.lfchar + self.htchar * indent)
 
     def list_formatter(self, value, indent):
@@ -646,8 +1272,7 @@ class Pretty(object):
         """
         items = [
             self.lfchar + self.htchar * (indent + 1) +
-            self.get_formatter(value)(
-                self, item, indent + 1)
+            self.get_formatter(item)(self, item, indent + 1)
             for item in value
         ]
         return '(%s)' % (','.join(items) + self.lfchar + self.htchar * indent)
@@ -0,0 +1,1378 @@
+"""
+In-process memory backend for :class:`minimongo.repository.Model`.
+
+Contains an in-process store implementing the subset of the :mod:`pymongo`
+client, database, and collection API used by :class:`Model`, with a query
+matcher for the common query and update operators, real hash and sorted
+indexes built from config['indexes'], and change streams (so
+:meth:`Model.mirror` can follow a collection). Select it per model with
+config['backend'] set to 'memory', e.g. to run tests without a server, or to
+serve small read mostly collections at memory speed.
+
+Note that documents are stored in process, so are neither shared between
+processes nor persisted, and only a subset of MongoDB semantics is supported
+(unsupported operators raise :class:`pymongo.errors.OperationFailure`).
+"""
+
+import bson
+import re
+import threading
+import time
+
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from datetime import datetime
+from itertools import product
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure, \
+    CollectionInvalid
+from pymongo.read_concern import ReadConcern
+from pymongo.write_concern import WriteConcern
+from pymongo.results import InsertOneResult, InsertManyResult, \
+    UpdateResult, DeleteResult, BulkWriteResult
+
+# -----------------------------------------------------------------------------
+# Constants
+# -----------------------------------------------------------------------------
+
+# Sort order of types (following MongoDB, numbers are compared together)
+TYPE_ORDER = [
+    (type(None), 1),
+    (bool, 8),  # Before int (as bool is a subclass of int)
+    (int, 2),
+    (float, 2),
+    (str, 3),
+    (dict, 4),
+    (list, 5),
+    (bytes, 6),
+    (ObjectId, 7),
+    (datetime, 9),
+]
+
+# Range operators which can use a sorted index
+RANGE_OPERATORS = {'$gt', '$gte', '$lt', '$lte'}
+
+# Compiled regular expression type
+PATTERN_TYPE = type(re.compile(''))
+
+# Number of changes kept per collection for change streams to resume after
+CHANGE_LOG_SIZE = 10000
+
+
+# -----------------------------------------------------------------------------
+# Values
+# -----------------------------------------------------------------------------
+
+def get_rank(value):
+    """Type rank of a value (for sorting and comparison).
+    """
+
+    for type_, rank in TYPE_ORDER:
+        if isinstance(value, type_):
+            return rank
+    return 10
+
+
+def get_sort_key(value):
+    """Sort key of a value (ordered by type rank, then value).
+    """
+
+    rank = get_rank(value)
+    if rank == 1:
+        return (rank, 0)
+    if rank in (4, 5, 10):
+        return (rank, repr(value))  # Not naturally ordered
+    return (rank, value)
+
+
+def freeze(value):
+    """Hashable equivalent of a value (for hash indexes).
+    """
+
+    if isinstance(value, dict):
+        return ('dict', tuple((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return ('list', tuple(freeze(v) for v in value))
+    return (get_rank(value), value)
+
+
+def identical(a, b):
+    """Checks values are identical, as BSON (including types and key order).
+    """
+
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return list(a) == list(b) and all(identical(a[k], b[k]) for k in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(identical(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def copy_value(value):
+    """Copy a value (only dictionaries and lists, as others are immutable).
+    """
+
+    if isinstance(value, dict):
+        return {k: copy_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [copy_value(v) for v in value]
+    return value
+
+
+def resolve(doc, path):
+    """Resolve a dotted path, traversing lists of dictionaries.
+
+    Args:
+        doc (dict): document
+        path (str): dotted path
+
+    Returns:
+        list: values found (empty if missing)
+    """
+
+    values = [doc]
+    for key in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if key in value:
+                    found.append(value[key])
+            elif isinstance(value, list):
+                if key.isdigit() and int(key) < len(value):
+                    found.append(value[int(key)])
+                for item in value:
+                    if isinstance(item, dict) and key in item:
+                        found.append(item[key])
+        values = found
+    return values
+
+
+def expand(values):
+    """Expand values with the elements of any lists (for matching).
+    """
+
+    expanded = []
+    for value in values:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+
+def equal(a, b):
+    """Compare values for equality (respecting type rank, unlike Python).
+    """
+
+    return get_rank(a) == get_rank(b) and a == b
+
+
+def compare(op, a, b):
+    """Compare values with a range operator (only values of the same rank).
+    """
+
+    if get_rank(a) != get_rank(b):
+        return False
+    try:
+        if op == '$gt':
+            return a > b
+        elif op == '$gte':
+            return a >= b
+        elif op == '$lt':
+            return a < b
+        else:
+            return a <= b
+    except TypeError:
+        return False
+
+
+# -----------------------------------------------------------------------------
+# Matching
+# -----------------------------------------------------------------------------
+
+def match(doc, query):
+    """Check if a document matches a query.
+
+    Args:
+        doc (dict): document
+        query (dict): query
+
+    Returns:
+        bool: if document matches
+    """
+
+    for key, condition in (query or {}).items():
+        if key == '$and':
+            if not all(match(doc, q) for q in condition):
+                return False
+        elif key == '$or':
+            if not any(match(doc, q) for q in condition):
+                return False
+        elif key == '$nor':
+            if any(match(doc, q) for q in condition):
+                return False
+        elif key.startswith('$'):
+            raise OperationFailure('unknown top level operator: ' + key)
+        elif not match_condition(resolve(doc, key), condition):
+            return False
+    return True
+
+
+def is_operator_dict(condition):
+    """Check if a condition is a dictionary of operators.
+    """
+
+    return (isinstance(condition, dict) and len(condition) > 0 and
+            all(key.startswith('$') for key in condition))
+
+
+def match_condition(values, condition):
+    """Check if values (resolved from a path) match a condition.
+    """
+
+    if is_operator_dict(condition):
+        options = condition.get('$options', '')
+        return all(match_operator(values, op, arg, options)
+                   for op, arg in condition.items() if op != '$options')
+    if isinstance(condition, PATTERN_TYPE):
+        return match_operator(values, '$regex', condition, '')
+    return match_operator(values, '$eq', condition, '')
+
+
+def match_operator(values, op, arg, options):
+    """Check if values (resolved from a path) match an operator.
+    """
+
+    expanded = expand(values)
+    if op == '$eq':
+        if arg is None and not values:
+            return True
+        return any(equal(value, arg) for value in expanded)
+    elif op == '$ne':
+        return not match_operator(values, '$eq', arg, options)
+    elif op in RANGE_OPERATORS:
+        return any(compare(op, value, arg) for value in expanded)
+    elif op == '$in':
+        return any(match_condition(values, a) for a in arg)
+    elif op == '$nin':
+        return not match_operator(values, '$in', arg, options)
+    elif op == '$exists':
+        return bool(values) == bool(arg)
+    elif op == '$regex':
+        if not isinstance(arg, PATTERN_TYPE):
+            flags = sum(getattr(re, f.upper()) for f in options if f in 'imsx')
+            arg = re.compile(arg, flags)
+        return any(isinstance(value, str) and arg.search(value)
+                   for value in expanded)
+    elif op == '$size':
+        return any(isinstance(value, list) and len(value) == arg
+                   for value in values)
+    elif op == '$all':
+        return all(match_condition(values, a) for a in arg)
+    elif op == '$elemMatch':
+        for value in values:
+            if isinstance(value, list):
+                for item in value:
+                    if is_operator_dict(arg):
+                        if match_condition([item], arg):
+                            return True
+                    elif isinstance(item, dict) and match(item, arg):
+                        return True
+        return False
+    elif op == '$not':
+        return not match_condition(values, arg)
+    elif op == '$mod':
+        return any(get_rank(value) == 2 and value % arg[0] == arg[1]
+                   for value in expanded)
+
+    raise OperationFailure('unknown operator: ' + op)
+
+
+# -----------------------------------------------------------------------------
+# Updating
+# -----------------------------------------------------------------------------
+
+def set_path(doc, path, value):
+    """Set a value at a dotted path (creating dictionaries as required).
+    """
+
+    keys = path.split('.')
+    for key in keys[:-1]:
+        if isinstance(doc, list):
+            doc = doc[int(key)]
+        else:
+            doc = doc.setdefault(key, {})
+    if isinstance(doc, list):
+        doc[int(keys[-1])] = value
+    else:
+        doc[keys[-1]] = value
+
+
+def get_path(doc, path, default=None):
+    """Get a value at a dotted path (or default if missing).
+    """
+
+    for key in path.split('.'):
+        if isinstance(doc, dict) and key in doc:
+            doc = doc[key]
+        elif isinstance(doc, list) and key.isdigit() and int(key) < len(doc):
+            doc = doc[int(key)]
+        else:
+            return default
+    return doc
+
+
+def unset_path(doc, path):
+    """Delete a value at a dotted path (if it exists).
+    """
+
+    keys = path.split('.')
+    parent = get_path(doc, '.'.join(keys[:-1])) if len(keys) > 1 else doc
+    if isinstance(parent, dict):
+        parent.pop(keys[-1], None)
+
+
+def apply_update(doc, update, insert=False):
+    """Apply an update (with update operators, or a replacement) in place.
+
+    Args:
+        doc (dict): document
+        update (dict): update
+        insert (bool): if the update is an upsert inserting the document
+    """
+
+    if not any(key.startswith('$') for key in update):  # Replacement
+        _id = doc.get('_id')
+        doc.clear()
+        doc.update(copy_value(update))
+        if _id is not None:
+            doc['_id'] = _id
+        return
+
+    missing = object()
+    for op, fields in update.items():
+        for path, value in fields.items():
+            value = copy_value(value)
+            current = get_path(doc, path, missing)
+            if op == '$set':
+                set_path(doc, path, value)
+            elif op == '$setOnInsert':
+                if insert:
+                    set_path(doc, path, value)
+            elif op == '$unset':
+                unset_path(doc, path)
+            elif op == '$inc':
+                set_path(doc, path,
+                         value if current is missing else current + value)
+            elif op in ('$min', '$max'):
+                if current is missing or compare(
+                        '$lt' if op == '$min' else '$gt', value, current):
+                    set_path(doc, path, value)
+            elif op in ('$push', '$addToSet'):
+                if is_operator_dict(value):
+                    values = value['$each']
+                else:
+                    values = [value]
+                items = [] if current is missing else current
+                if not isinstance(items, list):
+                    raise OperationFailure(
+                        'The field {!r} must be an array'.format(path))
+                for item in values:
+                    if op == '$push' or not any(equal(item, i) for i in items):
+                        items.append(item)
+                if is_operator_dict(value) and '$slice' in value:
+                    n = value['$slice']
+                    items[:] = items[-abs(n):] if n < 0 else items[:n]
+                set_path(doc, path, items)
+            elif op == '$pull':
+                if isinstance(current, list):
+                    current[:] = [
+                        item for item in current if not (
+                            match_condition([item], value)
+                            if is_operator_dict(value) else
+                            match(item, value) if isinstance(value, dict) and
+                            isinstance(item, dict) else equal(item, value))]
+            else:
+                raise OperationFailure('unknown update operator: ' + op)
+
+
+def project(doc, projection):
+    """Apply a projection (inclusion or exclusion of dotted paths).
+
+    Args:
+        doc (dict): document (not modified)
+        projection (dict): projection (or list of paths to include)
+
+    Returns:
+        dict: projected document (copied)
+    """
+
+    if not projection:
+        return copy_value(doc)
+    if not isinstance(projection, dict):
+        projection = {key: 1 for key in projection}
+
+    inclusion = any(value for key, value in projection.items()
+                    if key != '_id')
+    if inclusion:
+        d = {}
+        if projection.get('_id', 1) and '_id' in doc:
+            d['_id'] = doc['_id']
+        missing = object()
+        for path, value in projection.items():
+            if value and path != '_id':
+                item = get_path(doc, path, missing)
+                if item is not missing:
+                    set_path(d, path, copy_value(item))
+        return d
+
+    d = copy_value(doc)
+    for path, value in projection.items():
+        if not value:
+            unset_path(d, path)
+    return d
+
+
+def get_sort_keys(keys):
+    """List of (key, direction) pairs from a sort specification.
+    """
+
+    if isinstance(keys, str):
+        return [(keys, 1)]
+    elif isinstance(keys, dict):
+        return list(keys.items())
+    return list(keys)
+
+
+def sort_key(keys):
+    """Key function ordering documents as :func:`sort` (e.g. for merging
+    sorted cursors with :func:`heapq.merge`).
+    """
+
+    keys = get_sort_keys(keys)
+
+    def key_function(doc):
+        return SortKey([(get_sort_key((resolve(doc, key) or [None])[0]),
+                         direction) for key, direction in keys])
+    return key_function
+
+
+class SortKey(object):
+    """Sort key of a document (see :func:`sort_key`), comparing each key in
+    its direction.
+    """
+
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values  # List of (sort key, direction)
+
+    def __lt__(self, other):
+        for (a, direction), (b, _) in zip(self.values, other.values):
+            if a != b:
+                return a < b if direction > 0 else b < a
+        return False
+
+
+def sort(docs, keys):
+    """Sort documents by a list of (key, direction) pairs (stable).
+    """
+
+    keys = get_sort_keys(keys)
+    for key, direction in reversed(list(keys)):
+        docs.sort(key=lambda doc: get_sort_key(
+            (resolve(doc, key) or [None])[0]), reverse=direction < 0)
+    return docs
+
+
+# -----------------------------------------------------------------------------
+# MemoryIndex
+# -----------------------------------------------------------------------------
+
+class MemoryIndex(object):
+    """Hash index (all fields) and sorted index (first field) of documents.
+
+    Array values are indexed by element (multikey), and missing values are
+    indexed as None, so an index lookup always returns a superset of the
+    documents matching, which are then checked by the query matcher.
+    """
+
+    def __init__(self, name, keys, unique=False):
+        """Initialize empty index.
+
+        Args:
+            name (str): index name
+            keys (list): list of (key, direction) pairs
+            unique (bool): if the index is unique
+        """
+
+        self.name = name
+        self.keys = list(keys)
+        self.fields = [key for key, direction in self.keys]
+        self.unique = unique
+        self.hash = {}  # Frozen key tuple -> set of _id
+        self.sorted = []  # Sorted list of (sort key, sequence, _id)
+        self.multikey = False  # If any document has several sort keys
+        self.ops = 0
+
+    def entries(self, doc):
+        """Frozen key tuples of a document (several if multikey).
+        """
+
+        values = [expand(resolve(doc, field)) or [None]
+                  for field in self.fields]
+        values = [[v for v in vs if not isinstance(v, list)] or [None]
+                  for vs in values]
+        return set(tuple(freeze(v) for v in key) for key in product(*values))
+
+    def first(self, doc):
+        """Sort keys of the first field of a document (several if multikey).
+        """
+
+        values = expand(resolve(doc, self.fields[0])) or [None]
+        return set(get_sort_key(v) for v in values if not isinstance(v, list))
+
+    def add(self, doc, seq):
+        """Add a document (raising DuplicateKeyError if unique and duplicated).
+        """
+
+        entries = self.entries(doc)
+        if self.unique:
+            for entry in entries:
+                if self.hash.get(entry, set()) - {doc['_id']}:
+                    raise DuplicateKeyError(
+                        'E11000 duplicate key error index: {} dup key: {}'
+                        .format(self.name, entry))
+        for entry in entries:
+            self.hash.setdefault(entry, set()).add(doc['_id'])
+        keys = self.first(doc)
+        self.multikey = self.multikey or len(keys) > 1
+        for key in keys:
+            insort(self.sorted, (key, seq, doc['_id']))
+
+    def remove(self, doc, seq):
+        """Remove a document.
+        """
+
+        for entry in self.entries(doc):
+            ids = self.hash.get(entry)
+            if ids is not None:
+                ids.discard(doc['_id'])
+                if not ids:
+                    del self.hash[entry]
+        for key in self.first(doc):
+            i = bisect_left(self.sorted, (key, seq))
+            if i < len(self.sorted) and self.sorted[i][:2] == (key, seq):
+                del self.sorted[i]
+
+    def lookup(self, query):
+        """Candidate _ids for a query (None if the index is not usable).
+        """
+
+        values = []
+        for field in self.fields:
+            condition = query.get(field, None)
+            if is_operator_dict(condition) and list(condition) == ['$eq']:
+                condition = condition['$eq']
+            if field not in query or isinstance(condition, (dict, list)) or \
+                    isinstance(condition, PATTERN_TYPE):
+                break
+            values.append(condition)
+        else:
+            self.ops += 1
+            return self.hash.get(tuple(freeze(v) for v in values), set())
+
+        condition = query.get(self.fields[0])
+        if is_operator_dict(condition) and set(condition) <= RANGE_OPERATORS:
+            ranks = set(get_rank(v) for v in condition.values())
+            if len(ranks) != 1:
+                return None
+            self.ops += 1
+            if not self.multikey:
+                return self._range(ranks.pop(), condition.items())
+            # Each bound can be satisfied by a different array element, so
+            # the bounds are looked up separately and intersected
+            return set.intersection(*[
+                self._range(get_rank(value), [(op, value)])
+                for op, value in condition.items()])
+
+        return None
+
+    def _range(self, rank, bounds):
+        """_ids of sort keys of a type rank within all bounds (op, value).
+        """
+
+        inf = float('inf')
+        lo = bisect_left(self.sorted, ((rank,),))
+        hi = bisect_left(self.sorted, ((rank + 1,),))
+        for op, value in bounds:
+            key = get_sort_key(value)
+            if op == '$gt':
+                lo = max(lo, bisect_right(self.sorted, (key, inf)))
+            elif op == '$gte':
+                lo = max(lo, bisect_left(self.sorted, (key,)))
+            elif op == '$lt':
+                hi = min(hi, bisect_left(self.sorted, (key,)))
+            else:
+                hi = min(hi, bisect_right(self.sorted, (key, inf)))
+        return set(entry[2] for entry in self.sorted[lo:hi])
+
+
+# -----------------------------------------------------------------------------
+# MemoryCursor
+# -----------------------------------------------------------------------------
+
+class MemoryCursor(object):
+    """Cursor over documents (already copied and projected).
+    """
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.iterator = None
+        self.alive = True  # Cursors are never tailable
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.iterator is None:
+            self.iterator = iter(self.docs)
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            self.alive = False
+            raise
+
+    def sort(self, key, direction=1):
+        sort(self.docs, key if not isinstance(key, str) else
+             [(key, direction)])
+        return self
+
+    def skip(self, n):
+        self.docs = self.docs[n:]
+        return self
+
+    def limit(self, n):
+        if n:
+            self.docs = self.docs[:abs(n)]
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    def close(self):
+        self.docs = []
+        self.iterator = None
+        self.alive = False
+
+
+# -----------------------------------------------------------------------------
+# MemoryCollection
+# -----------------------------------------------------------------------------
+
+class MemoryCollection(object):
+    """In-process collection implementing a subset of the :mod:`pymongo` API.
+    """
+
+    def __init__(self, database, name):
+        """Initialize empty collection (with an _id index).
+        """
+
+        self.database = database
+        self.name = name
+        self.full_name = '{}.{}'.format(database.name, name)
+        self.lock = threading.RLock()
+        self.documents = {}  # Frozen _id -> document (in insertion order)
+        self.sequence = {}  # Frozen _id -> insertion sequence number
+        self.next_seq = 0
+        self.indexes = {}  # Index name -> MemoryIndex (excluding _id)
+        self.id_ops = 0
+        self.write_concern = WriteConcern()
+        self.read_concern = ReadConcern()
+        self.changes = None  # Change log (once watched), see watch
+        self.next_change = 0  # Sequence number of the next change
+        self.changed = threading.Condition(self.lock)
+
+    def with_options(self, write_concern=None, read_concern=None, **kwargs):
+        """Collection view with the write and read concern specified (other
+        options are ignored), sharing the documents of the collection.
+        """
+
+        return MemoryCollectionView(
+            self, write_concern or self.write_concern,
+            read_concern or self.read_concern)
+
+    def clear(self):
+        """Remove all documents and indexes (as when dropped).
+        """
+
+        with self.lock:
+            self.documents.clear()
+            self.sequence.clear()
+            self.indexes.clear()
+            self._record('drop')
+
+    # -------------------------------------------------------------------------
+    # Indexes
+    # -------------------------------------------------------------------------
+
+    def create_indexes(self, indexes):
+        """Create indexes from a list of :class:`pymongo.IndexModel`.
+        """
+
+        names = []
+        for index in indexes:
+            document = index.document
+            names.append(self._create_index(
+                list(document['key'].items()), document['name'],
+                document.get('unique', False)))
+        return names
+
+    def create_index(self, keys, name=None, unique=False, **kwargs):
+        """Create an index from a key (or list of (key, direction) pairs).
+        """
+
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        name = name or '_'.join('{}_{}'.format(k, d) for k, d in keys)
+        return self._create_index(list(keys), name, unique)
+
+    def _create_index(self, keys, name, unique):
+        with self.lock:
+            if name not in self.indexes:
+                index = MemoryIndex(name, keys, unique)
+                for _id, doc in self.documents.items():
+                    index.add(doc, self.sequence[_id])
+                self.indexes[name] = index
+        return name
+
+    def drop_index(self, name):
+        """Drop an index by name.
+        """
+
+        with self.lock:
+            if name not in self.indexes:
+                raise OperationFailure('index not found with name ' + name)
+            del self.indexes[name]
+
+    def index_information(self):
+        """Index information (including the _id index).
+        """
+
+        information = {'_id_': {'key': [('_id', 1)]}}
+        for name, index in self.indexes.items():
+            information[name] = {'key': list(index.keys)}
+            if index.unique:
+                information[name]['unique'] = True
+        return information
+
+    # -------------------------------------------------------------------------
+    # Reading
+    # -------------------------------------------------------------------------
+
+    def _candidates(self, query):
+        """Candidate documents for a query (using an index where possible).
+        """
+
+        query = query or {}
+        condition = query.get('_id')
+        if is_operator_dict(condition) and list(condition) == ['$eq']:
+            condition = condition['$eq']
+        if '_id' in query and not isinstance(condition, (dict, list)):
+            self.id_ops += 1
+            doc = self.documents.get(freeze(condition))
+            return [doc] if doc is not None else []
+
+        for index in self.indexes.values():
+            ids = index.lookup(query)
+            if ids is not None:
+                keys = sorted((freeze(_id) for _id in ids),
+                              key=self.sequence.__getitem__)
+                return [self.documents[key] for key in keys]
+
+        return list(self.documents.values())
+
+    def _find(self, query=None, sort_keys=None, skip=0, limit=0):
+        """Documents matching a query (not copied).
+        """
+
+        with self.lock:
+            docs = [doc for doc in self._candidates(query)
+                    if match(doc, query)]
+        if sort_keys:
+            sort(docs, sort_keys)
+        if skip:
+            docs = docs[skip:]
+        if limit:
+            docs = docs[:abs(limit)]
+        return docs
+
+    def find(self, filter=None, projection=None, skip=0, limit=0, sort=None,
+             **kwargs):
+        """Find documents (other options, e.g. batch_size, are ignored).
+        """
+
+        docs = self._find(filter, sort, skip, limit)
+        return MemoryCursor([project(doc, projection) for doc in docs])
+
+    def find_one(self, filter=None, projection=None, *args, **kwargs):
+        """Find one document (or None).
+        """
+
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        kwargs['limit'] = 1
+        return next(self.find(filter, projection, *args, **kwargs), None)
+
+    def find_raw_batches(self, filter=None, projection=None, batch_size=0,
+                         **kwargs):
+        """Find documents as raw BSON batches.
+        """
+
+        docs = list(self.find(filter, projection, **kwargs))
+        size = batch_size or 101
+        for i in range(0, len(docs), size):
+            yield b''.join(bson.BSON.encode(doc) for doc in docs[i:i + size])
+
+    def count_documents(self, filter, limit=0, skip=0, **kwargs):
+        """Count documents matching a query.
+        """
+
+        return len(self._find(filter, None, skip, limit))
+
+    def estimated_document_count(self, **kwargs):
+        """Count all documents.
+        """
+
+        return len(self.documents)
+
+    def aggregate(self, pipeline, **kwargs):
+        """Aggregate (supports $match, $sort, $skip, $limit, $project, $unwind,
+        $group, $count, and $indexStats).
+        """
+
+        if pipeline and '$indexStats' in pipeline[0]:
+            stats = [{'name': '_id_', 'key': {'_id': 1},
+                      'accesses': {'ops': self.id_ops}}]
+            stats += [{'name': name, 'key': dict(index.keys),
+                       'accesses': {'ops': index.ops}}
+                      for name, index in self.indexes.items()]
+            return MemoryCursor(stats)
+
+        docs = None
+        for stage in pipeline:
+            (op, arg), = stage.items()
+            if docs is None:
+                query = arg if op == '$match' else {}
+                docs = [copy_value(doc) for doc in self._find(query)]
+                if op == '$match':
+                    continue
+            if op == '$match':
+                docs = [doc for doc in docs if match(doc, arg)]
+            elif op == '$sort':
+                sort(docs, list(arg.items()))
+            elif op == '$skip':
+                docs = docs[arg:]
+            elif op == '$limit':
+                docs = docs[:arg]
+            elif op == '$project':
+                docs = [project(doc, arg) for doc in docs]
+            elif op == '$unwind':
+                path = (arg if isinstance(arg, str) else arg['path'])[1:]
+                docs = [dict(doc, **{path: item}) for doc in docs
+                        for item in get_path(doc, path, None) or []]
+            elif op == '$group':
+                docs = group(docs, arg)
+            elif op == '$count':
+                docs = [{arg: len(docs)}]
+            else:
+                raise OperationFailure('unsupported pipeline stage: ' + op)
+
+        return MemoryCursor(docs if docs is not None else
+                            [copy_value(doc) for doc in self._find({})])
+
+    # -------------------------------------------------------------------------
+    # Writing
+    # -------------------------------------------------------------------------
+
+    def _insert(self, doc):
+        """Insert a document (copied) with the lock held.
+        """
+
+        if hasattr(doc, 'raw'):  # RawBSONDocument
+            doc = bson.BSON(doc.raw).decode()
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()  # As pymongo, set on the original
+        stored = copy_value(doc)
+        key = freeze(stored['_id'])
+        if key in self.documents:
+            raise DuplicateKeyError(
+                'E11000 duplicate key error index: _id_ dup key: {}'.format(
+                    stored['_id']))
+        seq = self.next_seq
+        added = []
+        try:
+            for index in self.indexes.values():
+                index.add(stored, seq)
+                added.append(index)
+        except DuplicateKeyError:
+            for index in added:
+                index.remove(stored, seq)
+            raise
+        self.next_seq += 1
+        self.documents[key] = stored
+        self.sequence[key] = seq
+        self._record('insert', stored)
+        return stored['_id']
+
+    def _replace(self, old, new):
+        """Replace a stored document, maintaining indexes (lock held).
+        """
+
+        key = freeze(old['_id'])
+        seq = self.sequence[key]
+        for index in self.indexes.values():
+            index.remove(old, seq)
+        try:
+            for index in self.indexes.values():
+                index.add(new, seq)
+        except DuplicateKeyError:
+            for index in self.indexes.values():
+                index.remove(new, seq)
+                index.add(old, seq)
+            raise
+        self.documents[key] = new
+        self._record('update', new)
+
+    def _delete(self, doc):
+        """Delete a stored document (lock held).
+        """
+
+        key = freeze(doc['_id'])
+        seq = self.sequence.pop(key)
+        for index in self.indexes.values():
+            index.remove(doc, seq)
+        del self.documents[key]
+        self._record('delete', doc)
+
+    def _record(self, op, doc=None):
+        """Record a change in the change log, if watched (lock held).
+        """
+
+        if self.changes is None:
+            return
+        change = {'_id': {'_data': str(self.next_change)},
+                  'operationType': op}
+        if doc is not None:
+            change['documentKey'] = {'_id': doc['_id']}
+            if op != 'delete':
+                change['fullDocument'] = copy_value(doc)
+        self.changes.append(change)
+        self.next_change += 1
+        self.changed.notify_all()
+
+    # -------------------------------------------------------------------------
+    # Change streams
+    # -------------------------------------------------------------------------
+
+    def watch(self, pipeline=None, full_document=None, resume_after=None,
+              max_await_time_ms=None, **kwargs):
+        """Change stream of the collection (pipelines are not supported).
+
+        Changes are only recorded once the collection is first watched, and
+        the last CHANGE_LOG_SIZE changes are kept to resume after.
+        """
+
+        if pipeline:
+            raise OperationFailure('change stream pipelines are not supported')
+        with self.lock:
+            if self.changes is None:
+                self.changes = deque(maxlen=CHANGE_LOG_SIZE)
+            position = self.next_change
+            if resume_after is not None:
+                position = int(resume_after['_data']) + 1
+                if not (self.next_change - len(self.changes) <= position <=
+                        self.next_change):
+                    raise OperationFailure(
+                        'resume point may no longer be in the change log')
+        return MemoryChangeStream(
+            self, position, full_document, max_await_time_ms)
+
+    def _update(self, filter, update, upsert=False, many=False):
+        """Update documents, returning raw result (lock held).
+        """
+
+        docs = self._find(filter, limit=0 if many else 1)
+        n = modified = 0
+        for doc in docs:
+            new = copy_value(doc)
+            apply_update(new, update)
+            n += 1
+            if not identical(new, doc):
+                self._replace(doc, new)
+                modified += 1
+
+        result = {'n': n, 'nModified': modified}
+        if not docs and upsert:
+            doc = {}
+            for key, condition in (filter or {}).items():
+                if is_operator_dict(condition) and '$eq' in condition:
+                    condition = condition['$eq']
+                if not key.startswith('$') and not is_operator_dict(condition):
+                    set_path(doc, key, copy_value(condition))
+            apply_update(doc, update, insert=True)
+            result['upserted'] = self._insert(doc)
+            result['n'] = 1
+        return result
+
+    def insert_one(self, document, **kwargs):
+        with self.lock:
+            return InsertOneResult(self._insert(document), True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        ids = []
+        with self.lock:
+            for document in documents:
+                ids.append(self._insert(document))
+        return InsertManyResult(ids, True)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        with self.lock:
+            return UpdateResult(self._update(filter, update, upsert), True)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        with self.lock:
+            return UpdateResult(
+                self._update(filter, update, upsert, many=True), True)
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        with self.lock:
+            return UpdateResult(
+                self._update(filter, replacement, upsert), True)
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None,
+                            upsert=False, return_document=False, **kwargs):
+        """Update one document atomically, returning it before (or after).
+        """
+
+        with self.lock:
+            docs = self._find(filter, sort, limit=1)
+            if docs:
+                old = docs[0]
+                new = copy_value(old)
+                apply_update(new, update)
+                if new != old:
+                    self._replace(old, new)
+                doc = new if return_document else old
+            elif upsert:
+                _id = self._update(filter, update, upsert=True)['upserted']
+                doc = self.documents[freeze(_id)] if return_document else None
+            else:
+                doc = None
+            return project(doc, projection) if doc is not None else None
+
+    def find_one_and_delete(self, filter, projection=None, sort=None,
+                            **kwargs):
+        """Delete one document atomically, returning it.
+        """
+
+        with self.lock:
+            docs = self._find(filter, sort, limit=1)
+            for doc in docs:
+                self._delete(doc)
+            return project(docs[0], projection) if docs else None
+
+    def delete_one(self, filter, **kwargs):
+        with self.lock:
+            docs = self._find(filter, limit=1)
+            for doc in docs:
+                self._delete(doc)
+        return DeleteResult({'n': len(docs)}, True)
+
+    def delete_many(self, filter, **kwargs):
+        with self.lock:
+            docs = self._find(filter)
+            for doc in docs:
+                self._delete(doc)
+        return DeleteResult({'n': len(docs)}, True)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        """Bulk write (requests are applied sequentially).
+        """
+
+        result = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0,
+                  'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        with self.lock:
+            for i, request in enumerate(requests):
+                name = request.__class__.__name__
+                if name == 'InsertOne':
+                    self._insert(request._doc)
+                    result['nInserted'] += 1
+                elif name in ('UpdateOne', 'UpdateMany', 'ReplaceOne'):
+                    raw = self._update(request._filter, request._doc,
+                                       bool(request._upsert),
+                                       many=name == 'UpdateMany')
+                    if 'upserted' in raw:
+                        result['nUpserted'] += 1
+                        result['upserted'].append(
+                            {'index': i, '_id': raw['upserted']})
+                    else:
+                        result['nMatched'] += raw['n']
+                        result['nModified'] += raw['nModified']
+                elif name in ('DeleteOne', 'DeleteMany'):
+                    docs = self._find(request._filter,
+                                      limit=1 if name == 'DeleteOne' else 0)
+                    for doc in docs:
+                        self._delete(doc)
+                    result['nRemoved'] += len(docs)
+                else:
+                    raise OperationFailure('unsupported request: ' + name)
+        return BulkWriteResult(result, True)
+
+    def drop(self):
+        """Drop collection.
+        """
+
+        self.database.drop_collection(self.name)
+
+
+class MemoryCollectionView(object):
+    """Collection with options (see :meth:`MemoryCollection.with_options`).
+
+    Concerns are only reported, as writes are always applied immediately in
+    memory, and every other attribute is the collection's.
+    """
+
+    def __init__(self, collection, write_concern, read_concern):
+        self.collection = collection
+        self.write_concern = write_concern
+        self.read_concern = read_concern
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def with_options(self, write_concern=None, read_concern=None, **kwargs):
+        return self.collection.with_options(
+            write_concern=write_concern or self.write_concern,
+            read_concern=read_concern or self.read_concern)
+
+
+class MemoryChangeStream(object):
+    """Change stream of a collection (see :meth:`MemoryCollection.watch`).
+
+    Updates are reported with the full document after the update (as with
+    full_document='updateLookup'), otherwise only the document key.
+    """
+
+    def __init__(self, collection, position, full_document=None,
+                 max_await_time_ms=None):
+        self.collection = collection
+        self.position = position  # Sequence number of the next change
+        self.full_document = full_document
+        self.max_await_time = (max_await_time_ms or 0) / 1000.0
+        self.alive = True
+        self.resume_token = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self.alive:
+            change = self.try_next()
+            if change is not None:
+                return change
+        raise StopIteration
+
+    def try_next(self):
+        """Next change (or None if none within max_await_time_ms).
+        """
+
+        collection = self.collection
+        with collection.changed:
+            deadline = time.monotonic() + self.max_await_time
+            while self.alive and self.position >= collection.next_change:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                collection.changed.wait(remaining)
+            if not self.alive:
+                return None
+            first = collection.next_change - len(collection.changes)
+            if self.position < first:
+                self.alive = False
+                raise OperationFailure(
+                    'change stream fell behind the change log')
+            change = copy_value(collection.changes[self.position - first])
+        self.position += 1
+        if change['operationType'] == 'update' and \
+                self.full_document != 'updateLookup':
+            del change['fullDocument']
+        self.resume_token = change['_id']
+        return change
+
+    def close(self):
+        with self.collection.changed:
+            self.alive = False
+            self.collection.changed.notify_all()
+
+
+# -----------------------------------------------------------------------------
+# Aggregation
+# -----------------------------------------------------------------------------
+
+def evaluate(doc, expression):
+    """Evaluate a (field path or literal) expression for a document.
+    """
+
+    if isinstance(expression, str) and expression.startswith('$'):
+        if expression == '$$ROOT':
+            return doc
+        return (resolve(doc, expression[1:]) or [None])[0]
+    if isinstance(expression, dict):
+        return {k: evaluate(doc, v) for k, v in expression.items()}
+    return expression
+
+
+def group(docs, spec):
+    """Group documents (supports $push, $addToSet, $sum, $avg, $min, $max,
+    $first, and $last accumulators).
+    """
+
+    groups = {}
+    for doc in docs:
+        _id = evaluate(doc, spec['_id'])
+        key = freeze(_id)
+        if key not in groups:
+            groups[key] = ({'_id': _id}, {})
+        out, counts = groups[key]
+        for field, accumulator in spec.items():
+            if field == '_id':
+                continue
+            (op, expression), = accumulator.items()
+            value = evaluate(doc, expression)
+            if op == '$push':
+                out.setdefault(field, []).append(value)
+            elif op == '$addToSet':
+                items = out.setdefault(field, [])
+                if not any(equal(value, item) for item in items):
+                    items.append(value)
+            elif op in ('$sum', '$avg'):
+                if get_rank(value) == 2:
+                    out[field] = out.get(field, 0) + value
+                    counts[field] = counts.get(field, 0) + 1
+                else:
+                    out.setdefault(field, 0)
+            elif op in ('$min', '$max'):
+                if value is not None and (field not in out or compare(
+                        '$lt' if op == '$min' else '$gt', value, out[field])):
+                    out[field] = value
+            elif op == '$first':
+                out.setdefault(field, value)
+            elif op == '$last':
+                out[field] = value
+            else:
+                raise OperationFailure('unknown group operator: ' + op)
+    results = []
+    for out, counts in groups.values():
+        for field, accumulator in spec.items():
+            if field != '_id' and '$avg' in accumulator:
+                out[field] = (out[field] / counts[field]
+                              if counts.get(field) else None)
+        results.append(out)
+    return results
+
+
+# -----------------------------------------------------------------------------
+# MemoryDatabase and MemoryClient
+# -----------------------------------------------------------------------------
+
+class MemoryDatabase(object):
+    """In-process database (collections are created on demand).
+    """
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(self, name)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def create_collection(self, name, **kwargs):
+        """Create a collection (options, e.g. capped, are ignored).
+        """
+
+        if name in self.list_collection_names():
+            raise CollectionInvalid(
+                'collection {} already exists'.format(name))
+        return self[name]
+
+    def list_collection_names(self):
+        return [name for name, collection in self.collections.items()
+                if collection.documents or collection.indexes]
+
+    def drop_collection(self, name):
+        # Collections are cleared (not removed), as models keep a reference
+        if not isinstance(name, str):
+            name = name.name
+        if name in self.collections:
+            self.collections[name].clear()
+
+
+class MemoryClient(object):
+    """In-process client (databases are shared between clients by host URI).
+    """
+
+    stores = {}  # Host URI -> dict of MemoryDatabase
+    lock = threading.Lock()
+
+    def __init__(self, host='memory', **kwargs):
+        """Initialize client (options are ignored).
+        """
+
+        self.host = host
+        with self.lock:
+            self.databases = self.stores.setdefault(host, {})
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.databases:
+                self.databases[name] = MemoryDatabase(self, name)
+            return self.databases[name]
+
+    @property
+    def address(self):
+        match = re.search(r'([^@/]+):(\d+)$', self.host)
+        return (match.group(1), int(match.group(2))) if match else None
+
+    def server_info(self):
+        return {'ok': 1, 'version': 'memory'}
+
+    def list_database_names(self):
+        return list(self.databases)
+
+    def drop_database(self, name):
+        if not isinstance(name, str):
+            name = name.name
+        with self.lock:
+            database = self.databases.get(name)
+        if database is not None:
+            for collection in database.collections.values():
+                collection.clear()
+
+    def close(self):
+        pass
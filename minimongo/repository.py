@@ -7,13 +7,47 @@ attribute style indexing using :class:'AttrDictionary'.
 """
 
 from .auxiliary import *  # should expand
-
+from .memory import MemoryClient, match, get_sort_keys, sort_key
+from .spool import Spool, is_idempotent
+
+import atexit
+import bson
+import hashlib
+import heapq
+import io
+import keyword
+import mmap
+import os
 import pymongo
 import logging
-
+import threading
+import time
+
+from bisect import bisect_right
+from collections import Counter, OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import chain, groupby, islice
+from types import FunctionType
+
+from bson import ObjectId, json_util
+from bson.raw_bson import RawBSONDocument
 from inflection import underscore
 
-from pymongo import IndexModel, TEXT, ASCENDING, DESCENDING
+from pymongo import IndexModel, TEXT, ASCENDING, DESCENDING, UpdateOne, \
+    ReplaceOne
+from pymongo import CursorType, ReturnDocument
+from pymongo.errors import PyMongoError, OperationFailure, \
+    CollectionInvalid, BulkWriteError, ConnectionFailure, CursorNotFound
+from pymongo.read_concern import ReadConcern
+from pymongo.results import UpdateResult, DeleteResult
+from pymongo.write_concern import WriteConcern
+
+try:
+    import numpy  # Optional (only required for Model.find_columns)
+except ImportError:
+    numpy = None
 
 # -----------------------------------------------------------------------------
 # Constants
@@ -27,7 +61,69 @@ DEFAULT_CONFIG = {
     'password': None,
     'database': None,
     'collection': None,
-    'indexes': []  # List of pymongo IndexModel
+    'indexes': [],  # List of pymongo IndexModel
+    'record_queries': False,  # Record query shapes for index recommendations
+    'count_max_age': None,  # Seconds to cache counts for (None disables)
+    'fields': None,  # Dict of Field declaring a compact schema (optional)
+    'write_behind': None,  # Dict of WriteBuffer options (None disables)
+    'spool': None,  # Dict of Spool options, including path (None disables)
+    'write_concern': None,  # Dict of WriteConcern options, e.g. {'w': 0}
+    'read_concern': None,  # Dict of ReadConcern options, e.g. {'level': ...}
+    'client': {},  # Dict of MongoClient options, e.g. {'maxPoolSize': 100}
+    'backend': 'mongodb',  # Backend, 'mongodb' or 'memory' (in process)
+    'checkpoints': 'checkpoints',  # Collection for checkpoints (same database)
+    'buckets': None,  # Dict of bucket options (None disables)
+    'capped': None,  # Dict of capped collection options, e.g. {'size': ...}
+    'large_fields': [],  # Keys stored out of line, loaded lazily (see Model)
+    'fingerprint': None,  # Dict of fingerprint options (None disables)
+    'partitions': None,  # Dict of partition options (None disables)
+}
+
+# Default fingerprint options (see Model.save)
+DEFAULT_FINGERPRINT = {
+    'key': '_fingerprint',  # Key to store the fingerprint
+    'exclude': ['_id'],  # Keys excluded from the fingerprint
+}
+
+# Default partition options (see Model._get_partition)
+DEFAULT_PARTITIONS = {
+    'key': None,  # Shard key (required)
+    'method': 'hash',  # Routing method, 'hash' or 'range'
+    'count': 2,  # Number of partitions ('hash' only, unless targets given)
+    'bounds': [],  # Sorted lower bounds of partitions 1..N-1 ('range' only)
+    'targets': None,  # List of config overrides (e.g. host, collection)
+}
+
+# Chunk size in bytes for large fields (as for GridFS)
+LARGE_CHUNK_SIZE = 255 * 1024
+
+# Default bucket options (see Model.append)
+DEFAULT_BUCKETS = {
+    'series': 'series',  # Series key
+    'time': 'time',  # Time key
+    'window': 3600,  # Bucket time window in seconds
+    'size': 1000,  # Maximum number of events per bucket
+    'stats': [],  # Numeric keys to keep the minimum and maximum of
+}
+
+# Update operators supported (see Model.update)
+UPDATE_OPERATORS = {'$set', '$unset', '$inc', '$push'}
+
+# Index options set by the server (ignored when comparing indexes)
+SERVER_INDEX_OPTIONS = {
+    'background', 'textIndexVersion', '2dsphereIndexVersion', 'weights',
+    'default_language', 'language_override',
+}
+
+# Maximum number of counts cached per model (least recently used evicted)
+COUNT_CACHE_SIZE = 1024
+
+# Default numpy dtypes for Python types (see Model.find_columns)
+_numpy_dtypes = {
+    bool: 'bool',
+    int: 'int64',
+    float: 'float64',
+    datetime: 'datetime64[ms]',
 }
 
 
@@ -67,11 +163,11 @@ class MetaModel(type):
         # Configure logging
         _cls._logger = logging.getLogger(name)
 
-        # Get model config
+        # Get model config (merged recursively, e.g. for client options)
         try:
-            config = merge(DEFAULT_CONFIG, getattr(_cls, 'config'))
+            config = merge_nested(DEFAULT_CONFIG, getattr(_cls, 'config'))
         except AttributeError:
-            config = DEFAULT_CONFIG
+            config = merge_nested(DEFAULT_CONFIG)
         setattr(_cls, 'config', config)
         # else:
         #     delattr(cls, 'config')  # delete attribute to avoid key conflicts
@@ -81,9 +177,14 @@ class MetaModel(type):
         config['collection'] = config['collection'] or underscore(name)
 
         # Connect to MongoDB
+        def connect(host_uri):
+            if config['backend'] == 'memory':
+                return MemoryClient(host_uri)
+            return pymongo.MongoClient(host=host_uri, **config['client'])
+
         host_uri = get_uri(config)
         try:
-            _cls.connection = pymongo.MongoClient(host=host_uri)
+            _cls.connection = connect(host_uri)
             _cls._logger.info('Connection to %s succeeded', host_uri)
         except Exception as e:
             _cls._logger.exception('Error establishing connection to %s: %s',
@@ -91,11 +192,119 @@ class MetaModel(type):
             raise
 
         _cls.database = _cls.connection[config['database']]
+
+        # Capped collection (if config['capped'] is specified and not created)
+        if config['capped'] is not None:
+            try:
+                _cls.database.create_collection(
+                    config['collection'], capped=True, **config['capped'])
+            except CollectionInvalid:
+                pass  # Already exists (options are not checked)
+
         _cls.collection = _cls.database[config['collection']]
+        _cls._chunks = _cls.database[config['collection'] + '.large']
+        _cls._checkpoints = _cls.database[config['checkpoints']]
+
+        # Write and read concern (applied without creating new clients)
+        if config['write_concern'] is not None:
+            _cls.collection = _cls.collection.with_options(
+                write_concern=WriteConcern(**config['write_concern']))
+        if config['read_concern'] is not None:
+            _cls.collection = _cls.collection.with_options(
+                read_concern=ReadConcern(**config['read_concern']))
+
+        # Partitions (if config['partitions'] is specified)
+        _cls._partitions = None
+        if config['partitions'] is not None:
+            options = merge(DEFAULT_PARTITIONS, config['partitions'])
+            config['partitions'] = options
+            if options['key'] is None or options['method'] not in (
+                    'hash', 'range'):
+                raise ValueError(
+                    "partitions require a key and method 'hash' or 'range'")
+            if (config['write_behind'] is not None or
+                    config['spool'] is not None):
+                raise ValueError(
+                    "config['partitions'] can not be used with "
+                    "config['spool'] or config['write_behind']")
+            targets = options['targets'] or [
+                {'collection': '{}.{}'.format(config['collection'], i)}
+                for i in range(len(options['bounds']) + 1
+                               if options['method'] == 'range' else
+                               options['count'])]
+            if (options['method'] == 'range' and
+                    len(targets) != len(options['bounds']) + 1):
+                raise ValueError('range partitions require len(bounds) + 1 '
+                                 'targets')
+            clients = {host_uri: _cls.connection}
+            _cls._partitions = []
+            for target in targets:
+                target = merge(config, target)
+                target_uri = get_uri(target)
+                if target_uri not in clients:
+                    clients[target_uri] = connect(target_uri)
+                collection = clients[target_uri][target['database']][
+                    target['collection']]
+                if config['write_concern'] is not None:
+                    collection = collection.with_options(
+                        write_concern=WriteConcern(**config['write_concern']))
+                if config['read_concern'] is not None:
+                    collection = collection.with_options(
+                        read_concern=ReadConcern(**config['read_concern']))
+                _cls._partitions.append(collection)
+            _cls._executor = ThreadPoolExecutor(len(targets))
+
+        # Query shapes recorded (if config['record_queries'] is enabled)
+        _cls._query_shapes = Counter()
+
+        # Counts cached (if config['count_max_age'] is specified)
+        _cls._count_cache = OrderedDict()  # Least recently used first
+
+        # Compact type (if config['fields'] is specified)
+        if config['fields']:
+            _cls.Compact = MetaEmbedded(
+                name + 'Compact', (Embedded,), {
+                    '__module__': _cls.__module__,
+                    'fields': merge({'_id': Field()}, config['fields']),
+                })
+
+        # Write behind buffer (if config['write_behind'] is specified)
+        _cls._write_buffer = None
+        if config['write_behind'] is not None:
+            _cls._write_buffer = WriteBuffer(
+                _cls.collection, logger=_cls._logger, **config['write_behind'])
+
+        # Spool (if config['spool'] is specified)
+        _cls._spool = None
+        if config['spool'] is not None:
+            _cls._spool = Spool(logger=_cls._logger, **config['spool'])
+
+        # Buckets (if config['buckets'] is specified)
+        if config['buckets'] is not None:
+            config['buckets'] = merge(DEFAULT_BUCKETS, config['buckets'])
+            config['indexes'] = config['indexes'] + [IndexModel(
+                [(config['buckets']['series'], ASCENDING),
+                 ('start', ASCENDING)])]
+
+        # Fingerprint (if config['fingerprint'] is specified)
+        if config['fingerprint'] is not None:
+            config['fingerprint'] = merge(
+                DEFAULT_FINGERPRINT, config['fingerprint'])
+
+        # Large fields chunks (if config['large_fields'] is specified), which
+        # are written directly, so can not be deferred with the document
+        if config['large_fields']:
+            if config['spool'] is not None or \
+                    config['write_behind'] is not None:
+                raise ValueError("config['large_fields'] can not be used with "
+                                 "config['spool'] or config['write_behind']")
+            _cls._chunks.create_index([('file', ASCENDING), ('n', ASCENDING)],
+                                    unique=True)
 
         if len(config['indexes']) > 0:
             # Should gracefully create indexes (providing no option conflicts)
-            _cls.collection.create_indexes(config['indexes'])
+            for collection in _cls._get_collections():
+                collection.create_indexes(config['indexes'])
 
         return _cls
 
@@ -165,10 +374,39 @@ class AttrDictionary(dict):
 
         return super(AttrDictionary, self).__setitem__(key, value)
 
+    def __reduce__(self):
+        """Pickle by items (already wrapped), so unpickling skips wrapping.
+        """
+
+        return (self.__class__._from_items, (dict(self),),
+                self.__dict__ or None)
+
     # -------------------------------------------------------------------------
     # Helpers
     # -------------------------------------------------------------------------
 
+    @classmethod
+    def _from_items(cls, items):
+        """Create from items which are already wrapped (skipping wrapping).
+        """
+
+        obj = dict.__new__(cls)
+        dict.update(obj, items)
+        return obj
+
+    @classmethod
+    def _from_decoded(cls, obj):
+        """Wrap a decoded BSON document recursively (faster than __init__).
+        """
+
+        if type(obj) is dict:
+            return AttrDictionary._from_items(
+                {k: cls._from_decoded(v) for k, v in obj.items()})
+        elif type(obj) is list:
+            return [cls._from_decoded(child) for child in obj]
+
+        return obj
+
     @classmethod
     def _ensure_attr_dictionary(cls, obj):
         """Ensure object has AttrDictionary functionality recursively.
@@ -184,6 +422,273 @@ class AttrDictionary(dict):
         return obj
 
 
+# -----------------------------------------------------------------------------
+# AttrView
+# -----------------------------------------------------------------------------
+
+class AttrView(Mapping):
+    """Read only view of a :class:`dict` allowing `.` access to members.
+
+    Unlike :class:`AttrDictionary`, the dictionary is neither copied nor
+    wrapped recursively, as nested dictionaries are only wrapped (as views)
+    when they are accessed, and lists are returned as tuples of views.
+    """
+
+    __slots__ = ('_d',)
+
+    def __init__(self, d):
+        """Initialize view of a dictionary (not copied).
+
+        Args:
+            d (dict): dictionary
+        """
+
+        object.__setattr__(self, '_d', d)
+
+    def __getitem__(self, key):
+        """Get dictionary values by key (wrapped as views if required).
+        """
+
+        return self._ensure_attr_view(self._d[key])
+
+    def __getattr__(self, key):
+        """Allow get dictionary values by attribute key.
+        """
+
+        try:
+            return self._ensure_attr_view(self._d[key])
+        except KeyError as e:
+            raise AttributeError(e)
+
+    def __setattr__(self, key, value):
+        """Disallow set (read only).
+        """
+
+        raise TypeError("'{}' object is read only".format(
+            self.__class__.__name__))
+
+    def __delattr__(self, key):
+        """Disallow delete (read only).
+        """
+
+        raise TypeError("'{}' object is read only".format(
+            self.__class__.__name__))
+
+    def __iter__(self):
+        return iter(self._d)
+
+    def __len__(self):
+        return len(self._d)
+
+    def __contains__(self, key):
+        return key in self._d
+
+    def __eq__(self, other):
+        """Compare with a view or dictionary (without wrapping).
+        """
+
+        if isinstance(other, AttrView):
+            other = other._d
+        return self._d == other
+
+    def __repr__(self):
+        """String representation for object (class instance).
+        """
+
+        return '{}({!r})'.format(self.__class__.__name__, self._d)
+
+    # -------------------------------------------------------------------------
+    # Helpers
+    # -------------------------------------------------------------------------
+
+    @classmethod
+    def _ensure_attr_view(cls, obj):
+        """Ensure nested dictionaries (and lists of them) are views.
+        """
+
+        if isinstance(obj, dict):
+            return AttrView(obj)
+        elif isinstance(obj, list):
+            return tuple(cls._ensure_attr_view(child) for child in obj)
+
+        return obj
+
+
+# -----------------------------------------------------------------------------
+# Embedded (compact declared schema)
+# -----------------------------------------------------------------------------
+
+class Field(object):
+    """Declared field for an :class:`Embedded` (or compact :class:`Model`).
+
+    The type is only used for nested documents, which can be declared as an
+    :class:`Embedded` subclass, or a list containing one (for a list of nested
+    documents). The default is used for missing fields, and is called if it
+    is callable (e.g. :class:`list`) to avoid sharing mutable defaults.
+    """
+
+    __slots__ = ('type', 'default')
+
+    def __init__(self, type=None, default=None):
+        """Initialize with type and default.
+
+        Args:
+            type (type): field type, an :class:`Embedded` subclass, or a list
+                containing one
+            default (object): default value (or callable returning it)
+        """
+
+        self.type = type
+        self.default = default
+
+
+class MetaEmbedded(type):
+    """Embedded metaclass compiling slots and encode/decode functions.
+
+    When an :class:`Embedded` subclass is defined, its declared fields are
+    turned into `__slots__`, and :meth:`Embedded.from_dict` and
+    :meth:`Embedded.to_dict` are compiled once (as straight line code with no
+    per-field dispatch) for the class.
+    """
+
+    def __new__(cls, name, bases, namespace, **kwargs):
+        """Constructor for a new embedded type (compiles fields).
+        """
+
+        fields = namespace.get('fields', {})
+        for base in bases:
+            fields = merge(getattr(base, 'fields', {}), fields)
+        fields = {key: field if isinstance(field, Field) else Field(field)
+                  for key, field in fields.items()}
+
+        # Fields must be identifiers not shadowing (or shadowed by) attributes
+        inherited = set()
+        for base in bases:
+            inherited.update(getattr(base, 'fields', {}))
+        reserved = set(namespace)
+        for base in bases:
+            reserved.update(set(dir(base)) - inherited)
+        for key in fields:
+            if not isinstance(key, str) or not key.isidentifier() or \
+                    keyword.iskeyword(key):
+                raise ValueError(
+                    "Field %r of %s is not an identifier." % (key, name))
+            if key in reserved:
+                raise ValueError(
+                    "Field %r of %s collides with a class attribute." % (
+                        key, name))
+
+        namespace = dict(namespace)
+        namespace['fields'] = fields
+        namespace['__slots__'] = tuple(
+            key for key in fields
+            if not any(key in getattr(b, '__slots__', ()) for b in bases))
+
+        _cls = super().__new__(cls, name, bases, namespace)
+        _cls._compile()
+        return _cls
+
+    def _compile(cls):
+        """Compile from_dict and to_dict for the declared fields.
+        """
+
+        scope = {}
+        decode = ['def from_dict(cls, d):', '    obj = cls.__new__(cls)']
+        encode = ['def to_dict(self):', '    d = {}']
+        for i, (key, field) in enumerate(cls.fields.items()):
+            scope['d%s' % i] = field.default
+            default = '(d%s() if callable(d%s) else d%s)' % (i, i, i)
+            type_ = field.type
+            if isinstance(type_, list):
+                type_ = type_[0]
+                many = True
+            else:
+                many = False
+            if isinstance(type_, MetaEmbedded):
+                scope['t%s' % i] = type_
+                decode.append('    v = d.get(%r)' % key)
+                encode.append('    v = self.%s' % key)
+                if many:
+                    decode.append(
+                        '    obj.%s = %s if v is None else '
+                        '[t%s.from_dict(w) for w in v]' % (key, default, i))
+                    encode.append(
+                        '    d[%r] = v if v is None else '
+                        '[w.to_dict() for w in v]' % key)
+                else:
+                    decode.append(
+                        '    obj.%s = %s if v is None else t%s.from_dict(v)'
+                        % (key, default, i))
+                    encode.append(
+                        '    d[%r] = v if v is None else v.to_dict()' % key)
+            else:
+                decode.append(
+                    '    obj.%s = d[%r] if %r in d else %s'
+                    % (key, key, key, default))
+                encode.append('    d[%r] = self.%s' % (key, key))
+        decode.append('    return obj')
+        encode.append('    return d')
+
+        exec('\n'.join(decode), scope)
+        exec('\n'.join(encode), scope)
+        cls.from_dict = classmethod(scope['from_dict'])
+        cls.to_dict = scope['to_dict']
+
+
+class Embedded(object, metaclass=MetaEmbedded):
+    """Compact object with declared fields, allowing `.` access to members.
+
+    Subclasses declare fields as a :class:`dict` of :class:`Field` (or types),
+    and instances are `__slots__` backed, so have no per-instance dictionary,
+    giving a much smaller memory footprint than :class:`AttrDictionary`.
+
+    Example::
+
+        class Point(Embedded):
+            fields = {'x': Field(float, 0.0), 'y': Field(float, 0.0)}
+
+        point = Point.from_dict({'x': 1.0})
+    """
+
+    __slots__ = ()
+    fields = {}
+
+    def __init__(self, **kwargs):
+        """Initialize with keyword arguments (or defaults).
+        """
+
+        for key, field in self.fields.items():
+            if key in kwargs:
+                value = kwargs[key]
+            elif callable(field.default):
+                value = field.default()
+            else:
+                value = field.default
+            setattr(self, key, value)
+
+    def __eq__(self, other):
+        """Compare by class and declared fields.
+        """
+
+        return (self.__class__ == other.__class__ and
+                self.to_dict() == other.to_dict())
+
+    def __repr__(self):
+        """String representation for object (class instance).
+        """
+
+        return '{}({})'.format(self.__class__.__name__, self.to_dict())
+
+    @classmethod
+    def from_dict(cls, d):
+        """Decode from a dictionary (compiled by :class:`MetaEmbedded`).
+        """
+
+    def to_dict(self):
+        """Encode to a dictionary (compiled by :class:`MetaEmbedded`).
+        """
+
+
 # -----------------------------------------------------------------------------
 # Model (ORM)
 # -----------------------------------------------------------------------------
@@ -195,6 +700,14 @@ class Model(AttrDictionary, metaclass=MetaModel):
     to members of the dictionary, giving a straightforward ORM. The underlying
     :class:`pymongo.collection.Collection` can also be accessed directly,
     exposing the entirety of :mod:`pymongo` functionality if required.
+
+    Large fields (see config['large_fields']) are stored out of line by
+    :meth:`insert`, :meth:`insert_many`, :meth:`save`, and :meth:`update`
+    ($set or $unset of the whole field), in chunks in a sibling collection
+    (as for GridFS), with only a reference {'_large': id} in the document.
+    Objects loaded contain the reference, and the value is loaded on first
+    attribute access (e.g. obj.blob, but not obj['blob']), or streamed using
+    :meth:`open_large` (bytes values only).
     """
 
     # -------------------------------------------------------------------------
@@ -207,6 +720,45 @@ class Model(AttrDictionary, metaclass=MetaModel):
         super().__init__(*args, **kwargs)
         self._logger.debug('%s initialized.', self)
 
+    def to_bson(self):
+        """Encode to BSON (e.g. to send to another process or a cache).
+
+        Returns:
+            bytes: BSON document
+        """
+
+        return bson.encode(self)
+
+    @classmethod
+    def from_bson(self, data):
+        """Decode from BSON (see :meth:`to_bson`), without wrapping twice.
+
+        Args:
+            data (bytes): BSON document
+
+        Returns:
+            Model: object
+        """
+
+        return self._from_items({
+            key: AttrDictionary._from_decoded(value)
+            for key, value in bson.decode(data).items()})
+
+    def __getattr__(self, key):
+        """Allow get dictionary values by attribute key (loading large fields).
+        """
+
+        value = super(Model, self).__getattr__(key)
+        if key in self.config['large_fields']:
+            file_id = self._get_large_id(value)
+            if file_id is not None:
+                value = self._get_large(file_id)
+                self.__setitem__(key, value)
+                self._get_large_cache()[key] = (file_id, self._get_large_hash(
+                    value))
+                value = super(Model, self).__getattr__(key)
+        return value
+
     def __str__(self):
         """String representation for object (class instance).
         """
@@ -219,150 +771,2528 @@ class Model(AttrDictionary, metaclass=MetaModel):
     # -------------------------------------------------------------------------
 
     @classmethod
-    def insert_many(self, objects):
+    def insert_many(self, objects, write_concern=None):
         """Create and insert many objects into MongoDB.
 
         Objects can be a :class:`dict` or :class:`AttrDictionary`, and
         are returned as :class:`Model` instances, with the necessary bindings
         to MongoDB.
+
+        If config['spool'] is specified, the objects are spooled (see
+        :class:`minimongo.spool.Spool`) with an _id assigned locally.
+
+        The write concern can be specified per call, e.g. {'w': 0} for
+        unacknowledged writes, overriding config['write_concern'].
         """
 
-        res = self.collection.insert_many(objects)
+        if self._spool is not None:
+            self._check_deferred(write_concern)
+            objects = [self(obj) for obj in objects]
+            for obj in objects:
+                if '_id' not in obj:
+                    obj._id = ObjectId()
+                obj._keep_fingerprint(self._put_fingerprint(obj))
+            self._spool.insert_many(objects)
+            self._logger.info("%s objects spooled.", len(objects))
+            return objects
+
+        caches = [{} for obj in objects]
+        docs = [self._put_fingerprint(self._put_large_fields(obj, cache))
+                for obj, cache in zip(objects, caches)]
+        try:
+            if self._partitions is None:
+                collection = self._get_collection(write_concern)
+                inserted_ids = collection.insert_many(docs).inserted_ids
+            else:  # Scattered by partition (in parallel)
+                groups = {}
+                for i, doc in enumerate(docs):
+                    groups.setdefault(self._get_partition(doc), []).append(i)
+                partitions = sorted(groups)
+                results = self._scatter(
+                    lambda collection, partition: collection.insert_many(
+                        [docs[i] for i in groups[partition]]).inserted_ids,
+                    partitions, write_concern)
+                inserted_ids = [None] * len(docs)
+                for partition, ids in zip(partitions, results):
+                    for i, inserted_id in zip(groups[partition], ids):
+                        inserted_ids[i] = inserted_id
+        except Exception:
+            self._delete_large_unsaved(docs, caches)
+            raise
         objects = [self(obj) for obj in objects]
-        for i, inserted_id in enumerate(res.inserted_ids):
+        for i, inserted_id in enumerate(inserted_ids):
             objects[i]._id = inserted_id
+            objects[i]._keep_fingerprint(docs[i])
+            object.__setattr__(objects[i], '_large', caches[i])
             self._logger.debug("%s inserted.", objects[i])
 
         self._logger.info("%s objects inserted.", len(objects))
         return objects
 
     @classmethod
-    def insert(self, obj):
+    def insert(self, obj, write_concern=None):
         """Create and insert one object into MongoDB.
 
         Objects can be a :class:`dict` or :class:`AttrDictionary`, and
         are returned as :class:`Model` instances, with the necessary bindings
         to MongoDB.
+
+        If config['spool'] is specified, the object is spooled (see
+        :class:`minimongo.spool.Spool`) with an _id assigned locally.
+
+        The write concern can be specified per call, e.g. {'w': 0} for
+        unacknowledged writes, overriding config['write_concern'].
         """
 
-        res = self.collection.insert_one(obj)
+        if self._spool is not None:
+            self._check_deferred(write_concern)
+            obj = self(obj)
+            if '_id' not in obj:
+                obj._id = ObjectId()
+            obj._keep_fingerprint(self._put_fingerprint(obj))
+            self._spool.insert(obj)
+            self._logger.info("{{'_id': ObjectID('%s')}} spooled.", obj._id)
+            return obj
+
+        collection = self._get_collection(write_concern, obj)
+        cache = {}
+        doc = self._put_fingerprint(self._put_large_fields(obj, cache))
+        try:
+            res = collection.insert_one(doc)
+        except Exception:
+            self._delete_large_unsaved([doc], [cache])
+            raise
         obj = self(obj)
         obj._id = res.inserted_id
+        obj._keep_fingerprint(doc)
+        object.__setattr__(obj, '_large', cache)
 
         self._logger.debug("%s inserted.", obj)
         self._logger.info("{{'_id': ObjectID('%s')}} inserted.", obj._id)
         return obj
 
     @classmethod
-    def find_many(self, *args, **kwargs):
+    def find_many(self, *args, readonly=False, read_concern=None, **kwargs):
         """Load many from MongoDB.
-        """
 
-        objects = self.collection.find(*args, **kwargs)
+        If readonly is True, read only views (see :class:`AttrView`) of the
+        documents are returned instead of :class:`Model` instances, which are
+        much cheaper to create when the objects are never modified.
 
+        The read concern can be specified per call, e.g. {'level':
+        'majority'}, overriding config['read_concern'].
+        """
+
+        self._record_query(*args, **kwargs)
         query = args[0] if len(args) != 0 else {}
+        objects = self._find(query, *args[1:], read_concern=read_concern,
+                             **kwargs)
+
         if objects is not None:
             self._logger.info("Query %s succeeded.", query)
+            projection = args[1] if len(args) > 1 else kwargs.get(
+                'projection')
             for obj in objects:
-                yield self(obj)
+                yield (AttrView(obj) if readonly else
+                       self._hydrate(obj, projection))
             objects.close()  # Ensure cursor is closed
         else:
             self._logger.info("Query %s failed.", query)
             return None
 
     @classmethod
-    def find(self, *args, **kwargs):
-        """Find one from MongoDB.
+    def find_compact(self, *args, **kwargs):
+        """Load many from MongoDB as compact objects (see :class:`Embedded`).
+
+        Requires config['fields'], and the projection defaults to the declared
+        fields. Compact objects can be converted back for writes using
+        `Model(obj.to_dict())`.
+
+        Yields:
+            Embedded: compact objects
+        """
+
+        if not self.config['fields']:
+            raise AttributeError(
+                "{} has no declared config['fields']".format(self.__name__))
+
+        if len(args) < 2 and 'projection' not in kwargs:
+            kwargs['projection'] = list(self.Compact.fields)
+
+        self._record_query(*args, **kwargs)
+        query = args[0] if len(args) != 0 else {}
+        objects = self._find(query, *args[1:], **kwargs)
+
+        self._logger.info("Query %s succeeded.", query)
+        from_dict = self.Compact.from_dict
+        for obj in objects:
+            yield from_dict(obj)
+        objects.close()  # Ensure cursor is closed
+
+    @classmethod
+    def find_columns(self, query=None, fields=(), dtypes=None,
+                     batch_size=1000, **kwargs):
+        """Load many from MongoDB as columns (:mod:`numpy` arrays).
+
+        Documents are read from the cursor in batches and values are written
+        directly into preallocated arrays (doubling in size as required),
+        without ever creating :class:`Model` instances. Missing values (or
+        None) are masked. Unless a dtype is specified, it is inferred from the
+        first value, and the column falls back to a float (for mixed int and
+        float) or object array (for mixed types) as required.
+
+        Args:
+            query (dict): query
+            fields (list): fields to extract (possibly dotted)
+            dtypes (dict): :class:`numpy.dtype` for each field (optional)
+            batch_size (int): number of objects per batch returned by MongoDB
+            **kwargs: passed to :meth:`pymongo.collection.Collection.find`
+
+        Returns:
+            dict: :class:`numpy.ma.MaskedArray` for each field
+
+        Example::
+
+            columns = Model.find_columns({'a': 0}, ['b', 'c.d'],
+                                         {'b': 'float64'})
         """
 
-        obj = self.collection.find_one(*args, **kwargs)
+        if numpy is None:
+            raise ImportError('numpy is required for find_columns')
+
+        dtypes = dtypes or {}
+        paths = [field.split('.') for field in fields]
+        projection = {field: 1 for field in fields}
+        if '_id' not in projection:
+            projection['_id'] = 0
+
+        self._record_query(query, projection, **kwargs)
+        objects = self._find(query or {}, projection, batch_size=batch_size,
+                             **kwargs)
+
+        size = batch_size
+        columns = {field: None for field in fields}
+        masks = {field: numpy.ones(size, dtype=bool) for field in fields}
+        kinds = {}  # Python type inferred for each column (unless specified)
+
+        n = 0
+        for obj in objects:
+            if n == size:  # Grow columns (amortized doubling)
+                size *= 2
+                for field in fields:
+                    mask = numpy.ones(size, dtype=bool)
+                    mask[:n] = masks[field][:n]
+                    masks[field] = mask
+                    if columns[field] is not None:
+                        column = numpy.empty(size, columns[field].dtype)
+                        column[:n] = columns[field][:n]
+                        columns[field] = column
+
+            for field, path in zip(fields, paths):
+                value = obj
+                try:
+                    for key in path:
+                        value = value[key]
+                except (KeyError, TypeError, IndexError):
+                    continue
+                if value is None:
+                    continue
+
+                column = columns[field]
+                if column is None:
+                    if field in dtypes:
+                        dtype = dtypes[field]
+                    else:
+                        kinds[field] = type(value)
+                        dtype = _numpy_dtypes.get(kinds[field], object)
+                    column = columns[field] = numpy.empty(size, dtype)
+                elif field in kinds and type(value) is not kinds[field]:
+                    # Mixed types (promote int to float, otherwise object),
+                    # copied only when the kind is widened
+                    kind = (float if {kinds[field], type(value)} == {
+                        int, float} else object)
+                    if kinds[field] is not object and kind is not kinds[
+                            field]:
+                        kinds[field] = kind
+                        column = columns[field] = column.astype(
+                            _numpy_dtypes.get(kind, object))
+
+                try:
+                    column[n] = value
+                except (TypeError, ValueError, OverflowError):
+                    column = columns[field] = column.astype(object)
+                    column[n] = value
+                    kinds[field] = object
+                masks[field][n] = False
+            n += 1
+        objects.close()  # Ensure cursor is closed
+
+        self._logger.info("Query %s succeeded, %s objects returned.",
+                          query, n)
+        return {
+            field: numpy.ma.MaskedArray(
+                columns[field][:n] if columns[field] is not None else
+                numpy.empty(n, dtypes.get(field, object)),
+                mask=masks[field][:n])
+            for field in fields
+        }
 
+    @classmethod
+    def paginate(self, query=None, sort_key='_id', page_size=100, after=None,
+                 direction=ASCENDING, **kwargs):
+        """Load one page from MongoDB using keyset (seek) pagination.
+
+        Rather than skipping documents, each page continues from the sort
+        position of the last document seen, using range conditions on the
+        sort key (tie-broken by _id). Given an index on the sort key and _id,
+        every page costs an index seek regardless of depth.
+
+        Args:
+            query (dict): query
+            sort_key (str): sort key (possibly dotted), ideally indexed
+            page_size (int): number of objects per page
+            after (str): continuation token returned by the previous page
+                (ValueError is raised if it is malformed)
+            direction (int): sort direction, ASCENDING or DESCENDING
+            **kwargs: passed to :meth:`pymongo.collection.Collection.find`
+
+        Returns:
+            tuple: list of objects and continuation token (None if last page)
+
+        Example::
+
+            objects, token = Model.paginate({'a': 0}, 'b', page_size=50)
+            while token:
+                objects, token = Model.paginate(
+                    {'a': 0}, 'b', page_size=50, after=token)
+        """
+
+        query = query or {}
+        if after is not None:
+            query = get_keyset_query(
+                query, sort_key, decode_token(after), direction)
+
+        sort = [(sort_key, direction)]
+        if sort_key != '_id':
+            sort.append(('_id', direction))
+
+        # The sort key and _id are projected (and removed unless requested)
+        projection = kwargs.pop('projection', None)
+        kwargs['projection'], hidden = get_keyset_projection(
+            projection, sort_key)
+        self._record_query(query, sort=sort, **kwargs)
+
+        # Fetch one extra object to determine if there is another page
+        cursor = self._find(query, sort=sort, limit=page_size + 1, **kwargs)
+        objects = list(cursor)
+        cursor.close()  # Ensure cursor is closed
+
+        token = None
+        if len(objects) > page_size:
+            objects = objects[:page_size]
+            last = objects[-1]
+            value = (getitem_nested(last, sort_key.split('.'))
+                     if hasitem_nested(last, sort_key.split('.')) else None)
+            token = encode_token([value, last['_id']])
+
+        paths = [key.split('.') for key in hidden]
+        for obj in objects:
+            for path in paths:
+                if hasitem_nested(obj, path):
+                    delitem_nested(obj, path)
+        objects = [self._hydrate(obj, projection) for obj in objects]
+
+        self._logger.info("Query %s succeeded, %s objects returned.",
+                          query, len(objects))
+        return objects, token
+
+    @classmethod
+    def find(self, *args, readonly=False, read_concern=None, **kwargs):
+        """Find one from MongoDB.
+
+        If readonly is True, a read only view (see :class:`AttrView`) of the
+        document is returned instead of a :class:`Model` instance.
+
+        The read concern can be specified per call, e.g. {'level':
+        'majority'}, overriding config['read_concern'].
+        """
+
+        self._record_query(*args, **kwargs)
         query = args[0] if len(args) != 0 else {}
+        if self._partitions is None:
+            obj = self._get_collection(read_concern=read_concern).find_one(
+                *args, **kwargs)
+        else:  # Merged from the partitions the query can match (by sort)
+            objects = list(self._find_partitions(
+                query, *args[1:], limit=1, read_concern=read_concern,
+                **kwargs))
+            obj = objects[0] if objects else None
+
         if obj is not None:
             self._logger.debug("%s returned.", obj)
             self._logger.info("Query %s succeeded, {{'_id': ObjectID('%s')}} "
                               "returned.", query, obj['_id'])
-            return self(obj)
+            if readonly:
+                return AttrView(obj)
+            return self._hydrate(
+                obj, args[1] if len(args) > 1 else kwargs.get('projection'))
         else:
             self._logger.info("Query %s failed, object not found.", query)
             return None
 
     @classmethod
-    def count(self, *args, **kwargs):
-        """Count objects in MongoDB.
+    def _check_update(self, update):
+        """Check an update only uses supported operators (see :meth:`update`).
+
+        Raises:
+            UpdateError: if other operators (or none) are used
         """
 
-        return self.collection.count(*args, **kwargs)
+        if not update or not all(key in UPDATE_OPERATORS for key in update):
+            raise UpdateError(
+                update, 'Update only works with {} operators.'.format(
+                    ' and '.join(sorted(UPDATE_OPERATORS))))
 
-    # -------------------------------------------------------------------------
-    # Object functionality
-    # -------------------------------------------------------------------------
+    @classmethod
+    def _check_shard_key(self, update):
+        """Check an update does not change the shard key (if partitioned), as
+        objects are never moved between partitions.
 
-    def save(self):
-        """Save to MongoDB, automatically inserting or updating.
+        Raises:
+            UpdateError: if the shard key (or a key within it) is updated
         """
 
-        if hasattr(self, '_id'):
-            update = get_update(self.find({'_id': self._id}), self)
-            res = self.collection.update_one({'_id': self._id}, update)
-        else:
-            res = self.collection.insert_one(self)
-            self._id = res.inserted_id
-
-        self._logger.info("{{'_id': ObjectID('%s')}} saved.", self._id)
-        return res
+        if self._partitions is None:
+            return
+        key = self.config['partitions']['key']
+        for fields in update.values():
+            for field in fields:
+                if (field == key or key.startswith(field + '.') or
+                        field.startswith(key + '.')):
+                    raise UpdateError(
+                        update, 'Update can not change the shard key {}.'
+                        .format(key))
 
-    def update(self, update):
-        """Update the MongoDB copy to match local copy.
+    @classmethod
+    def _combine_results(self, results, cls):
+        """Combines the results of a write to several collections (partitions).
 
-        Note that this requires the object to be already inserted, and the _id
-        key to be specified.
+        Args:
+            results (list): update or delete results
+            cls (type): UpdateResult or DeleteResult
 
-        The update can be a dictionary of 'update operators' which are applied
-        to the local and the MongoDB copy directly, or a dictionary containing
-        a newer version of the object which is used to replace the local and
-        the MongoDB copy with the minimal update required.
+        Returns:
+            UpdateResult or DeleteResult: result with the counts summed
+            (unacknowledged if any of the writes is)
         """
 
-        operators = {'$set', '$unset', '$push'}
-        if not all(key in operators for key in update.keys()):
-            raise UpdateError(
-                update, 'Update only works with {} operators.'.format(
-                    ' and '.join(operators)))
+        if not all(result.acknowledged for result in results):
+            return cls(None, False)
+        if cls is DeleteResult:
+            return cls({'n': sum(result.deleted_count for result in results)},
+                       True)
+        return cls({'n': sum(result.matched_count for result in results),
+                    'nModified': sum(result.modified_count
+                                     for result in results)}, True)
 
-        if '$set' in update:
-            for key in update['$set']:
-                setitem_nested(self, key.split('.'), update['$set'][key])
+    @classmethod
+    def update_many(self, filter, update, write_concern=None):
+        """Update many objects in MongoDB, using a single server side update.
 
-        if '$unset' in update:
-            for key in update['$unset']:
-                delitem_nested(self, key.split('.'))
+        The update operators are checked as for :meth:`update`, and buffered
+        updates (see config['write_behind']) are flushed first, so are applied
+        in order (spooled writes can not be, see config['spool']).
+
+        Args:
+            filter (dict): query
+            update (dict): update operators
+            write_concern (dict): write concern (see :meth:`insert`)
 
-        if '$push' in update:
-            for key in update['$push']:
-                item = getitem_nested(self, key.split('.'))
-                setitem_nested(
-                    self, key.split('.'), item + [update['$push'][key]])
+        Returns:
+            pymongo.results.UpdateResult: result (the counts summed across
+            the partitions if partitioned, see config['partitions'])
 
-        res = self.collection.update_one({'_id': self._id}, update)
-        self._logger.info("Update %s succeeded {{'_id': ObjectID('%s')}} "
-                          "updated.", update, self._id)
+        Raises:
+            NotImplementedError: if config['spool'] is specified
+        """
+
+        self._check_unspooled('update_many')
+        self._check_update(update)
+        self._check_shard_key(update)
+        if self._get_large_updates(update):
+            raise UpdateError(update, 'Large fields can only be updated by '
+                              'update (one object).')
+        self.flush()
+        update = self._unset_fingerprint(update)
+
+        self._record_query(filter)
+        if self._partitions is None:
+            res = self._get_collection(write_concern).update_many(
+                filter, update)
+        else:
+            res = self._combine_results(self._scatter(
+                lambda collection, partition: collection.update_many(
+                    filter, update),
+                self._get_partitions(filter), write_concern), UpdateResult)
+
+        if res.acknowledged:
+            self._logger.info("Update %s succeeded, %s objects updated.",
+                              update, res.modified_count)
         return res
 
-    def delete(self):
-        """Remove from MongoDB.
+    @classmethod
+    def delete_many(self, filter, write_concern=None):
+        """Remove many objects from MongoDB, using a single server side delete.
 
-        Note that this requires the object to be already inserted, and the _id
-        key to be specified. The local copy will continue to exist but the _id
-        key will be removed.
+        Buffered updates (see config['write_behind']) are flushed first, so
+        are applied in order (spooled writes can not be, see config['spool']).
+
+        Large fields (see config['large_fields']) are deleted too, in which
+        case objects are deleted one at a time (using find one and delete),
+        so only the large fields of the objects actually deleted are deleted,
+        even if objects are updated or deleted concurrently.
+
+        Args:
+            filter (dict): query
+            write_concern (dict): write concern (see :meth:`insert`)
+
+        Returns:
+            pymongo.results.DeleteResult: result (the counts summed across
+            the partitions if partitioned, see config['partitions'])
+
+        Raises:
+            NotImplementedError: if config['spool'] is specified
         """
 
-        res = self.collection.delete_one({'_id': self._id})
-        self._logger.info(
-            "Object {{'_id': ObjectID('%s')}} deleted.", self._id)
-        self.__delattr__('_id')
+        self._check_unspooled('delete_many')
+        self.flush()
+
+        def delete(collection, partition=None):
+            if not self.config['large_fields']:
+                return collection.delete_many(filter)
+            projection = {key: 1 for key in self.config['large_fields']}
+            deleted = 0
+            while True:
+                doc = collection.find_one_and_delete(filter, projection)
+                if doc is None:
+                    return DeleteResult({'n': deleted}, True)
+                self._delete_large([self._get_large_id(doc.get(key))
+                                    for key in self.config['large_fields']])
+                deleted += 1
+
+        self._record_query(filter)
+        if self._partitions is None:
+            res = delete(self._get_collection(write_concern))
+        else:
+            res = self._combine_results(self._scatter(
+                delete, self._get_partitions(filter), write_concern),
+                DeleteResult)
+
+        if res.acknowledged:
+            self._logger.info("Delete %s succeeded, %s objects deleted.",
+                              filter, res.deleted_count)
         return res
 
+    @classmethod
+    def find_one_and_update(self, filter, update, return_new=True, sort=None,
+                            projection=None, upsert=False, write_concern=None):
+        """Update one object in MongoDB atomically, returning it.
+
+        The update operators are checked as for :meth:`update`, so this can be
+        used to claim objects, e.g. {'$set': {'claimed': True}} for the first
+        object matching {'claimed': False}.
+
+        If partitioned (see config['partitions']), the first object matching
+        (by sort) across the partitions is found, then updated in its own
+        partition if it still matches (otherwise the next is found), and an
+        upsert requires the filter to specify the shard key (by equality).
+
+        Args:
+            filter (dict): query
+            update (dict): update operators
+            return_new (bool): return the object after (or before) the update
+            sort (list): sort specification (the first object is updated)
+            projection (dict): projection
+            upsert (bool): insert an object if none match
+            write_concern (dict): write concern (see :meth:`insert`)
+
+        Returns:
+            Model: object (or None if none match)
+
+        Raises:
+            ValueError: if partitioned and upserting without the shard key
+            NotImplementedError: if config['spool'] is specified
+        """
+
+        self._check_unspooled('find_one_and_update')
+        self._check_update(update)
+        self._check_shard_key(update)
+        if self._get_large_updates(update):
+            raise UpdateError(update, 'Large fields can only be updated by '
+                              'update (one object).')
+        self.flush()
+        update = self._unset_fingerprint(update)
+
+        self._record_query(filter, projection, sort=sort)
+        return_document = (ReturnDocument.AFTER if return_new else
+                           ReturnDocument.BEFORE)
+        partitions = ([None] if self._partitions is None else
+                      self._get_partitions(filter))
+        if upsert and self._partitions is not None:
+            key = self.config['partitions']['key']
+            condition = filter.get(key)
+            if key not in filter or isinstance(condition, dict) and any(
+                    k.startswith('$') for k in condition) and list(
+                        condition) != ['$eq']:
+                raise ValueError('upsert requires the shard key {} in the '
+                                 'filter (by equality)'.format(key))
+        if len(partitions) == 1:  # Atomic within the partition
+            obj = self._get_collection(
+                write_concern, partition=partitions[0]).find_one_and_update(
+                    filter, update, projection=projection, sort=sort,
+                    upsert=upsert, return_document=return_document)
+        else:  # First by sort across the partitions, updated in its own
+            keys = [self.config['partitions']['key'], '_id'] + [
+                key for key, direction in get_sort_keys(sort or [])]
+            while True:
+                candidates = list(self._find_partitions(
+                    filter, dict.fromkeys(keys, 1), sort=sort, limit=1))
+                if not candidates:
+                    obj = None
+                    break
+                obj = self._get_collection(
+                    write_concern, candidates[0]).find_one_and_update(
+                        {'$and': [filter, {'_id': candidates[0]['_id']}]},
+                        update, projection=projection,
+                        return_document=return_document)
+                if obj is not None:
+                    break
+                self._logger.debug("Retrying, %s changed concurrently.",
+                                   candidates[0])
+
+        if obj is None:
+            self._logger.info("Query %s failed, object not found.", filter)
+            return None
+        self._logger.info("Update %s succeeded {{'_id': ObjectID('%s')}} "
+                          "updated.", update, obj['_id'])
+        return self._hydrate(obj, projection)
+
+    @classmethod
+    def tail(self, filter=None, await_data=True, interval=1.0, key='_id'):
+        """Follow new objects in a capped collection, using a tailable cursor.
+
+        The generator never finishes (the consumer stops iterating when done),
+        and if the cursor dies (e.g. the collection was empty, a network error
+        occurred, or the cursor was not found), it is re-established from the
+        last key seen. Other errors (e.g. the collection is not capped) are
+        raised, as retrying would not help.
+
+        The key must increase in insertion (natural) order, otherwise objects
+        could be skipped when the cursor is re-established. This holds for
+        ObjectIds generated by a single process (or by the server), but not
+        for ObjectIds generated by several clients, which should use a key
+        such as a sequence number assigned by the single writer.
+
+        Args:
+            filter (dict): query
+            await_data (bool): block on the server waiting for new objects
+                (rather than waiting interval seconds between polls)
+            interval (float): seconds to wait before polling or re-establishing
+                the cursor
+            key (str): key (possibly dotted) increasing in insertion order
+
+        Yields:
+            Model: objects, in insertion order
+
+        Raises:
+            ValueError: if the key of an object is missing or does not increase
+            pymongo.errors.OperationFailure: if the query fails
+        """
+
+        self._check_unpartitioned('tail')
+        cursor_type = (CursorType.TAILABLE_AWAIT if await_data else
+                       CursorType.TAILABLE)
+        path = key.split('.')
+        last = None
+        while True:
+            query = filter or {}
+            if last is not None:
+                query = {'$and': [query, {key: {'$gt': last}}]}
+            cursor = self.collection.find(query, cursor_type=cursor_type)
+            try:
+                while True:
+                    for obj in cursor:
+                        value = (getitem_nested(obj, path)
+                                 if hasitem_nested(obj, path) else None)
+                        if value is None or (
+                                last is not None and not value > last):
+                            raise ValueError(
+                                "Tail key {} is not increasing: {!r} after "
+                                "{!r}".format(key, value, last))
+                        last = value
+                        yield self(obj)
+                    if not cursor.alive:
+                        break
+                    if not await_data:
+                        time.sleep(interval)
+            except (ConnectionFailure, CursorNotFound) as e:
+                self._logger.warning("Tailable cursor error: %s", e)
+            finally:
+                cursor.close()  # Ensure cursor is closed
+            self._logger.debug("Tailable cursor re-established after %s.",
+                               last)
+            time.sleep(interval)
+
+    @classmethod
+    def count(self, query=None, hint=None, limit=None, max_time_ms=None,
+              max_age=None, read_concern=None, **kwargs):
+        """Count objects in MongoDB.
+
+        An empty query is counted using collection metadata (estimated count),
+        while a query is counted using an aggregation, which can be hinted
+        and bounded. Counts can optionally be cached, which is handy for UI
+        counters that can tolerate some staleness.
+
+        Args:
+            query (dict): query (empty for the estimated total)
+            hint (list): index to use (query only), name or list of pairs
+            limit (int): maximum number of objects to count (query only)
+            max_time_ms (int): maximum server time in milliseconds
+            max_age (float): return a cached count up to max_age seconds old
+                (defaults to config['count_max_age'], None disables caching)
+            read_concern (dict): read concern (see :meth:`find`)
+            **kwargs: passed to
+                :meth:`pymongo.collection.Collection.count_documents`
+
+        Returns:
+            int: count
+
+        Raises:
+            ValueError: if hint, limit, or kwargs are specified without a query
+        """
+
+        if not query and (hint is not None or limit is not None or kwargs):
+            raise ValueError('hint, limit, and kwargs require a query')
+
+        max_age = self.config['count_max_age'] if max_age is None else max_age
+        if max_age is not None:
+            # Options (e.g. Collation) are keyed by document, as repr
+            read_concern = getattr(read_concern, 'document', read_concern)
+            key = repr((query or {}, hint, limit, sorted(
+                (k, getattr(v, 'document', v)) for k, v in kwargs.items()),
+                read_concern))
+            cached = self._count_cache.get(key)
+            if cached and time.monotonic() - cached[0] <= max_age:
+                self._count_cache.move_to_end(key)
+                return cached[1]
+
+        self._record_query(query)
+        options = {} if max_time_ms is None else {'maxTimeMS': max_time_ms}
+        if query:
+            if hint is not None:
+                options['hint'] = hint
+            if limit is not None:
+                options['limit'] = limit
+
+        def count_partition(collection, partition=None):
+            if query:
+                return collection.count_documents(query, **options, **kwargs)
+            return collection.estimated_document_count(**options)
+
+        if self._partitions is None:
+            count = count_partition(
+                self._get_collection(read_concern=read_concern))
+        else:  # Summed over the partitions the query can match
+            count = sum(self._scatter(
+                count_partition, self._get_partitions(query),
+                read_concern=read_concern))
+            if limit is not None:
+                count = min(count, limit)
+
+        if max_age is not None:
+            self._count_cache[key] = (time.monotonic(), count)
+            self._count_cache.move_to_end(key)
+            while len(self._count_cache) > COUNT_CACHE_SIZE:
+                self._count_cache.popitem(last=False)
+        return count
+
+    @classmethod
+    def aggregate(self, pipeline, batch_size=None, allow_disk_use=False,
+                  read_concern=None, **kwargs):
+        """Aggregate in MongoDB, streaming results.
+
+        Args:
+            pipeline (list): aggregation pipeline
+            batch_size (int): number of objects per batch returned by MongoDB
+            allow_disk_use (bool): allow stages to write temporary files
+            read_concern (dict): read concern (see :meth:`find`)
+            **kwargs: passed to :meth:`pymongo.collection.Collection.aggregate`
+
+        Yields:
+            Model: objects returned by the final stage of the pipeline
+        """
+
+        self._check_unpartitioned('aggregate')
+        if batch_size is not None:
+            kwargs['batchSize'] = batch_size
+        objects = self._get_collection(read_concern=read_concern).aggregate(
+            pipeline, allowDiskUse=allow_disk_use, **kwargs)
+
+        self._logger.info("Aggregation %s succeeded.", pipeline)
+        for obj in objects:
+            yield self(obj)
+        objects.close()  # Ensure cursor is closed
+
+    @classmethod
+    def pivot(self, query, pivots, types=None, projection=None,
+              allow_disk_use=False):
+        """Pivot objects in MongoDB into a nested dictionary.
+
+        Equivalent to :func:`pivot_list_to_dict` applied to the objects found,
+        except that the objects are sorted by the pivots in MongoDB (which
+        should be indexed), so objects are grouped while streaming and only
+        the projected keys are transferred.
+
+        Args:
+            query (dict): query
+            pivots (list): ordered list of keys (may be dotted) to pivot by
+            types (list): ordered list of types to convert pivots
+            projection (dict): projection applied to each object
+            allow_disk_use (bool): allow stages to write temporary files
+
+        Returns:
+            dict: nested dictionary
+        """
+
+        if not isinstance(pivots, list):
+            pivots = [pivots]
+
+        if not isinstance(types, list):
+            types = [types for pivot in pivots]
+
+        paths = [pivot.split('.') for pivot in pivots]
+
+        def get_keys(obj):
+            return [getitem_nested(obj, path)
+                    if hasitem_nested(obj, path) else None for path in paths]
+
+        pipeline = get_pivot_pipeline(query, pivots, projection)
+        if self._partitions is None:
+            objects = self.collection.aggregate(
+                pipeline, allowDiskUse=allow_disk_use)
+        else:  # Merged from the partitions the query can match (by pivots)
+            objects = self._merge(self._scatter(
+                lambda collection, partition: collection.aggregate(
+                    pipeline, allowDiskUse=allow_disk_use),
+                self._get_partitions(query)), pipeline[1]['$sort'])
+
+        # Groups are collected by converted keys, as different values can be
+        # converted to the same keys (e.g. 1 and '1' by str)
+        groups = {}
+        for keys, group in groupby(objects, key=get_keys):
+            keys = tuple(t(k) if t else k for t, k in zip(types, keys))
+            group = list(group)
+            for obj in group:
+                for path in paths:
+                    if hasitem_nested(obj, path):
+                        delitem_nested(obj, path)
+            groups.setdefault(keys, []).extend(group)
+        objects.close()  # Ensure cursor is closed
+
+        d = {}
+        for keys, group in groups.items():
+            setitem_nested(d, list(keys), group[0] if len(group) == 1 else
+                           group)
+
+        self._logger.info("Pivot %s by %s succeeded.", query, pivots)
+        return d
+
+    @classmethod
+    def sync(self, target, key='updated_at', query=None, batch_size=1000,
+             name=None, reset=False):
+        """Incrementally sync objects changed since the last sync, in batches.
+
+        The high-water mark (the key and _id of the last object synced) is
+        stored in the checkpoints collection after each batch, so only objects
+        changed since (with a greater key, or the same key and a greater _id)
+        are read, using a range query which should be indexed on the key and
+        _id. If interrupted, the sync resumes after the last batch completed,
+        so each object is delivered at least once.
+
+        Note that the key must increase whenever an object changes (e.g. an
+        updated_at time set by every writer, or _id for inserts only).
+
+        Objects upserted to a :class:`Model` are replaced as a whole, with
+        the target fingerprint (see config['fingerprint']), so large fields
+        (see config['large_fields']) can not be synced between models (the
+        references would be copied rather than the values).
+
+        Args:
+            target (object): callable called with each batch (a list of
+                objects), or a :class:`Model` which the objects are upserted to
+            key (str): key (possibly dotted) tracked as the high-water mark
+            query (dict): query (objects not matching are not synced)
+            batch_size (int): number of objects per batch
+            name (str): checkpoint name (defaults to the target collection or
+                qualified function name, required for other callables, e.g.
+                lambdas and bound methods)
+            reset (bool): discard the checkpoint, syncing all objects
+
+        Returns:
+            int: number of objects synced
+
+        Raises:
+            ValueError: if the name is required but not specified, or if
+                either model has large fields when syncing to a model
+        """
+
+        if isinstance(target, MetaModel) and (
+                self.config['large_fields'] or target.config['large_fields']):
+            raise ValueError("config['large_fields'] can not be synced to "
+                             "{}".format(target.__name__))
+        if name is None:
+            if isinstance(target, MetaModel):
+                name = target.collection.name
+            elif isinstance(target, FunctionType) and \
+                    target.__name__ != '<lambda>':
+                name = '{}.{}'.format(target.__module__, target.__qualname__)
+            else:
+                raise ValueError('name must be specified to sync to {!r}'
+                                 .format(target))
+        checkpoint_id = 'sync.{}.{}'.format(self.collection.name, name)
+
+        checkpoint = None
+        if not reset:
+            checkpoint = self._checkpoints.find_one({'_id': checkpoint_id})
+        if checkpoint is not None and checkpoint['key'] != key:
+            self._logger.warning("Sync key changed from %s to %s, resetting.",
+                                 checkpoint['key'], key)
+            checkpoint = None
+
+        query = query or {}
+        if checkpoint is not None:
+            query = get_keyset_query(query, key, checkpoint['values'])
+        sort = [(key, ASCENDING)]
+        if key != '_id':
+            sort.append(('_id', ASCENDING))
+
+        def deliver(batch):
+            if isinstance(target, MetaModel):  # Grouped by target partition
+                groups = {}
+                for obj in batch:
+                    partition = (None if target._partitions is None else
+                                 target._get_partition(obj))
+                    groups.setdefault(partition, []).append(ReplaceOne(
+                        {'_id': obj['_id']}, target._put_fingerprint(obj),
+                        upsert=True))
+                for partition, requests in groups.items():
+                    target._get_collection(partition=partition).bulk_write(
+                        requests, ordered=True)
+            else:
+                target(batch)
+            last = batch[-1]
+            value = (getitem_nested(last, key.split('.'))
+                     if hasitem_nested(last, key.split('.')) else None)
+            self._checkpoints.update_one(
+                {'_id': checkpoint_id},
+                {'$set': {'key': key, 'values': [value, last['_id']]}},
+                upsert=True)
+
+        count = 0
+        batch = []
+        cursor = self._find(query, sort=sort, batch_size=batch_size)
+        for obj in cursor:
+            batch.append(self(obj))
+            if len(batch) >= batch_size:
+                deliver(batch)
+                count += len(batch)
+                batch = []
+        cursor.close()  # Ensure cursor is closed
+        if batch:
+            deliver(batch)
+            count += len(batch)
+
+        self._logger.info("%s objects synced to %s.", count, name)
+        return count
+
+    @classmethod
+    def export(self, path, query=None, format='bson', batch_size=1000):
+        """Export objects from MongoDB to a file, streaming in batches.
+
+        For BSON, raw batches are written to the file as returned by MongoDB
+        (never decoded), otherwise objects are written as one (extended) JSON
+        document per line. :class:`Model` instances are never created.
+
+        Args:
+            path (str): file path
+            query (dict): query
+            format (str): file format, 'bson' or 'jsonl'
+            batch_size (int): number of objects per batch returned by MongoDB
+
+        Returns:
+            int: number of objects exported
+        """
+
+        count = 0
+        if format == 'bson':
+            partitions = ([None] if self._partitions is None else
+                          self._get_partitions(query))
+            with open(path, 'wb') as f:
+                for partition in partitions:
+                    batches = self._get_collection(
+                        partition=partition).find_raw_batches(
+                            query or {}, batch_size=batch_size)
+                    for batch in batches:
+                        f.write(batch)
+                        count += sum(1 for offset in get_bson_offsets(batch))
+        elif format == 'jsonl':
+            objects = self._find(query or {}, batch_size=batch_size)
+            with open(path, 'w') as f:
+                for obj in objects:
+                    f.write(json_util.dumps(obj) + '\n')
+                    count += 1
+            objects.close()  # Ensure cursor is closed
+        else:
+            raise ValueError("format must be 'bson' or 'jsonl'")
+
+        self._logger.info("%s objects exported to %s.", count, path)
+        return count
+
+    @classmethod
+    def import_(self, path, format=None, batch_size=1000):
+        """Import objects into MongoDB from a file (see :meth:`export`).
+
+        BSON files are memory mapped and split into documents using their
+        length prefix, and inserted as raw documents (never decoded), while
+        JSON lines files are decoded line by line. Documents are inserted
+        using unordered bulk writes in batches.
+
+        Args:
+            path (str): file path
+            format (str): file format, 'bson' or 'jsonl' (default from the
+                file extension)
+            batch_size (int): number of objects per bulk write
+
+        Returns:
+            int: number of objects imported
+        """
+
+        format = format or ('jsonl' if path.endswith('.jsonl') else 'bson')
+
+        def insert(batch):
+            if batch and self._partitions is None:
+                self.collection.insert_many(batch, ordered=False)
+            elif batch:  # Grouped by partition
+                groups = {}
+                for doc in batch:
+                    groups.setdefault(self._get_partition(doc), []).append(doc)
+                for partition, docs in groups.items():
+                    self._get_collection(partition=partition).insert_many(
+                        docs, ordered=False)
+            return len(batch)
+
+        count = 0
+        batch = []
+        if format == 'bson':
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return 0
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    documents = split_bson(m)
+                    try:  # Copied as bytes (views are released by mmap)
+                        for raw in documents:
+                            batch.append(RawBSONDocument(bytes(raw)))
+                            if len(batch) >= batch_size:
+                                count += insert(batch)
+                                batch = []
+                    finally:
+                        documents.close()
+        elif format == 'jsonl':
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        batch.append(json_util.loads(line))
+                    if len(batch) >= batch_size:
+                        count += insert(batch)
+                        batch = []
+        else:
+            raise ValueError("format must be 'bson' or 'jsonl'")
+        count += insert(batch)
+
+        self._logger.info("%s objects imported from %s.", count, path)
+        return count
+
+    # -------------------------------------------------------------------------
+    # Bucket functionality
+    # -------------------------------------------------------------------------
+
+    @classmethod
+    def _get_bucket_upsert(self, event):
+        """Compiles an event append into a bucket query and update.
+        """
+
+        options = self.config['buckets']
+        if options is None:
+            raise ValueError("config['buckets'] must be specified")
+
+        event = dict(event)
+        series = event.pop(options['series'])
+        event[options['time']] = get_naive_utc(event[options['time']])
+        start = get_bucket_start(event[options['time']], options['window'])
+        query = {options['series']: series, 'start': start,
+                 'n': {'$lt': options['size']}}
+        update = get_bucket_update(event, options['time'], options['stats'])
+        return query, update
+
+    @classmethod
+    def append(self, event, write_concern=None):
+        """Append an event to its bucket, using a single upsert.
+
+        Events are grouped into bucket documents by series and time window
+        (see config['buckets']), rather than inserted one document each. The
+        event is pushed to the bucket events, and the bucket count, minimum,
+        and maximum (of the time and stats keys) are updated. If the bucket is
+        full (see config['buckets']['size']), the upsert creates another
+        bucket for the same series and time window.
+
+        Args:
+            event (dict): event, including the series and time keys
+            write_concern (dict): write concern (see :meth:`insert`)
+        """
+
+        self._check_unpartitioned('append')
+        query, update = self._get_bucket_upsert(event)
+        collection = self._get_collection(write_concern)
+        collection.update_one(query, update, upsert=True)
+        self._logger.debug("%s appended.", event)
+
+    @classmethod
+    def append_many(self, events, write_concern=None):
+        """Append many events to their buckets, using an ordered bulk write.
+
+        Args:
+            events (list): events, including the series and time keys
+            write_concern (dict): write concern (see :meth:`insert`)
+
+        Returns:
+            int: number of events appended
+        """
+
+        self._check_unpartitioned('append_many')
+        requests = [UpdateOne(*self._get_bucket_upsert(event), upsert=True)
+                    for event in events]
+        if requests:
+            collection = self._get_collection(write_concern)
+            collection.bulk_write(requests, ordered=True)
+
+        self._logger.info("%s events appended.", len(requests))
+        return len(requests)
+
+    @classmethod
+    def find_events(self, series, start=None, end=None):
+        """Load events for a series and time range, unrolling buckets.
+
+        Only buckets overlapping the time range are loaded, and the events are
+        returned sorted by time.
+
+        Args:
+            series (object): series
+            start (datetime.datetime): start time (inclusive, optional, naive
+                times are taken as UTC)
+            end (datetime.datetime): end time (exclusive, optional)
+
+        Yields:
+            AttrDictionary: events
+        """
+
+        options = self.config['buckets']
+        if options is None:
+            raise ValueError("config['buckets'] must be specified")
+        self._check_unpartitioned('find_events')
+        key, time_key = options['series'], options['time']
+        if start is not None:
+            start = get_naive_utc(start)
+        if end is not None:
+            end = get_naive_utc(end)
+
+        query = {key: series}
+        if start is not None:
+            query['start'] = {'$gte': get_bucket_start(
+                start, options['window'])}
+        if end is not None:
+            query.setdefault('start', {})['$lt'] = end
+        buckets = self.collection.find(
+            query, sort=[('start', ASCENDING)], projection={'events': 1,
+                                                            'start': 1})
+
+        # Buckets for the same window (full buckets) are sorted together
+        def unroll(events):
+            for event in sorted(events, key=lambda event: event[time_key]):
+                if ((start is None or event[time_key] >= start) and
+                        (end is None or event[time_key] < end)):
+                    event[key] = series
+                    yield AttrDictionary(event)
+
+        window, events = None, []
+        for bucket in buckets:
+            if bucket['start'] != window:
+                yield from unroll(events)
+                window, events = bucket['start'], []
+            events.extend(bucket['events'])
+        yield from unroll(events)
+        buckets.close()  # Ensure cursor is closed
+
+        self._logger.info("Events for %s from %s to %s loaded.", series,
+                          start, end)
+
+    # -------------------------------------------------------------------------
+    # Partition functionality
+    # -------------------------------------------------------------------------
+
+    @classmethod
+    def _get_partition(self, obj):
+        """Partition of an object, by hash (stable) or range of the shard key.
+
+        The shard key value is canonicalized first (see
+        :func:`minimongo.auxiliary.get_shard_value`), so values MongoDB
+        considers equal (e.g. 1 and 1.0) are routed to the same partition.
+
+        Args:
+            obj (dict): object (including the shard key), possibly raw BSON
+
+        Returns:
+            int: partition
+        """
+
+        options = self.config['partitions']
+        value = obj
+        for key in options['key'].split('.'):
+            value = value[key]
+        value = get_shard_value(value)
+        if options['method'] == 'range':
+            return bisect_right(options['bounds'], value)
+        digest = hashlib.md5(bson.encode({'value': value})).digest()
+        return int.from_bytes(digest[:8], 'little') % len(self._partitions)
+
+    @classmethod
+    def _get_partitions(self, query):
+        """Partitions a query can match (only one for shard key equality).
+
+        Args:
+            query (dict): query
+
+        Returns:
+            list: partitions
+        """
+
+        key = self.config['partitions']['key']
+        condition = (query or {}).get(key)
+        if key not in (query or {}):
+            values = None
+        elif isinstance(condition, dict) and any(
+                k.startswith('$') for k in condition):
+            if list(condition) == ['$eq']:
+                values = [condition['$eq']]
+            elif list(condition) == ['$in']:
+                values = condition['$in']
+            else:
+                values = None
+        else:
+            values = [condition]
+
+        if values is None:
+            return list(range(len(self._partitions)))
+        partitions = set()
+        for value in values:
+            obj = {}
+            setitem_nested(obj, key.split('.'), value)
+            partitions.add(self._get_partition(obj))
+        return sorted(partitions)
+
+    @classmethod
+    def _scatter(self, function, partitions, write_concern=None,
+                 read_concern=None):
+        """Call a function for partitions in parallel, gathering the results.
+
+        Args:
+            function (callable): called with the collection and partition
+            partitions (list): partitions
+            write_concern (dict): write concern (see :meth:`insert`)
+            read_concern (dict): read concern (see :meth:`find`)
+
+        Returns:
+            list: results (in the order of the partitions)
+        """
+
+        def call(partition):
+            return function(self._get_collection(
+                write_concern, partition=partition,
+                read_concern=read_concern), partition)
+
+        if len(partitions) == 1:
+            return [call(partitions[0])]
+        return list(self._executor.map(call, partitions))
+
+    @classmethod
+    def _find_partitions(self, query, *args, skip=0, limit=0, sort=None,
+                         read_concern=None, **kwargs):
+        """Find in the partitions a query can match (in parallel).
+
+        Each partition is sorted and limited (to skip plus limit) by MongoDB,
+        and the cursors are merged (see :meth:`_merge`), so only as many
+        documents as required are read from each partition. As cursors are
+        lazy, the first batch of each is fetched by the workers, so the
+        partitions are read in parallel (later batches are fetched as the
+        documents are merged).
+
+        Yields:
+            dict: documents
+        """
+
+        if limit:
+            kwargs['limit'] = skip + limit
+
+        def find(collection, partition):
+            cursor = collection.find(query, *args, sort=sort, **kwargs)
+            return cursor, list(islice(cursor, 1))  # First batch fetched
+
+        results = self._scatter(find, self._get_partitions(query),
+                                read_concern=read_concern)
+        return self._merge([cursor for cursor, head in results], sort, skip,
+                           limit, [head for cursor, head in results])
+
+    @classmethod
+    def _merge(self, cursors, sort=None, skip=0, limit=0, heads=None):
+        """Merge cursors (each sorted by sort, if specified), skipping and
+        limiting the documents merged, and closing the cursors when done.
+
+        Args:
+            cursors (list): cursors
+            sort (list): sort specification (each cursor is sorted by)
+            skip (int): number of documents merged to skip
+            limit (int): maximum number of documents (0 for no limit)
+            heads (list): documents already read from each cursor (optional)
+
+        Yields:
+            dict: documents
+        """
+
+        iterables = cursors if heads is None else [
+            chain(head, cursor) for head, cursor in zip(heads, cursors)]
+        try:
+            objects = (heapq.merge(*iterables, key=sort_key(sort)) if sort
+                       else chain.from_iterable(iterables))
+            yield from islice(objects, skip, skip + limit if limit else None)
+        finally:
+            for cursor in cursors:
+                cursor.close()  # Ensure cursors are closed
+
+    @classmethod
+    def _find(self, query, *args, read_concern=None, **kwargs):
+        """Cursor over the collection (or merged over the partitions the
+        query can match), see :meth:`pymongo.collection.Collection.find`.
+        """
+
+        if self._partitions is None:
+            return self._get_collection(read_concern=read_concern).find(
+                query, *args, **kwargs)
+        return self._find_partitions(
+            query, *args, read_concern=read_concern, **kwargs)
+
+    @classmethod
+    def _get_collections(self):
+        """Collections storing the objects (the partitions if partitioned).
+        """
+
+        return self._partitions or [self.collection]
+
+    @classmethod
+    def _check_unpartitioned(self, method):
+        """Check the model is not partitioned (see config['partitions']).
+
+        Raises:
+            NotImplementedError: if the method does not support partitions
+        """
+
+        if self._partitions is not None:
+            raise NotImplementedError(
+                "{}.{} is not supported with config['partitions']".format(
+                    self.__name__, method))
+
+    # -------------------------------------------------------------------------
+    # Index functionality
+    # -------------------------------------------------------------------------
+
+    @classmethod
+    def _record_query(self, query=None, projection=None, *args, sort=None,
+                      **kwargs):
+        """Record the query shape (if config['record_queries'] is enabled).
+        """
+
+        if self.config['record_queries']:
+            self._query_shapes[get_query_shape(query, sort, projection)] += 1
+
+    @classmethod
+    def query_shapes(self):
+        """Query shapes recorded, with counts (most common first).
+
+        Returns:
+            list: list of (shape, count) pairs, see :func:`get_query_shape`
+        """
+
+        return self._query_shapes.most_common()
+
+    @classmethod
+    def recommend_indexes(self, min_count=1):
+        """Recommend indexes for the query shapes recorded.
+
+        Recommendations already covered by an existing (in every partition,
+        if partitioned) or declared index (as a prefix), or by another
+        recommendation, are omitted.
+
+        Args:
+            min_count (int): minimum number of queries for a shape
+
+        Returns:
+            list: list of :class:`pymongo.operations.IndexModel`
+        """
+
+        collections = self._get_collections()
+        existing = [index['key'] for index in
+                    collections[0].index_information().values()]
+        for collection in collections[1:]:
+            keys = [index['key'] for index in
+                    collection.index_information().values()]
+            existing = [key for key in existing if key in keys]
+        existing += [list(index.document['key'].items())
+                     for index in self.config['indexes']]
+
+        recommended = []
+        for shape, count in self.query_shapes():
+            keys = get_index_keys(shape)
+            if count >= min_count and keys and keys not in recommended:
+                recommended.append(keys)
+
+        def covered(keys, indexes):
+            return any(list(index[:len(keys)]) == keys
+                       for index in indexes if index is not keys)
+
+        return [IndexModel(keys) for keys in recommended
+                if not covered(keys, existing + recommended)]
+
+    @classmethod
+    def unused_indexes(self):
+        """Declared indexes that have not been used since the server restarted.
+
+        Relies on the $indexStats aggregation stage, and note that usage is
+        only counted per server. Indexes which are not declared (see
+        config['indexes']), e.g. created by other applications, are excluded.
+        If partitioned, indexes are unused if unused in every partition.
+
+        Returns:
+            list: index names
+        """
+
+        declared = {index.document['name'] for index in self.config['indexes']}
+        ops = Counter()
+        for collection in self._get_collections():
+            for stat in collection.aggregate([{'$indexStats': {}}]):
+                ops[stat['name']] += stat['accesses']['ops']
+        return sorted(name for name, count in ops.items()
+                      if name in declared and count == 0)
+
+    @classmethod
+    def diff_indexes(self):
+        """Computes the difference between declared and existing indexes.
+
+        Indexes are matched by name, and compared by key specification and
+        options (e.g. unique), ignoring options set by the server. If
+        partitioned, the differences in any partition are combined.
+
+        Returns:
+            dict: difference summary, with created (declared but missing),
+                changed (declared but existing with other keys or options),
+                and deleted (existing but not declared) indexes
+        """
+
+        return self._combine_index_diffs([
+            self._diff_indexes(collection)
+            for collection in self._get_collections()])
+
+    @classmethod
+    def _diff_indexes(self, collection):
+        """Computes the difference between declared and existing indexes of a
+        collection (see :meth:`diff_indexes`).
+        """
+
+        declared = {index.document['name']: index
+                    for index in self.config['indexes']}
+        existing = {name: info for name, info in
+                    collection.index_information().items()
+                    if name != '_id_'}
+
+        summary = {}
+        created = [index for name, index in declared.items()
+                   if name not in existing]
+        changed = [index for name, index in declared.items()
+                   if name in existing and
+                   not self._match_index(index.document, existing[name])]
+        deleted = sorted(set(existing) - set(declared))
+        if created:
+            summary['created'] = created
+        if changed:
+            summary['changed'] = changed
+        if deleted:
+            summary['deleted'] = deleted
+        return summary
+
+    @classmethod
+    def _combine_index_diffs(self, summaries):
+        """Combines the index differences of several collections (partitions).
+        """
+
+        summary = {}
+        for key in ('created', 'changed'):
+            names = {index.document['name'] for diff in summaries
+                     for index in diff.get(key, [])}
+            indexes = [index for index in self.config['indexes']
+                       if index.document['name'] in names]
+            if indexes:
+                summary[key] = indexes
+        deleted = sorted({name for diff in summaries
+                          for name in diff.get('deleted', [])})
+        if deleted:
+            summary['deleted'] = deleted
+        return summary
+
+    @classmethod
+    def _match_index(self, document, info):
+        """Check if an existing index (information) matches its declaration.
+        """
+
+        keys = list(document['key'].items())
+        if TEXT not in dict(keys).values():  # Text keys are stored as _fts
+            if keys != [tuple(key) for key in info['key']]:
+                return False
+
+        ignored = {'key', 'name', 'v', 'ns'} | SERVER_INDEX_OPTIONS
+        options = {k: v for k, v in document.items() if k not in ignored}
+        existing = {k: v for k, v in info.items() if k not in ignored}
+        return options == existing
+
+    @classmethod
+    def sync_indexes(self, drop=False):
+        """Sync existing indexes with config['indexes'].
+
+        Creates declared indexes which are missing, recreates declared indexes
+        which have changed, and (optionally) drops stale indexes which are no
+        longer declared, as every unused index is maintained on each write.
+        Note that indexes which are not declared may have been created by
+        operators or other applications, so are only dropped if specified.
+
+        Args:
+            drop (bool): drop indexes which are not declared
+
+        Returns:
+            dict: difference summary applied, see :meth:`diff_indexes`
+        """
+
+        summaries = []
+        for collection in self._get_collections():  # Each partition
+            summary = self._diff_indexes(collection)
+            for index in summary.get('changed', []):
+                collection.drop_index(index.document['name'])
+                self._logger.info("Index %s changed.", index.document['name'])
+            indexes = summary.get('created', []) + summary.get('changed', [])
+            if indexes:
+                collection.create_indexes(indexes)
+            if drop:
+                for name in summary.get('deleted', []):
+                    collection.drop_index(name)
+                    self._logger.info("Index %s dropped.", name)
+            summaries.append(summary)
+
+        summary = self._combine_index_diffs(summaries)
+        if not drop:
+            summary.pop('deleted', None)
+
+        self._logger.info("Indexes synced %s.", summary)
+        return summary
+
+    # -------------------------------------------------------------------------
+    # Object functionality
+    # -------------------------------------------------------------------------
+
+    @classmethod
+    def mirror(self, start=True, **kwargs):
+        """In-memory mirror of the collection, kept fresh by a change stream.
+
+        Args:
+            start (bool): load the mirror and start following changes
+            **kwargs: passed to :class:`Mirror`, e.g. checkpoint_size
+
+        Returns:
+            Mirror: mirror
+        """
+
+        self._check_unpartitioned('mirror')
+        mirror = Mirror(self, **kwargs)
+        if start:
+            mirror.start()
+        return mirror
+
+    @classmethod
+    def _get_collection(self, write_concern=None, obj=None, partition=None,
+                        read_concern=None):
+        """Collection with the write and read concern specified (or default).
+
+        Args:
+            write_concern (dict): WriteConcern options (or a WriteConcern),
+                e.g. {'w': 0} for unacknowledged writes
+            obj (dict): object routed to its partition (if partitioned)
+            partition (int): partition (if partitioned)
+            read_concern (dict): ReadConcern options (or a ReadConcern), e.g.
+                {'level': 'majority'}
+
+        Returns:
+            pymongo.collection.Collection: collection
+        """
+
+        collection = self.collection
+        if self._partitions is not None:
+            if partition is None and obj is not None:
+                partition = self._get_partition(obj)
+            if partition is not None:
+                collection = self._partitions[partition]
+
+        options = {}
+        if write_concern is not None:
+            if isinstance(write_concern, dict):
+                write_concern = WriteConcern(**write_concern)
+            options['write_concern'] = write_concern
+        if read_concern is not None:
+            if isinstance(read_concern, dict):
+                read_concern = ReadConcern(**read_concern)
+            options['read_concern'] = read_concern
+        if not options:
+            return collection
+        return collection.with_options(**options)
+
+    @classmethod
+    def _check_deferred(self, write_concern):
+        """Check no write concern is specified for a spooled or buffered write.
+
+        Raises:
+            ValueError: if a write concern is specified (as the write is
+                deferred, it can not be acknowledged as requested)
+        """
+
+        if write_concern is not None:
+            raise ValueError('write_concern can not be specified for writes '
+                             'spooled or buffered (see config)')
+
+    @classmethod
+    def _check_unspooled(self, method):
+        """Check writes are not spooled (see config['spool']), as server side
+        writes would be applied before writes spooled earlier (and overwritten
+        when these are replayed).
+
+        Raises:
+            NotImplementedError: if config['spool'] is specified
+        """
+
+        if self._spool is not None:
+            raise NotImplementedError(
+                "{}.{} is not supported with config['spool']".format(
+                    self.__name__, method))
+
+    def _get_filter(self):
+        """Filter matching the object by _id (and shard key if partitioned).
+        """
+
+        query = {'_id': self._id}
+        if self._partitions is not None:
+            key = self.config['partitions']['key']
+            query[key] = getitem_nested(self, key.split('.'))
+        return query
+
+    @classmethod
+    def replay(self, batch_size=1000):
+        """Replay spooled writes (if config['spool'] is specified).
+
+        Args:
+            batch_size (int): number of writes per ordered bulk write
+
+        Returns:
+            int: number of writes replayed
+        """
+
+        if self._spool is not None:
+            return self._spool.replay(self.collection, batch_size)
+        return 0
+
+    @classmethod
+    def flush(self):
+        """Flush buffered updates (if config['write_behind'] is specified).
+
+        Returns:
+            pymongo.results.BulkWriteResult: result (None if nothing to flush)
+        """
+
+        if self._write_buffer is not None:
+            return self._write_buffer.flush()
+
+    def _get_projection(self):
+        """Projection the object was loaded with (None if not partial).
+
+        Stored as an instance attribute (not a property or item), so it does
+        not hide an item named projection from attribute access.
+        """
+
+        return self.__dict__.get('_projection')
+
+    @classmethod
+    def _hydrate(self, obj, projection=None):
+        """Create object, remembering the projection if partial.
+        """
+
+        obj = self(obj)
+        if projection is not None:
+            object.__setattr__(obj, '_projection', projection)
+        return obj
+
+    @classmethod
+    def _get_large_id(self, value):
+        """Large field file id if the value is a reference (or None).
+        """
+
+        if isinstance(value, dict) and list(value) == ['_large']:
+            return value['_large']
+        return None
+
+    @classmethod
+    def _get_large_hash(self, value):
+        """Hash of a large field value (to avoid storing unchanged values).
+        """
+
+        return hashlib.sha1(bson.encode({'value': value})).digest()
+
+    @classmethod
+    def _get_large(self, file_id):
+        """Load a large field value, reading the chunks in order.
+        """
+
+        with LargeReader(self._chunks, file_id) as reader:
+            data = reader.read()
+            raw = reader.raw
+        self._logger.debug("Large field %s loaded.", file_id)
+        return data if raw else bson.decode(data)['value']
+
+    @classmethod
+    def _put_large(self, value):
+        """Store a large field value in chunks, returning the file id.
+
+        Bytes are stored as is (raw, so can be streamed), and other values
+        are stored as BSON.
+        """
+
+        raw = isinstance(value, bytes)
+        data = value if raw else bson.encode({'value': value})
+        file_id = ObjectId()
+        chunks = [
+            {'file': file_id, 'n': n, 'data': data[i:i + LARGE_CHUNK_SIZE]}
+            for n, i in enumerate(range(0, max(len(data), 1),
+                                        LARGE_CHUNK_SIZE))]
+        chunks[0]['raw'] = raw
+        self._chunks.insert_many(chunks)
+        self._logger.debug("Large field %s stored.", file_id)
+        return file_id
+
+    def open_large(self, key):
+        """Open a large field value (bytes) for streaming, chunk by chunk.
+
+        Args:
+            key (str): large field key
+
+        Returns:
+            io.BufferedReader: reader (see :class:`LargeReader`)
+
+        Raises:
+            ValueError: if the value is not stored bytes
+        """
+
+        value = self.get(key)
+        file_id = self._get_large_id(value)
+        if file_id is None:
+            cached = self._get_large_cache().get(key)
+            if cached is None or not isinstance(value, bytes) or \
+                    cached[1] != self._get_large_hash(value):
+                raise ValueError('{} is not a stored large field'.format(key))
+            file_id = cached[0]
+        reader = LargeReader(self._chunks, file_id)
+        if not reader.raw:
+            reader.close()
+            raise ValueError('{} is not bytes, so can not be streamed'.format(
+                key))
+        return io.BufferedReader(reader, LARGE_CHUNK_SIZE)
+
+    @classmethod
+    def _put_large_fields(self, obj, cache):
+        """Store large fields, returning a copy of the object with references.
+
+        Values loaded (or stored) previously are only stored again if changed,
+        using the cache of file ids and value hashes, which is updated.
+        """
+
+        if not self.config['large_fields']:
+            return obj
+
+        doc = dict(obj)
+        for key in self.config['large_fields']:
+            if key not in doc or self._get_large_id(doc[key]) is not None:
+                continue
+            value_hash = self._get_large_hash(doc[key])
+            if key in cache and cache[key][1] == value_hash:
+                file_id = cache[key][0]
+            else:
+                file_id = self._put_large(doc[key])
+            cache[key] = (file_id, value_hash)
+            doc[key] = {'_large': file_id}
+        return doc
+
+    @classmethod
+    def _delete_large(self, file_ids):
+        """Delete large field values.
+        """
+
+        file_ids = [file_id for file_id in file_ids if file_id is not None]
+        if file_ids:
+            self._chunks.delete_many({'file': {'$in': file_ids}})
+
+    @classmethod
+    def _delete_large_unsaved(self, docs, caches):
+        """Delete large fields stored for documents not inserted (on errors).
+
+        Chunks still referenced by a stored document (i.e. inserted before
+        the error) are kept.
+
+        Args:
+            docs (list): documents (with an _id if inserted)
+            caches (list): large field caches (see :meth:`_put_large_fields`)
+        """
+
+        keys = self.config['large_fields']
+        if not keys:
+            return
+        try:
+            ids = [doc['_id'] for doc in docs if '_id' in doc]
+            objects = self.find_many(
+                {'_id': {'$in': ids}}, {key: 1 for key in keys}) if ids else []
+            referenced = {self._get_large_id(obj.get(key))
+                          for obj in objects for key in keys}
+            self._delete_large([
+                file_id for cache in caches
+                for file_id, value_hash in cache.values()
+                if file_id not in referenced])
+        except PyMongoError as e:
+            self._logger.exception('Error deleting large fields: %s', e)
+
+    @classmethod
+    def _get_large_updates(self, update):
+        """Large fields set or unset by an update.
+
+        Returns:
+            dict: operator ('$set' or '$unset') for each large field
+
+        Raises:
+            UpdateError: if a large field is updated otherwise (e.g. $inc, or
+                $set of a nested key)
+        """
+
+        updates = {}
+        for op, fields in update.items():
+            for key in fields:
+                if key.split('.')[0] not in self.config['large_fields']:
+                    continue
+                if key not in self.config['large_fields'] or \
+                        op not in ('$set', '$unset'):
+                    raise UpdateError(update, 'Large fields can only be set '
+                                      'or unset as a whole.')
+                updates[key] = op
+        return updates
+
+    def _get_large_cache(self):
+        """Large field file ids and value hashes (see :meth:`_put_large`).
+        """
+
+        if '_large' not in self.__dict__:
+            object.__setattr__(self, '_large', {})
+        return self.__dict__['_large']
+
+    @classmethod
+    def _put_fingerprint(self, doc):
+        """Copy of a document with the fingerprint (if configured).
+        """
+
+        options = self.config['fingerprint']
+        if options is None:
+            return doc
+
+        doc = dict(doc)
+        doc[options['key']] = get_fingerprint(
+            doc, options['exclude'] + [options['key']])
+        return doc
+
+    def _keep_fingerprint(self, doc):
+        """Keep the fingerprint of the document stored (if configured).
+        """
+
+        if self.config['fingerprint'] is not None:
+            key = self.config['fingerprint']['key']
+            self[key] = doc[key]
+
+    @classmethod
+    def _unset_fingerprint(self, update):
+        """Update also unsetting the fingerprint (if configured).
+        """
+
+        if self.config['fingerprint'] is None:
+            return update
+
+        key = self.config['fingerprint']['key']
+        update = {op: {k: v for k, v in fields.items() if k != key}
+                  for op, fields in update.items()}
+        update.setdefault('$unset', {})[key] = ''
+        return {op: fields for op, fields in update.items() if fields}
+
+    def _drop_fingerprint(self, update):
+        """Drop the fingerprint (if configured), which an update makes stale.
+
+        Returns:
+            dict: update, also unsetting the fingerprint
+        """
+
+        if self.config['fingerprint'] is not None:
+            self.pop(self.config['fingerprint']['key'], None)
+        return self._unset_fingerprint(update)
+
+    def save(self, write_concern=None):
+        """Save to MongoDB, automatically inserting or updating.
+
+        If the object is partial (loaded with a projection), only the fields
+        loaded are updated, so fields which were not loaded are not unset.
+
+        If config['fingerprint'] is specified, a fingerprint of the object
+        (see :func:`minimongo.auxiliary.get_fingerprint`) is stored, and if it
+        is unchanged, the object is not saved (and None is returned) without
+        reading MongoDB or computing an update. The fingerprint is unset by
+        partial saves and by :meth:`update`, as it can not be recomputed.
+
+        If config['write_behind'] is specified, updates are buffered (and None
+        is returned), see :class:`WriteBuffer`.
+
+        If config['spool'] is specified, the object is spooled as a complete
+        replacement, or an update setting the fields loaded if partial (and
+        None is returned), so MongoDB is not read.
+
+        The write concern can be specified per call, e.g. {'w': 0} for
+        unacknowledged writes, overriding config['write_concern'].
+        """
+
+        if self._spool is not None:
+            self._check_deferred(write_concern)
+            if '_id' not in self:
+                self._id = ObjectId()
+            if self._get_projection() is not None:  # Partial (fields loaded)
+                update = {'$set': {key: value for key, value in self.items()
+                                   if key != '_id'}}
+                self._spool.update(self._id, self._drop_fingerprint(update))
+            else:
+                self._keep_fingerprint(self._put_fingerprint(self))
+                self._spool.replace(self)
+            self._logger.info("{{'_id': ObjectID('%s')}} spooled.", self._id)
+            return None
+
+        if hasattr(self, '_id'):
+            # Partial objects are compared with the same projection, so the
+            # update is confined to the fields loaded
+            new = self._put_large_fields(self, self._get_large_cache())
+            if self._get_projection() is None:
+                new = self._put_fingerprint(new)
+                key = (self.config['fingerprint'] or {}).get('key')
+                if key is not None and self.get(key) == new[key]:
+                    self._logger.info(
+                        "{{'_id': ObjectID('%s')}} unchanged.", self._id)
+                    return None
+            old = self.find(self._get_filter(), self._get_projection())
+            if old is None and self._partitions is not None and self.find(
+                    {'_id': self._id}, ['_id']) is not None:
+                raise ValueError(
+                    "{{'_id': ObjectID('{}')}} can not be saved as its shard "
+                    "key {} changed".format(
+                        self._id, self.config['partitions']['key']))
+            update = get_update(old, new)
+            if self._get_projection() is None:
+                self._keep_fingerprint(new)
+            elif update:
+                update = self._drop_fingerprint(update)
+            if not update:
+                self._logger.info(
+                    "{{'_id': ObjectID('%s')}} unchanged.", self._id)
+                return None
+            if self._write_buffer is not None:
+                self._check_deferred(write_concern)
+                self._write_buffer.add(self._id, update)
+                return None
+            res = self._get_collection(write_concern, self).update_one(
+                self._get_filter(), update)
+            # Large fields replaced (or removed) are deleted once updated
+            self._delete_large([
+                self._get_large_id(old.get(key))
+                for key in self.config['large_fields'] if key in old and
+                self._get_large_id(old[key]) != self._get_large_id(
+                    new.get(key))])
+        else:
+            cache = self._get_large_cache()
+            doc = self._put_fingerprint(self._put_large_fields(self, cache))
+            try:
+                res = self._get_collection(write_concern, self).insert_one(doc)
+            except Exception:
+                self._delete_large_unsaved([doc], [cache])
+                raise
+            self._id = res.inserted_id
+            self._keep_fingerprint(doc)
+
+        self._logger.info("{{'_id': ObjectID('%s')}} saved.", self._id)
+        return res
+
+    def update(self, update, write_concern=None):
+        """Update the MongoDB copy to match local copy.
+
+        Note that this requires the object to be already inserted, and the _id
+        key to be specified.
+
+        The update can be a dictionary of 'update operators' which are applied
+        to the local and the MongoDB copy directly, or a dictionary containing
+        a newer version of the object which is used to replace the local and
+        the MongoDB copy with the minimal update required.
+
+        If config['write_behind'] is specified, the update is buffered (and
+        None is returned), see :class:`WriteBuffer`. Similarly, if
+        config['spool'] is specified, the update is spooled (so must be
+        idempotent, e.g. $set and $unset, as replay is at least once).
+
+        The write concern can be specified per call, e.g. {'w': 0} for
+        unacknowledged writes, overriding config['write_concern'].
+        """
+
+        self._check_update(update)
+        self._check_shard_key(update)
+
+        # Only plain values or '$each' can be pushed (applied to self below)
+        pushed = {key: get_each(value)
+                  for key, value in update.get('$push', {}).items()}
+        if any(values is None for values in pushed.values()):
+            raise UpdateError(
+                update, "Update only works with $push of values or $each.")
+        if self._spool is not None and not is_idempotent(update):
+            raise UpdateError(
+                update, "Update must be idempotent when spooled.")
+
+        # Large fields set are stored (and those replaced deleted once updated)
+        large = self._get_large_updates(update)
+        cache = self._get_large_cache()
+        replaced = [self._get_large_id(self.get(key)) or
+                    cache.pop(key, (None,))[0] for key in large]
+
+        if '$set' in update:
+            for key in update['$set']:
+                setitem_nested(self, key.split('.'), update['$set'][key])
+
+        if '$unset' in update:
+            for key in update['$unset']:
+                delitem_nested(self, key.split('.'))
+
+        if '$inc' in update:
+            for key in update['$inc']:
+                keys = key.split('.')
+                item = (getitem_nested(self, keys)
+                        if hasitem_nested(self, keys) else 0)
+                setitem_nested(self, keys, item + update['$inc'][key])
+
+        for key, values in pushed.items():
+            keys = key.split('.')
+            item = (getitem_nested(self, keys)
+                    if hasitem_nested(self, keys) else [])
+            setitem_nested(self, keys, item + values)
+
+        update = self._drop_fingerprint(update)
+
+        if self._spool is not None:
+            self._check_deferred(write_concern)
+            self._spool.update(self._id, update)
+            self._logger.debug("Update %s spooled {{'_id': ObjectID('%s')}}.",
+                               update, self._id)
+            return None
+
+        if self._write_buffer is not None:
+            self._check_deferred(write_concern)
+            self._write_buffer.add(self._id, update)
+            self._logger.debug("Update %s buffered {{'_id': ObjectID('%s')}}.",
+                               update, self._id)
+            return None
+
+        if '$set' in large.values():
+            update = dict(update)
+            update['$set'] = dict(update['$set'])
+            for key, op in large.items():
+                if op == '$set':
+                    value = update['$set'][key]
+                    cache[key] = (self._put_large(value),
+                                  self._get_large_hash(value))
+                    update['$set'][key] = {'_large': cache[key][0]}
+
+        self._record_query(self._get_filter())
+        try:
+            res = self._get_collection(write_concern, self).update_one(
+                self._get_filter(), update)
+        except Exception:
+            self._delete_large([cache.pop(key)[0] for key in large
+                                if key in cache])
+            raise
+        self._delete_large(replaced)
+        self._logger.info("Update %s succeeded {{'_id': ObjectID('%s')}} "
+                          "updated.", update, self._id)
+        return res
+
+    def delete(self, write_concern=None):
+        """Remove from MongoDB.
+
+        Note that this requires the object to be already inserted, and the _id
+        key to be specified. The local copy will continue to exist but the _id
+        key will be removed.
+
+        If config['spool'] is specified, the delete is spooled (and None is
+        returned).
+
+        The write concern can be specified per call, e.g. {'w': 0} for
+        unacknowledged writes, overriding config['write_concern'].
+        """
+
+        if self._spool is not None:
+            self._check_deferred(write_concern)
+            self._spool.delete(self._id)
+            self._logger.info(
+                "Object {{'_id': ObjectID('%s')}} delete spooled.", self._id)
+            self.__delattr__('_id')
+            return None
+
+        res = self._get_collection(write_concern, self).delete_one(
+            self._get_filter())
+        cache = self._get_large_cache()
+        self._delete_large([
+            self._get_large_id(self.get(key)) or cache.get(key, (None,))[0]
+            for key in self.config['large_fields']])
+        self._logger.info(
+            "Object {{'_id': ObjectID('%s')}} deleted.", self._id)
+        self.__delattr__('_id')
+        return res
+
+
+# -----------------------------------------------------------------------------
+# Mirror
+# -----------------------------------------------------------------------------
+
+class Mirror(object):
+    """In-memory mirror of a (small) model collection, indexed by _id.
+
+    The mirror follows the collection change stream (which requires a
+    replica set) in a background thread, applying inserts, updates, replaces,
+    and deletes incrementally, so reads can be served from memory while
+    staying fresh. The change stream is opened before the collection is
+    loaded, so no change is missed. The resume token is stored in the model
+    checkpoints collection every checkpoint_size changes or checkpoint_interval
+    seconds (and when stopped), and is used to resume the change stream after
+    errors and restarts (falling back to a new change stream if the token is
+    no longer in the oplog). Changes since the last checkpoint are applied
+    again after a restart, which is harmless as each change event carries the
+    full document.
+    """
+
+    def __init__(self, model, checkpoint_size=100, checkpoint_interval=1.0):
+        """Initialize empty mirror of a model.
+
+        Args:
+            model (type): :class:`Model` subclass
+            checkpoint_size (int): number of changes between checkpoints
+            checkpoint_interval (float): seconds between checkpoints (None to
+                only checkpoint by size)
+        """
+
+        self.model = model
+        self.documents = {}  # _id -> document
+        self.lock = threading.Lock()  # Guards documents
+        self.key = 'mirror.' + model.collection.name
+        self.stopped = threading.Event()
+        self.thread = None
+        self.checkpoint_size = checkpoint_size
+        self.checkpoint_interval = checkpoint_interval
+
+        checkpoint = model._checkpoints.find_one({'_id': self.key})
+        self.token = checkpoint['token'] if checkpoint else None
+        self.unsaved = 0  # Changes applied since the last checkpoint
+        self.saved = time.monotonic()
+
+    # -------------------------------------------------------------------------
+    # Reading
+    # -------------------------------------------------------------------------
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __contains__(self, _id):
+        return _id in self.documents
+
+    def get(self, _id):
+        """Get object by _id (or None).
+        """
+
+        doc = self.documents.get(_id)
+        return self.model(doc) if doc is not None else None
+
+    def find_many(self, query=None):
+        """Load many from the mirror (see :func:`minimongo.memory.match`).
+
+        Yields:
+            Model: objects matching the query
+        """
+
+        with self.lock:
+            docs = list(self.documents.values())
+        for doc in docs:
+            if match(doc, query):
+                yield self.model(doc)
+
+    def find(self, query=None):
+        """Find one from the mirror (or None).
+        """
+
+        return next(self.find_many(query), None)
+
+    # -------------------------------------------------------------------------
+    # Following
+    # -------------------------------------------------------------------------
+
+    def start(self):
+        """Load the collection and start following changes.
+        """
+
+        stream = self._open()
+        self.load()
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._run, args=(stream,), daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop following changes (storing the resume token).
+        """
+
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.checkpoint()
+
+    def load(self):
+        """Load the collection (replacing the mirror).
+        """
+
+        documents = {doc['_id']: doc for doc in self.model.collection.find()}
+        with self.lock:
+            self.documents = documents
+        self.model._logger.info('Mirror loaded %s objects.', len(documents))
+
+    def apply(self, change):
+        """Apply a change (from the change stream), checkpointing if due.
+
+        Args:
+            change (dict): change event
+        """
+
+        op = change['operationType']
+        if op in ('insert', 'update', 'replace'):
+            _id = change['documentKey']['_id']
+            doc = change.get('fullDocument')
+            with self.lock:
+                if doc is None:  # Deleted before the update was looked up
+                    self.documents.pop(_id, None)
+                else:
+                    self.documents[_id] = doc
+        elif op == 'delete':
+            with self.lock:
+                self.documents.pop(change['documentKey']['_id'], None)
+        elif op in ('drop', 'rename', 'dropDatabase', 'invalidate'):
+            with self.lock:
+                self.documents = {}
+
+        self.token = change['_id']
+        self.unsaved += 1
+        if self.unsaved >= self.checkpoint_size:
+            self.checkpoint()
+        else:
+            self._checkpoint_due()
+
+    def checkpoint(self):
+        """Store the resume token (if changes were applied since).
+        """
+
+        if self.unsaved:
+            self.model._checkpoints.update_one(
+                {'_id': self.key}, {'$set': {'token': self.token}},
+                upsert=True)
+            self.unsaved = 0
+        self.saved = time.monotonic()
+
+    def _checkpoint_due(self):
+        """Store the resume token if checkpoint_interval has elapsed.
+        """
+
+        if self.checkpoint_interval is not None and \
+                time.monotonic() - self.saved >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def _open(self):
+        """Open the change stream (resuming from the token if possible).
+        """
+
+        options = {'full_document': 'updateLookup', 'max_await_time_ms': 1000}
+        if self.token is not None:
+            try:
+                return self.model.collection.watch(
+                    resume_after=self.token, **options)
+            except OperationFailure as e:
+                self.model._logger.warning(
+                    'Mirror could not resume (%s), restarting.', e)
+                self.token = None
+        return self.model.collection.watch(**options)
+
+    def _run(self, stream):
+        """Follow the change stream until stopped (reopening on errors).
+        """
+
+        while not self.stopped.is_set():
+            try:
+                if stream is None:
+                    stream = self._open()
+                    if self.token is None:
+                        self.load()  # Changes may have been missed
+                with stream:
+                    while not self.stopped.is_set() and stream.alive:
+                        change = stream.try_next()
+                        if change is None:
+                            self._checkpoint_due()  # Idle
+                        else:
+                            self.apply(change)
+                            if change['operationType'] == 'invalidate':
+                                self.token = None
+                                break
+            except PyMongoError as e:
+                self.model._logger.exception('Mirror change stream error: %s',
+                                             e)
+                self.stopped.wait(1.0)
+            stream = None
+
+
+# -----------------------------------------------------------------------------
+# WriteBuffer
+# -----------------------------------------------------------------------------
+
+class WriteBuffer(object):
+    """Write behind buffer coalescing updates per document.
+
+    Updates are buffered per _id, and successive updates are merged into one
+    update where possible (see :func:`merge_update`), otherwise queued in
+    order. Buffered updates are flushed using an ordered bulk write when the
+    buffer is full, periodically (by a background thread) if an interval is
+    specified, explicitly using :meth:`flush`, and when the process exits
+    normally (updates still buffered are lost if the process is killed). If a
+    flush fails, the updates not written are restored in front of any updates
+    buffered since, so are retried by the next flush.
+    """
+
+    def __init__(self, collection, size=1000, interval=None, logger=None):
+        """Initialize buffer (and background thread if interval specified).
+
+        Args:
+            collection (pymongo.collection.Collection): collection
+            size (int): number of buffered updates which triggers a flush
+            interval (float): seconds between periodic flushes (optional)
+            logger (logging.Logger): logger
+        """
+
+        self.collection = collection
+        self.size = size
+        self.interval = interval
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+
+        self.pending = {}  # Ordered list of updates for each _id
+        self.count = 0
+        self.lock = threading.Lock()  # Guards pending and count
+        self.flushing = threading.Lock()  # Keeps flushes in order
+
+        self.stopped = threading.Event()
+        if interval:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        atexit.register(self.close)
+
+    def add(self, _id, update):
+        """Buffer an update (flushing if the buffer is full).
+
+        Args:
+            _id (object): document _id
+            update (dict): update (with update operators)
+        """
+
+        with self.lock:
+            updates = self.pending.setdefault(_id, [])
+            merged = merge_update(updates[-1], update) if updates else None
+            if merged is None:
+                updates.append(update)
+                self.count += 1
+            else:
+                updates[-1] = merged
+            full = self.count >= self.size
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Flush buffered updates using an ordered bulk write.
+
+        Returns:
+            pymongo.results.BulkWriteResult: result (None if nothing to flush)
+        """
+
+        with self.flushing:
+            with self.lock:
+                pending, self.pending, self.count = self.pending, {}, 0
+            if not pending:
+                return None
+
+            updates = [(_id, update) for _id, updates in pending.items()
+                       for update in updates]
+            requests = [UpdateOne({'_id': _id}, update)
+                        for _id, update in updates]
+            try:
+                res = self.collection.bulk_write(requests)
+            except BulkWriteError as e:
+                # Ordered, so requests before the first error were written,
+                # and the failed request is dropped (it would fail again)
+                index = e.details['writeErrors'][0]['index']
+                self.logger.error(
+                    "Buffered update %s failed: %s", updates[index], e)
+                self._restore(updates[index + 1:])
+                raise
+            except PyMongoError:
+                self._restore(updates)
+                raise
+            self.logger.info("%s buffered updates flushed.", len(requests))
+            return res
+
+    def _restore(self, updates):
+        """Restore unwritten updates in front of updates buffered since.
+
+        Args:
+            updates (list): ordered list of (_id, update) not written
+        """
+
+        with self.lock:
+            pending = {}
+            for _id, update in updates:
+                pending.setdefault(_id, []).append(update)
+            for _id, newer in self.pending.items():
+                pending.setdefault(_id, []).extend(newer)
+            self.pending = pending
+            self.count = sum(len(v) for v in pending.values())
+        self.logger.warning("%s buffered updates restored.", len(updates))
+
+    def close(self):
+        """Stop the background thread (if any) and flush.
+        """
+
+        self.stopped.set()
+        self.flush()
+
+    def _run(self):
+        """Flush periodically until stopped.
+        """
+
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.exception('Error flushing buffered updates: %s', e)
+
+
+# -----------------------------------------------------------------------------
+# LargeReader
+# -----------------------------------------------------------------------------
+
+class LargeReader(io.RawIOBase):
+    """Streaming reader of a large field value stored in chunks.
+
+    Chunks are read from a cursor one at a time (in order), so only one chunk
+    is held in memory. Usually wrapped in a :class:`io.BufferedReader` (see
+    :meth:`Model.open_large`).
+    """
+
+    def __init__(self, chunks, file_id):
+        """Initialize reader (reading the first chunk).
+
+        Args:
+            chunks (pymongo.collection.Collection): chunks collection
+            file_id (bson.ObjectId): file id
+        """
+
+        super().__init__()
+        self.file_id = file_id
+        self.cursor = chunks.find({'file': file_id}, sort=[('n', ASCENDING)])
+        chunk = next(self.cursor, None)
+        if chunk is None:
+            self.cursor.close()
+            raise ValueError('Large field {} not found'.format(file_id))
+        self.raw = chunk.get('raw', False)  # Otherwise BSON
+        self.data = memoryview(chunk['data'])
+        self.n = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        """Read into a buffer, returning the number of bytes (0 at the end).
+        """
+
+        while not self.data:
+            chunk = next(self.cursor, None)
+            if chunk is None:
+                return 0
+            self.n += 1
+            if chunk['n'] != self.n:
+                raise OSError('Large field {} chunk {} missing'.format(
+                    self.file_id, self.n))
+            self.data = memoryview(chunk['data'])
+        size = min(len(b), len(self.data))
+        b[:size] = self.data[:size]
+        self.data = self.data[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.cursor.close()  # Ensure cursor is closed
+        super().close()
+
 
 # -----------------------------------------------------------------------------
 # UpdateError
@@ -0,0 +1,315 @@
+"""
+Durable on-disk spool for MongoDB writes.
+
+Contains a local write ahead spool, which accepts writes at local disk speed
+when MongoDB is slow or unavailable, and replays them into a collection later.
+Writes are appended to segment files as BSON documents (which are length
+prefixed), segments are rotated by size, and the replayer drains closed
+segments using ordered bulk writes, removing each segment once applied.
+"""
+
+import os
+import bson
+import logging
+import threading
+import time
+
+from pymongo import UpdateOne, ReplaceOne, DeleteOne
+
+# -----------------------------------------------------------------------------
+# Constants
+# -----------------------------------------------------------------------------
+
+# Segment file extension
+SEGMENT_EXTENSION = '.spool'
+
+# Fsync policies
+FSYNC_POLICIES = {'always', 'interval', 'never'}
+
+# Update operators which are idempotent (so can be replayed more than once)
+IDEMPOTENT_OPERATORS = {
+    '$set', '$unset', '$min', '$max', '$addToSet', '$pull', '$currentDate'}
+
+
+# -----------------------------------------------------------------------------
+# Spool
+# -----------------------------------------------------------------------------
+
+class Spool(object):
+    """Append only spool of MongoDB writes, rotated into segment files.
+
+    Each write is stored as a BSON record with the operation ('insert',
+    'update', 'replace', or 'delete') and its arguments. Inserts are replayed
+    as upserts by _id and deletes by _id, so replaying a segment more than
+    once (e.g. after a crash during replay) is idempotent, and updates are
+    restricted to idempotent operators (e.g. '$set' rather than '$inc').
+    """
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, fsync='interval',
+                 fsync_interval=1.0, logger=None):
+        """Initialize spool (opening a new segment for writing).
+
+        Args:
+            path (str): directory for segment files (created if required)
+            segment_size (int): size in bytes which triggers rotation
+            fsync (str): fsync policy, after every write ('always'), at most
+                every fsync_interval seconds ('interval'), or leave it to the
+                operating system ('never')
+            fsync_interval (float): seconds between fsync ('interval' only)
+            logger (logging.Logger): logger
+        """
+
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync must be one of {}'.format(
+                ', '.join(sorted(FSYNC_POLICIES))))
+
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+
+        self.lock = threading.Lock()  # Guards the current segment
+        self.file = None
+        self.synced = time.monotonic()
+
+        os.makedirs(path, exist_ok=True)
+        self._open(self._next_index())
+
+    # -------------------------------------------------------------------------
+    # Writing
+    # -------------------------------------------------------------------------
+
+    def append(self, records):
+        """Append records to the current segment (rotating if required).
+
+        Args:
+            records (list): records, each a :class:`dict` with the operation
+                ('op') and its arguments
+        """
+
+        data = b''.join(bson.BSON.encode(record) for record in records)
+
+        with self.lock:
+            self.file.write(data)
+            self.file.flush()
+            if self.fsync == 'always' or (
+                    self.fsync == 'interval' and
+                    time.monotonic() - self.synced >= self.fsync_interval):
+                os.fsync(self.file.fileno())
+                self.synced = time.monotonic()
+            if self.file.tell() >= self.segment_size:
+                self._rotate()
+
+    def insert(self, obj):
+        """Append an insert (the object must have an _id).
+        """
+
+        self.append([{'op': 'insert', 'doc': obj}])
+
+    def insert_many(self, objects):
+        """Append many inserts (the objects must have an _id).
+        """
+
+        self.append([{'op': 'insert', 'doc': obj} for obj in objects])
+
+    def update(self, _id, update):
+        """Append an update (with update operators) by _id.
+
+        Raises:
+            ValueError: if the update is not idempotent (see
+                :func:`is_idempotent`), as replay is at least once
+        """
+
+        if not is_idempotent(update):
+            raise ValueError('Spooled updates must only use {}'.format(
+                ', '.join(sorted(IDEMPOTENT_OPERATORS))))
+
+        self.append([{'op': 'update', '_id': _id, 'update': update}])
+
+    def replace(self, obj):
+        """Append a replacement (upsert) by _id.
+        """
+
+        self.append([{'op': 'replace', 'doc': obj}])
+
+    def delete(self, _id):
+        """Append a delete by _id.
+        """
+
+        self.append([{'op': 'delete', '_id': _id}])
+
+    def rotate(self):
+        """Close the current segment (so it can be replayed), opening another.
+        """
+
+        with self.lock:
+            self._rotate()
+
+    def close(self):
+        """Close the current segment (with fsync unless the policy is never).
+        """
+
+        with self.lock:
+            self._close()
+
+    # -------------------------------------------------------------------------
+    # Replaying
+    # -------------------------------------------------------------------------
+
+    def segments(self):
+        """Closed segments, ready to be replayed (oldest first).
+
+        Returns:
+            list: segment file paths
+        """
+
+        current = self.file.name if self.file else None
+        return [path for path in self._segments() if path != current]
+
+    def replay(self, collection, batch_size=1000, rotate=True):
+        """Replay closed segments into a collection, removing each once done.
+
+        Args:
+            collection (pymongo.collection.Collection): collection
+            batch_size (int): number of writes per ordered bulk write
+            rotate (bool): rotate first, so all writes so far are replayed
+
+        Returns:
+            int: number of writes replayed
+        """
+
+        if rotate:
+            self.rotate()
+
+        count = 0
+        for path in self.segments():
+            requests = []
+            for record in read_segment(path):
+                requests.append(get_request(record))
+                if len(requests) >= batch_size:
+                    collection.bulk_write(requests, ordered=True)
+                    count += len(requests)
+                    requests = []
+            if requests:
+                collection.bulk_write(requests, ordered=True)
+                count += len(requests)
+            os.remove(path)
+            self.logger.info('Segment %s replayed.', path)
+
+        self.logger.info('%s writes replayed.', count)
+        return count
+
+    # -------------------------------------------------------------------------
+    # Helpers
+    # -------------------------------------------------------------------------
+
+    def _segments(self):
+        """All segments (oldest first).
+        """
+
+        names = sorted(name for name in os.listdir(self.path)
+                       if name.endswith(SEGMENT_EXTENSION))
+        return [os.path.join(self.path, name) for name in names]
+
+    def _next_index(self):
+        """Index of the next segment.
+        """
+
+        segments = self._segments()
+        if not segments:
+            return 0
+        name = os.path.basename(segments[-1])
+        return int(name[:-len(SEGMENT_EXTENSION)]) + 1
+
+    def _open(self, index):
+        """Open a new segment.
+        """
+
+        path = os.path.join(
+            self.path, '{:020d}{}'.format(index, SEGMENT_EXTENSION))
+        self.file = open(path, 'ab')
+
+    def _close(self):
+        """Close the current segment.
+        """
+
+        if self.file and not self.file.closed:
+            self.file.flush()
+            if self.fsync != 'never':
+                os.fsync(self.file.fileno())
+            self.file.close()
+
+    def _rotate(self):
+        """Close the current segment and open the next (lock must be held).
+        """
+
+        self._close()
+        self._open(self._next_index())
+
+
+# -----------------------------------------------------------------------------
+# Segments
+# -----------------------------------------------------------------------------
+
+def read_segment(path):
+    """Read records from a segment file.
+
+    Records are split by their BSON length prefix, and a truncated record at
+    the end of the segment (e.g. after a crash during a write) is ignored.
+
+    Args:
+        path (str): segment file path
+
+    Yields:
+        dict: records
+    """
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    view = memoryview(data)
+    offset = 0
+    while offset + 4 <= len(data):
+        length = int.from_bytes(view[offset:offset + 4], 'little')
+        if length < 5 or offset + length > len(data):
+            logging.getLogger(__name__).warning(
+                'Truncated record in %s at offset %s ignored.', path, offset)
+            break
+        yield bson.BSON(view[offset:offset + length]).decode()
+        offset += length
+
+
+def get_request(record):
+    """Convert a record to a (idempotent) :mod:`pymongo` bulk write request.
+
+    Args:
+        record (dict): record
+
+    Returns:
+        object: :class:`pymongo.operations.UpdateOne` (or other request)
+    """
+
+    op = record['op']
+    if op == 'insert' or op == 'replace':
+        doc = record['doc']
+        return ReplaceOne({'_id': doc['_id']}, doc, upsert=True)
+    elif op == 'update':
+        return UpdateOne({'_id': record['_id']}, record['update'])
+    elif op == 'delete':
+        return DeleteOne({'_id': record['_id']})
+
+    raise ValueError('Unknown spool operation {!r}'.format(op))
+
+
+def is_idempotent(update):
+    """Checks an update (with update operators) can be applied repeatedly.
+
+    Args:
+        update (dict): update
+
+    Returns:
+        bool: if all update operators are idempotent
+    """
+
+    return bool(update) and all(key in IDEMPOTENT_OPERATORS for key in update)
@@ -0,0 +1,93 @@
+"""
+Benchmark of wire compression for large :meth:`Model.find_many` reads.
+
+Inserts large documents into a scratch collection, then times reading them
+back through :meth:`Model.find_many` using each of the compressors available
+(configured using the model config['client'] block). Note that compression
+only pays off when the network (rather than the server or Python) is the
+bottleneck, so run this against a remote server for meaningful numbers.
+
+Usage::
+
+    python scripts/benchmark_compression.py --host 10.0.0.1 --count 2000
+"""
+
+import argparse
+import random
+import string
+import time
+
+from minimongo.repository import Model
+
+
+def get_compressors():
+    """Compressors available (zlib is always, snappy and zstd are optional).
+    """
+
+    compressors = [None, 'zlib']
+    try:
+        import snappy  # noqa: F401 (python-snappy)
+        compressors.append('snappy')
+    except ImportError:
+        pass
+    try:
+        import zstandard  # noqa: F401
+        compressors.append('zstd')
+    except ImportError:
+        pass
+    return compressors
+
+
+def get_model(host, port, compressor):
+    """Model bound to the scratch collection using the compressor.
+    """
+
+    client = {'compressors': compressor} if compressor else {}
+    return type('Benchmark', (Model,), {'config': {
+        'host': host,
+        'port': port,
+        'database': 'minimongo_benchmark',
+        'collection': 'compression',
+        'client': client,
+    }})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=64 * 1024)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # Compressible (but not trivially) documents
+    words = [''.join(random.choice(string.ascii_lowercase) for i in range(8))
+             for j in range(256)]
+    text = ' '.join(random.choice(words) for i in range(args.size // 9))
+
+    Benchmark = get_model(args.host, args.port, None)
+    Benchmark.collection.drop()
+    Benchmark.insert_many([{'i': i, 'text': text} for i in range(args.count)])
+
+    print('{:<10}{:>12}{:>14}'.format('compressor', 'seconds', 'MB/s'))
+    for compressor in get_compressors():
+        Benchmark = get_model(args.host, args.port, compressor)
+        best = None
+        for i in range(args.repeat):
+            start = time.perf_counter()
+            for obj in Benchmark.find_many({}):
+                pass
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        Benchmark.connection.close()
+        print('{:<10}{:>12.3f}{:>14.1f}'.format(
+            compressor or 'none', best,
+            args.count * args.size / best / 1024 / 1024))
+
+    Benchmark = get_model(args.host, args.port, None)
+    Benchmark.collection.drop()
+
+
+if __name__ == '__main__':
+    main()
@@ -77,8 +77,11 @@ setup(
         'log4mongo>=1.4.3',
         'pyyaml>=3.1.1',
         'inflection>=0.3.1',
-        'pymongo>=3.0.3',
+        'pymongo>=3.7.0',
     ],
+    extras_require={
+        'numpy': ['numpy>=1.10.0'],
+    },
     cmdclass={
         'install': CustomInstallCommand,
         'develop': CustomDevelopCommand,
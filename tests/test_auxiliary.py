@@ -0,0 +1,176 @@
+"""
+Tests auxiliary functions for working with dictionaries, lists, BSON and pretty
+printing (these do not require MongoDB).
+"""
+
+import io
+
+from collections import OrderedDict
+from collections.abc import Mapping
+from datetime import datetime
+
+import bson
+import pytest
+
+from minimongo.auxiliary import pivot_list_to_dict, split_bson, Pretty
+
+
+# ----------------------------------------------------------------------------
+# Lists
+# ----------------------------------------------------------------------------
+
+class TestPivotListToDict(object):
+
+    def setup(self):
+        self.objects = [{'a': i % 2, 'b': i // 2, 'c': i} for i in range(5)]
+
+    def test_generator(self):
+        pivoted = pivot_list_to_dict(
+            (dict(obj) for obj in self.objects), ['a', 'b'])
+        assert pivoted == {
+            0: {0: {'c': 0}, 1: {'c': 2}, 2: {'c': 4}},
+            1: {0: {'c': 1}, 1: {'c': 3}},
+        }
+
+    def test_grouped(self):
+        pivoted = pivot_list_to_dict(self.objects, 'a')
+        assert pivoted[0] == [{'b': 0, 'c': 0}, {'b': 1, 'c': 2},
+                              {'b': 2, 'c': 4}]
+        assert pivoted[1] == [{'b': 0, 'c': 1}, {'b': 1, 'c': 3}]
+
+    def test_types(self):
+        pivoted = pivot_list_to_dict(self.objects, ['a', 'b'], [str, None])
+        assert set(pivoted) == {'0', '1'}
+        assert set(pivoted['1']) == {0, 1}
+        # Types (none, single, or list of none)
+        for types in [None, [None, None]]:
+            assert pivot_list_to_dict(self.objects, ['a', 'b'], types) == \
+                pivot_list_to_dict(self.objects, ['a', 'b'])
+        assert set(pivot_list_to_dict(self.objects, ['a', 'b'], str)) == \
+            {'0', '1'}
+
+    def test_copy(self):
+        # Copy (objects left unchanged)
+        pivoted = pivot_list_to_dict(self.objects, ['a', 'b'])
+        assert self.objects[0] == {'a': 0, 'b': 0, 'c': 0}
+        assert pivoted[0][0] is not self.objects[0]
+        # No copy (objects changed in place and not duplicated)
+        pivoted = pivot_list_to_dict(self.objects, ['a', 'b'], copy=False)
+        assert pivoted[0][0] is self.objects[0]
+        assert self.objects[0] == {'c': 0}
+
+
+# ----------------------------------------------------------------------------
+# Printing
+# ----------------------------------------------------------------------------
+
+class TestPretty(object):
+
+    def setup(self):
+        self.pretty = Pretty()
+
+    def test_types(self):
+        assert self.pretty(1) == '1'
+        assert self.pretty('a') == "'a'"
+        assert self.pretty({}) == '{\n}'
+        assert self.pretty({'b': 1, 'a': 'x'}) == "{\n  'a': 'x',\n  'b': 1\n}"
+        assert self.pretty([1, 2]) == '[\n  1,\n  2\n]'
+        assert self.pretty((1,)) == '(\n  1\n)'
+        assert self.pretty({'a': [1, (2,)]}) == (
+            "{\n  'a': [\n    1,\n    (\n      2\n    )\n  ]\n}")
+        # Options (as arguments or attributes)
+        assert Pretty(htchar='\t', lfchar='\r\n', indent=1)([1]) == \
+            '[\r\n\t\t1\r\n\t]'
+        assert self.pretty([1], indent=1) == '[\n    1\n  ]'
+        # Insertion order (keys not sorted)
+        assert Pretty(sort_keys=False)({'b': 1, 'a': 2}) == \
+            "{\n  'b': 1,\n  'a': 2\n}"
+
+    def test_formatters(self):
+        # Streamed containers match the formatters
+        value = {'a': [1, (2, {'b': 3})], 'c': {}}
+        assert self.pretty(value) == self.pretty.dict_formatter(value, 0)
+        assert self.pretty([value]) == self.pretty.list_formatter([value], 0)
+        # Custom formatter (and subclasses)
+        self.pretty.add_formatter(
+            datetime, lambda pretty, value, indent: value.isoformat())
+        assert self.pretty([datetime(2020, 1, 1)]) == \
+            '[\n  2020-01-01T00:00:00\n]'
+
+    def test_max_depth(self):
+        value = {'a': [1, {'b': 2}], 'c': 3}
+        assert Pretty(max_depth=1)(value) == "{\n  'a': [...],\n  'c': 3\n}"
+        assert Pretty(max_depth=2)(value) == (
+            "{\n  'a': [\n    1,\n    {...}\n  ],\n  'c': 3\n}")
+        assert Pretty(max_depth=0)(value) == '{...}'
+
+    def test_write(self):
+        # Written incrementally (in many writes) to a file-like object
+        writes = []
+
+        class File(object):
+            def write(self, s):
+                writes.append(s)
+
+        value = [{'a': i} for i in range(100)]
+        self.pretty.write(value, File())
+        assert len(writes) > 100
+        assert ''.join(writes) == self.pretty(value)
+        f = io.StringIO()
+        self.pretty.write(value, f)
+        assert f.getvalue() == ''.join(writes)
+        # Deeply nested (no recursion limit)
+        value = []
+        for i in range(10000):
+            value = [value]
+        assert self.pretty(value).count('[') == 10001
+
+    def test_get_formatter(self):
+        # Dispatch by MRO, cached by exact type
+        formatter = self.pretty.get_formatter(OrderedDict())
+        assert formatter is Pretty.dict_formatter
+        assert self.pretty.cache[OrderedDict] is Pretty.dict_formatter
+        assert self.pretty.get_formatter(True) is Pretty.object_formatter
+
+        def formatter(pretty, value, indent):
+            return 'ordered'
+
+        # Cache cleared when a formatter is added
+        self.pretty.add_formatter(OrderedDict, formatter)
+        assert OrderedDict not in self.pretty.cache
+        assert self.pretty({'a': OrderedDict()}) == "{\n  'a': ordered\n}"
+        assert self.pretty({}) == '{\n}'
+
+        # Abstract base classes (by isinstance)
+        class View(Mapping):
+            def __getitem__(self, key):
+                raise KeyError(key)
+
+            def __iter__(self):
+                return iter(())
+
+            def __len__(self):
+                return 0
+
+        self.pretty.add_formatter(Mapping, formatter)
+        assert self.pretty(View()) == 'ordered'
+        assert self.pretty.cache[View] is formatter
+
+
+# ----------------------------------------------------------------------------
+# BSON
+# ----------------------------------------------------------------------------
+
+class TestSplitBson(object):
+
+    def test_split_bson(self):
+        data = b''.join(bson.encode({'a': i}) for i in range(3))
+        documents = split_bson(data)
+        document = next(documents)
+        assert isinstance(document, memoryview)
+        assert bson.decode(document) == {'a': 0}
+
+        # Views are released when the next document is read
+        assert [bson.decode(d) for d in documents] == [{'a': 1}, {'a': 2}]
+        with pytest.raises(ValueError):
+            bytes(document)
@@ -0,0 +1,250 @@
+"""
+Tests classes and methods for the in-process memory backend.
+
+Unlike :mod:`test_repository`, these tests do not require MongoDB.
+"""
+
+import pytest
+import time
+
+from pymongo import IndexModel
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo.read_concern import ReadConcern
+from pymongo.write_concern import WriteConcern
+
+from minimongo.memory import MemoryClient, match, apply_update
+from minimongo.repository import Model
+
+
+# ----------------------------------------------------------------------------
+# Matching and updating
+# ----------------------------------------------------------------------------
+
+class TestMatch(object):
+
+    def setup(self):
+        self.doc = {
+            'a': 0,
+            'b': 'string',
+            'c': {'d': 2, 'e': [1, 2, 3]},
+            'f': [{'x': 1}, {'x': 2}],
+        }
+
+    def test_match(self):
+        assert match(self.doc, {'a': 0, 'c.d': 2})
+        assert match(self.doc, {'c.e': 2, 'f.x': 1})
+        assert match(self.doc, {'a': {'$gte': 0, '$lt': 1}})
+        assert match(self.doc, {'b': {'$in': ['x', 'string']}})
+        assert match(self.doc, {'g': None, 'g.h': {'$exists': False}})
+        assert match(self.doc, {'$or': [{'a': 1}, {'b': {'$regex': '^s'}}]})
+        assert match(self.doc, {'f': {'$elemMatch': {'x': {'$gt': 1}}}})
+        assert match(self.doc, {'c.e': {'$size': 3, '$all': [1, 3]}})
+        assert not match(self.doc, {'a': False})
+        assert not match(self.doc, {'a': {'$ne': 0}})
+        assert not match(self.doc, {'b': {'$gt': 0}})  # Type bracketing
+
+    def test_apply_update(self):
+        apply_update(self.doc, {
+            '$set': {'c.d': 3, 'g.h': 1},
+            '$unset': {'b': ''},
+            '$inc': {'a': 2},
+            '$push': {'c.e': {'$each': [4, 5]}},
+            '$max': {'i': 1},
+        })
+        assert self.doc['a'] == 2
+        assert 'b' not in self.doc
+        assert self.doc['c'] == {'d': 3, 'e': [1, 2, 3, 4, 5]}
+        assert self.doc['g'] == {'h': 1}
+        assert self.doc['i'] == 1
+
+
+# ----------------------------------------------------------------------------
+# MemoryCollection
+# ----------------------------------------------------------------------------
+
+class TestMemoryCollection(object):
+
+    def setup(self):
+        self.collection = MemoryClient('test')['test']['collection']
+        self.collection.drop()
+        self.collection.create_indexes([
+            IndexModel([('a', 1), ('b', 1)], name='a_b', unique=True),
+            IndexModel([('c', 1)], name='c'),
+        ])
+        self.collection.insert_many(
+            [{'a': i % 3, 'b': i, 'c': [i, i + 10]} for i in range(10)])
+
+    def test_indexes(self):
+        # Hash index (all fields)
+        docs = list(self.collection.find({'a': 1, 'b': 4}))
+        assert [doc['b'] for doc in docs] == [4]
+        assert self.collection.indexes['a_b'].ops == 1
+        # Sorted index (range on first field, multikey)
+        docs = list(self.collection.find({'c': {'$gte': 15, '$lt': 18}}))
+        assert [doc['b'] for doc in docs] == [5, 6, 7, 8, 9]
+        assert self.collection.indexes['c'].ops == 1
+        # Sorted index (bounds satisfied by different elements, multikey)
+        docs = list(self.collection.find({'c': {'$gt': 12, '$lt': 5}}))
+        assert [doc['b'] for doc in docs] == [3, 4]
+        # Unique
+        with pytest.raises(DuplicateKeyError):
+            self.collection.insert_one({'a': 1, 'b': 4})
+        with pytest.raises(DuplicateKeyError):
+            self.collection.update_one({'b': 5}, {'$set': {'b': 4, 'a': 1}})
+        assert self.collection.count_documents({'b': 5}) == 1
+
+    def test_find(self):
+        docs = list(self.collection.find(
+            {'a': 0}, {'_id': 0, 'b': 1}, sort=[('b', -1)], skip=1, limit=2))
+        assert docs == [{'b': 6}, {'b': 3}]
+        # Documents are copied
+        docs[0]['b'] = 100
+        assert self.collection.find_one({'b': 100}) is None
+
+    def test_update_and_delete(self):
+        res = self.collection.update_many({'a': 0}, {'$inc': {'b': 100}})
+        assert res.modified_count == 4
+        res = self.collection.update_one(
+            {'a': 5}, {'$set': {'b': 1}}, upsert=True)
+        assert self.collection.find_one({'_id': res.upserted_id})['a'] == 5
+        res = self.collection.delete_many({'b': {'$gte': 100}})
+        assert res.deleted_count == 4
+        assert self.collection.estimated_document_count() == 7
+        # Modified (types compared, as BSON)
+        res = self.collection.update_one({'b': 1}, {'$set': {'b': 1.0}})
+        assert res.modified_count == 1
+        res = self.collection.update_one({'b': 1}, {'$set': {'b': 1.0}})
+        assert res.modified_count == 0
+        res = self.collection.update_one({'b': 1}, {'$set': {'b': True}})
+        assert res.modified_count == 1
+
+    def test_with_options(self):
+        # View with options (sharing documents)
+        view = self.collection.with_options(
+            write_concern=WriteConcern(w=0),
+            read_concern=ReadConcern('majority'))
+        assert not view.write_concern.acknowledged
+        assert view.read_concern.level == 'majority'
+        assert self.collection.write_concern.acknowledged
+        view.insert_one({'a': 10, 'b': 10})
+        assert self.collection.find_one({'a': 10})['b'] == 10
+        assert view.with_options().read_concern.level == 'majority'
+
+    def test_find_one_and_update(self):
+        doc = self.collection.find_one_and_update(
+            {'a': 1}, {'$inc': {'b': 100}}, sort=[('b', -1)],
+            return_document=True)
+        assert doc['b'] == 107
+        doc = self.collection.find_one_and_update(
+            {'a': 1}, {'$inc': {'b': 100}}, sort=[('b', 1)])
+        assert doc['b'] == 1
+        doc = self.collection.find_one_and_update(
+            {'a': 5}, {'$set': {'b': 0}}, upsert=True, return_document=True)
+        assert doc['a'] == 5 and doc['b'] == 0
+
+    def test_find_one_and_delete(self):
+        count = self.collection.count_documents({'a': 1})
+        doc = self.collection.find_one_and_delete(
+            {'a': 1}, projection={'b': 1}, sort=[('b', -1)])
+        assert doc['b'] == 7 and 'a' not in doc
+        assert self.collection.count_documents({'a': 1}) == count - 1
+        assert self.collection.find_one_and_delete({'a': 100}) is None
+
+    def test_watch(self):
+        # Change stream (changes since watched)
+        stream = self.collection.watch(full_document='updateLookup')
+        assert stream.try_next() is None
+        _id = self.collection.insert_one({'a': 10, 'b': 10}).inserted_id
+        self.collection.update_one({'_id': _id}, {'$set': {'b': 11}})
+        self.collection.delete_one({'_id': _id})
+        changes = [stream.try_next() for i in range(3)]
+        assert [change['operationType'] for change in changes] == [
+            'insert', 'update', 'delete']
+        assert changes[1]['fullDocument']['b'] == 11
+        assert changes[2]['documentKey'] == {'_id': _id}
+        stream.close()
+        assert not stream.alive
+        # Resume after a change (and not after the change log)
+        with self.collection.watch(resume_after=changes[0]['_id']) as stream:
+            change = stream.try_next()
+            assert change['operationType'] == 'update'
+            assert 'fullDocument' not in change
+        with pytest.raises(OperationFailure):
+            self.collection.watch(resume_after={'_data': '100'})
+
+
+# ----------------------------------------------------------------------------
+# Model (memory backend)
+# ----------------------------------------------------------------------------
+
+def wait(condition, timeout=5.0):
+    """Wait for a condition (checked every 10ms), failing after a timeout.
+    """
+
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+class TestMemoryModel(object):
+
+    class Dummy(Model):
+        # Set config attr to configure binding by metaclass constructor
+        config = {
+            'database': 'minimongo_testing',
+            'collection': 'dummies',
+            'backend': 'memory',
+            'indexes': [IndexModel([('a', 1)], name='a')],
+        }
+
+    def setup(self):
+        self.Dummy.collection.delete_many({})
+
+    def test_unused_indexes(self):
+        # Indexes which are not declared are excluded
+        self.Dummy.collection.create_index([('b', 1)], name='b')
+        try:
+            assert self.Dummy.unused_indexes() in ([], ['a'])
+            self.Dummy.find({'a': 0})
+            assert self.Dummy.unused_indexes() == []
+        finally:
+            self.Dummy.collection.drop_index('b')
+
+    def test_mirror(self):
+        # Mirror (following a change stream)
+        dummy = self.Dummy.insert({'a': 0})
+        mirror = self.Dummy.mirror(checkpoint_size=2)
+        try:
+            assert mirror.get(dummy._id) == dummy
+            other = self.Dummy.insert({'a': 1})
+            dummy.update({'$set': {'b': 1}})
+            wait(lambda: other._id in mirror and mirror.get(dummy._id).get(
+                'b') == 1)
+            assert mirror.find({'b': 1}) == dummy
+            _id = other._id
+            other.delete()
+            wait(lambda: _id not in mirror)
+        finally:
+            mirror.stop()
+        # Resumed after the last change (stored when stopped)
+        self.Dummy.insert({'a': 2})
+        mirror = self.Dummy.mirror(start=False)
+        with self.Dummy.collection.watch(resume_after=mirror.token) as stream:
+            assert stream.try_next()['fullDocument']['a'] == 2
+
+    def test_model(self):
+        # Insert, find, update, save, and delete
+        dummies = self.Dummy.insert_many([{'a': 0, 'd': []}, {'a': 1}])
+        dummy = self.Dummy.find({'a': 0})
+        assert dummy == dummies[0]
+        dummy.update({'$set': {'b': {'c': 1}}, '$push': {'d': 1}})
+        dummy.b.c = 2
+        dummy.save()
+        assert self.Dummy.find({'a': 0}) == dummy
+        assert self.Dummy.count({'a': {'$gt': -1}}) == 2
+        dummy.delete()
+        assert list(self.Dummy.find_many()) == dummies[1:]
+        assert self.Dummy.collection.indexes['a'].ops > 0
+        # Pivot (aggregation)
+        assert self.Dummy.pivot({}, 'a') == {1: {'_id': dummies[1]._id}}
@@ -16,10 +16,24 @@ Created on Mar 21, 2015
 @author: Williams, James S.
 """
 
+import os
+import pickle
+import pymongo
 import pytest
+import shutil
+import tempfile
+import threading
 
+from datetime import datetime, timedelta, timezone
+
+from pymongo import IndexModel
+from pymongo.collation import Collation
+from pymongo.errors import AutoReconnect, OperationFailure
+
+from minimongo.auxiliary import pivot_list_to_dict, dict_list_diff, \
+    encode_token
 from minimongo.repository import MetaModel, AttrDictionary, Model, \
-    UpdateError
+    UpdateError, Embedded, Field, AttrView
 
 
 # ----------------------------------------------------------------------------
@@ -70,6 +84,71 @@ class TestAttrDictionary(object):
         assert self.dictionary.e.x.i == 1
         assert self.dictionary.e.y[0].i == 1
 
+    def test_pickle(self):
+        dictionary = pickle.loads(pickle.dumps(self.dictionary))
+        assert dictionary == self.dictionary
+        assert isinstance(dictionary.c, AttrDictionary)
+        assert dictionary.d[0].x == 1
+
+
+# ----------------------------------------------------------------------------
+# Embedded
+# ----------------------------------------------------------------------------
+
+class TestEmbedded(object):
+
+    class Point(Embedded):
+        fields = {
+            'x': Field(float, 0.0),
+            'y': Field(float, 0.0),
+            'tags': Field(default=list),
+        }
+
+    def setup(self):
+        self.path = {
+            'start': {'x': 1.0},
+            'points': [{'x': 2.0, 'y': 3.0}, {'y': 4.0}],
+        }
+
+    def test_slots(self):
+        point = self.Point(x=1.0)
+        assert point.x == 1.0
+        assert point.y == 0.0
+        assert point.tags == [] and point.tags is not self.Point().tags
+        # Test no per-instance dictionary
+        assert not hasattr(point, '__dict__')
+        with pytest.raises(AttributeError):
+            point.z = 1.0
+
+    def test_from_dict_and_to_dict(self):
+        class Path(Embedded):
+            fields = {
+                'start': Field(self.Point),
+                'points': Field([self.Point], default=list),
+            }
+        path = Path.from_dict(self.path)
+        assert path.start.x == 1.0
+        assert path.points[1].y == 4.0
+        assert path.to_dict() == {
+            'start': {'x': 1.0, 'y': 0.0, 'tags': []},
+            'points': [
+                {'x': 2.0, 'y': 3.0, 'tags': []},
+                {'x': 0.0, 'y': 4.0, 'tags': []},
+            ],
+        }
+        assert Path.from_dict({}).points == []
+
+    def test_field_names(self):
+        # Subclass (inherited fields allowed)
+        class Point3(self.Point):
+            fields = {'z': Field(float, 0.0)}
+        assert Point3(z=1.0).to_dict() == {
+            'x': 0.0, 'y': 0.0, 'tags': [], 'z': 1.0}
+        # Invalid or colliding field names
+        for key in ['a-b', 'class', 'fields', 'to_dict', '__init__']:
+            with pytest.raises(ValueError):
+                type('Invalid', (Embedded,), {'fields': {key: Field(int)}})
+
 
 # ----------------------------------------------------------------------------
 # Model
@@ -177,9 +256,18 @@ class TestModel(object):
         self.dummy.update({'$push': {'f': 1}})
         assert self.dummy.f[1] == 1
         assert self.Dummy.find({'a': 0}) == self.dummy
+        # Update (push each, empty, and new key)
+        self.dummy.update({'$push': {'f': {'$each': [2, 3]}}})
+        self.dummy.update({'$push': {'f': {'$each': []}, 'g': 4}})
+        assert self.dummy.f[1:] == [1, 2, 3]
+        assert self.dummy.g == [4]
+        assert self.Dummy.find({'a': 0}) == self.dummy
         # Error
         with pytest.raises(UpdateError):
             self.dummy.update({'$set': {'b': 6}, 'f': 7})
+        with pytest.raises(UpdateError):
+            self.dummy.update({'$push': {'f': {'$each': [4], '$slice': -2}}})
+        assert self.dummy.f[1:] == [1, 2, 3]
 
     def test_delete(self):
         # Save
@@ -196,3 +284,814 @@ class TestModel(object):
         dummies = list(self.Dummy.find_many())
         assert dummies[0] == self.Dummy.find({'a': 0})
         assert dummies[1] == self.Dummy.find({'a': 1})
+
+    def test_paginate(self):
+        # Insert many
+        self.Dummy.insert_many([{'a': i % 2, 'b': i} for i in range(5)])
+        # Paginate (sort key with _id tie-breaker)
+        dummies, token = self.Dummy.paginate({'a': 0}, 'b', page_size=2)
+        assert [dummy.b for dummy in dummies] == [0, 2]
+        dummies, token = self.Dummy.paginate(
+            {'a': 0}, 'b', page_size=2, after=token)
+        assert [dummy.b for dummy in dummies] == [4]
+        assert token is None
+        # Paginate (_id only)
+        dummies, token = self.Dummy.paginate(page_size=3)
+        assert len(dummies) == 3
+        dummies, token = self.Dummy.paginate(page_size=3, after=token)
+        assert len(dummies) == 2
+        assert token is None
+        # Projection (sort key and _id projected, removed unless requested)
+        for projection, keys in [({'a': 1, '_id': 0}, ['a']),
+                                 (['a'], ['_id', 'a']),
+                                 ({'b': 0, '_id': 0}, ['a'])]:
+            dummies, token = [], None
+            while True:
+                page, token = self.Dummy.paginate(
+                    {'a': 0}, 'b', page_size=1, after=token,
+                    projection=projection)
+                dummies.extend(page)
+                if token is None:
+                    break
+            assert len(dummies) == 3
+            assert all(sorted(dummy) == keys for dummy in dummies)
+        # Malformed token
+        for token in ['x', 'AAAA', encode_token(0)[:-2]]:
+            with pytest.raises(ValueError):
+                self.Dummy.paginate(after=token)
+
+    def test_paginate_null(self):
+        # Null and missing sort keys (sorted first)
+        self.Dummy.insert_many([{'b': 1}, {'b': None}, {}, {'b': 0}])
+        for direction, expected in ((1, [None, None, 0, 1]),
+                                    (-1, [1, 0, None, None])):
+            values, token = [], None
+            while True:
+                dummies, token = self.Dummy.paginate(
+                    sort_key='b', page_size=1, after=token,
+                    direction=direction)
+                values.extend(dummy.get('b') for dummy in dummies)
+                if token is None:
+                    break
+            assert values == expected
+
+    def test_recommend_indexes(self):
+        # Record query shapes (config is restored afterwards)
+        self.Dummy.config['record_queries'] = True
+        try:
+            self.Dummy._query_shapes.clear()
+            self.Dummy.find({'a': 0, 'b': {'$gt': 1}})
+            list(self.Dummy.find_many({'a': 1}, sort=[('c', -1)]))
+            list(self.Dummy.find_many({'a': 1}, sort=[('c', -1)]))
+        finally:
+            self.Dummy.config['record_queries'] = False
+        assert self.Dummy.query_shapes()[0] == (
+            (('a',), (('c', -1),), (), ()), 2)
+        # Recommend indexes (equality, sort, range)
+        keys = [list(index.document['key'].items())
+                for index in self.Dummy.recommend_indexes()]
+        assert keys == [[('a', 1), ('c', -1)], [('a', 1), ('b', 1)]]
+        assert len(self.Dummy.recommend_indexes(min_count=2)) == 1
+
+    def test_sync_indexes(self):
+        # Declare index (config is restored afterwards)
+        indexes = self.Dummy.config['indexes']
+        self.Dummy.config['indexes'] = [IndexModel([('a', 1)], name='a')]
+        try:
+            self.Dummy.collection.create_index([('b', 1)], name='b')
+            summary = self.Dummy.diff_indexes()
+            assert [i.document['name'] for i in summary['created']] == ['a']
+            assert summary['deleted'] == ['b']
+            # Sync indexes (indexes not declared are only dropped if
+            # specified)
+            self.Dummy.sync_indexes()
+            assert self.Dummy.diff_indexes() == {'deleted': ['b']}
+            self.Dummy.sync_indexes(drop=True)
+            assert not self.Dummy.diff_indexes()
+            # Changed keys and options
+            self.Dummy.config['indexes'] = [
+                IndexModel([('a', -1)], name='a', unique=True)]
+            summary = self.Dummy.diff_indexes()
+            assert [i.document['name'] for i in summary['changed']] == ['a']
+            self.Dummy.sync_indexes()
+            assert not self.Dummy.diff_indexes()
+            info = self.Dummy.collection.index_information()['a']
+            assert info['unique'] and list(info['key']) == [('a', -1)]
+        finally:
+            self.Dummy.config['indexes'] = indexes
+
+    def test_count(self):
+        # Insert many
+        self.Dummy.insert_many([{'a': i % 2} for i in range(5)])
+        # Count (estimated and query)
+        assert self.Dummy.count() == 5
+        assert self.Dummy.count({'a': 0}) == 3
+        assert self.Dummy.count({'a': 0}, limit=2) == 2
+        # Count (cached)
+        assert self.Dummy.count({'a': 1}, max_age=60) == 2
+        self.Dummy.insert({'a': 1})
+        assert self.Dummy.count({'a': 1}, max_age=60) == 2
+        assert self.Dummy.count({'a': 1}) == 3
+        # Cached by query and options
+        assert self.Dummy.count({'a': 0}, limit=2, max_age=60) == 2
+        assert self.Dummy.count({'a': 0}, max_age=60) == 3
+        # Options which are not BSON (keyed by document)
+        assert self.Dummy.count({'a': 0}, hint=[('_id', 1)], max_age=60) == 3
+        assert self.Dummy.count({'a': 0}, max_age=60, collation=Collation(
+            'en')) == 3
+        self.Dummy.insert({'a': 0})
+        assert self.Dummy.count({'a': 0}, max_age=60, collation=Collation(
+            'en')) == 3
+        self.Dummy._count_cache.clear()
+        # Options without a query
+        with pytest.raises(ValueError):
+            self.Dummy.count(limit=2)
+
+    def test_aggregate(self):
+        # Insert many
+        self.Dummy.insert_many([{'a': i % 2, 'b': i} for i in range(5)])
+        # Aggregate
+        dummies = list(self.Dummy.aggregate(
+            [{'$match': {'a': 0}}, {'$sort': {'b': -1}}], batch_size=2))
+        assert [dummy.b for dummy in dummies] == [4, 2, 0]
+        assert dummies[0].__class__ == self.Dummy
+
+    def test_pivot(self):
+        # Insert many
+        objects = [{'a': i % 2, 'b': i // 2, 'c': i} for i in range(5)]
+        self.Dummy.insert_many([dict(obj) for obj in objects])
+        # Pivot (server side, matching pivot_list_to_dict)
+        pivoted = self.Dummy.pivot({}, ['a', 'b'], [str, int])
+        for obj in pivoted.values():
+            for value in obj.values():
+                value.pop('_id')
+        assert pivoted == pivot_list_to_dict(objects, ['a', 'b'], [str, int])
+        # Pivot (dotted pivots and projection)
+        self.Dummy.collection.delete_many({})
+        self.Dummy.insert_many([{'d': {'a': i % 2}, 'c': i} for i in range(3)])
+        pivoted = self.Dummy.pivot({}, 'd.a', projection={'_id': 0, 'c': 1})
+        assert sorted(obj['c'] for obj in pivoted[0]) == [0, 2]
+        assert pivoted[0][0]['d'] == {}
+        assert pivoted[1] == {'d': {}, 'c': 1}
+        # Pivot (values converted to the same key, sorted apart)
+        self.Dummy.collection.delete_many({})
+        objects = [{'a': 1, 'v': 0}, {'a': 2, 'v': 2}, {'a': '1', 'v': 1}]
+        self.Dummy.insert_many([dict(obj) for obj in objects])
+        pivoted = self.Dummy.pivot({}, 'a', str, projection={'_id': 0})
+        assert pivoted == pivot_list_to_dict(objects, 'a', str)
+        assert pivoted['1'] == [{'v': 0}, {'v': 1}]
+
+    def test_find_columns(self):
+        numpy = pytest.importorskip('numpy')
+        # Insert many
+        self.Dummy.insert_many([
+            {'a': 0, 'b': 1, 'c': {'d': 'x'}},
+            {'a': 1, 'b': 1.5},
+            {'a': 2, 'b': None, 'c': {'d': 2}},
+        ])
+        # Find columns (nested, masked, promoted, and mixed)
+        columns = self.Dummy.find_columns(
+            {}, ['a', 'b', 'c.d', 'e'], {'a': 'float32'}, batch_size=2)
+        assert columns['a'].dtype == numpy.float32
+        assert columns['a'].tolist() == [0, 1, 2]
+        assert columns['b'].dtype == numpy.float64
+        assert columns['b'].tolist() == [1, 1.5, None]
+        assert columns['c.d'].dtype == object
+        assert columns['c.d'].tolist() == ['x', None, 2]
+        assert columns['e'].mask.all()
+        # Mixed types (promoted once, then kept as float or object)
+        self.Dummy.collection.delete_many({})
+        self.Dummy.insert_many([{'f': v, 'g': v} for v in [1, 1.5, 2, 3]])
+        self.Dummy.insert_many([{'g': v} for v in ['x', 4, 4.5, 'y']])
+        columns = self.Dummy.find_columns({}, ['f', 'g'], batch_size=3)
+        assert columns['f'].dtype == numpy.float64
+        assert columns['f'].tolist() == [1, 1.5, 2, 3] + [None] * 4
+        assert columns['g'].dtype == object
+        assert columns['g'].tolist() == [1, 1.5, 2, 3, 'x', 4, 4.5, 'y']
+
+    def test_find_compact(self):
+        class Compact(self.Dummy):
+            config = dict(self.Dummy.config, fields={
+                'a': Field(int, 0),
+                'c': Field(TestEmbedded.Point),
+            })
+        # Insert
+        Compact.insert({'a': 1, 'b': 2, 'c': {'x': 1.0, 'y': 0.0, 'tags': []}})
+        # Find compact (projected to declared fields)
+        compact = list(Compact.find_compact())[0]
+        assert compact.__class__ == Compact.Compact
+        assert compact.c.x == 1.0
+        assert not hasattr(compact, 'b')
+        assert Compact(compact.to_dict()) == Compact.find({}, {'b': 0})
+
+    def test_find_many_readonly(self):
+        # Save
+        self.dummy.save()
+        # Find many (read only views)
+        dummy = list(self.Dummy.find_many(readonly=True))[0]
+        assert isinstance(dummy, AttrView)
+        assert dummy == self.dummy
+        assert dummy.c.e == 3
+        assert dummy['f'] == (0,)
+        with pytest.raises(TypeError):
+            dummy.b = 4
+        with pytest.raises(TypeError):
+            dummy['b'] = 4
+        assert self.Dummy.find({'a': 0}, readonly=True) == dummy
+
+    def test_save_partial(self):
+        # Save
+        self.dummy.save()
+        # Find (partial) and save
+        dummy = self.Dummy.find({'a': 0}, ['a', 'c.d'])
+        assert dummy._get_projection() == ['a', 'c.d']
+        assert 'b' not in dummy
+        dummy.c.d = 4
+        dummy.g = 5
+        dummy.save()
+        # Fields not loaded are not unset
+        self.dummy.c.d = 4
+        self.dummy.g = 5
+        assert self.Dummy.find({'a': 0}) == self.dummy
+        assert self.Dummy.find({'a': 0})._get_projection() is None
+        # Find many (partial)
+        dummy = list(self.Dummy.find_many({}, {'f': 0}))[0]
+        assert dummy._get_projection()['f'] == 0
+        # Item named projection (not hidden by the projection loaded)
+        dummy = self.Dummy.insert({'a': 1, 'projection': {'a': 1}})
+        dummy = self.Dummy.find({'a': 1}, ['projection'])
+        assert dummy.projection == {'a': 1}
+        dummy.projection = {'b': 1}
+        dummy.save()
+        assert self.Dummy.find({'a': 1}).projection == {'b': 1}
+
+    def test_write_behind(self):
+        class Buffered(self.Dummy):
+            config = dict(self.Dummy.config, write_behind={'size': 2})
+        # Save and update (buffered and merged per _id)
+        dummy = Buffered(self.dummy)
+        dummy.save()
+        assert dummy.update({'$inc': {'b': 1}}) is None
+        dummy.update({'$inc': {'b': 1}, '$set': {'c.d': 4}})
+        dummy.update({'$push': {'f': 1}})
+        assert dummy.b == 3
+        assert Buffered.find({'a': 0}).b == 1
+        assert Buffered._write_buffer.count == 1
+        # Flush
+        assert Buffered.flush().modified_count == 1
+        assert Buffered.find({'a': 0}) == dummy
+        assert Buffered.flush() is None
+        # Flush (full)
+        other = Buffered.insert({'a': 1})
+        other.update({'$set': {'b': 0}})
+        other.update({'$set': {'c': 0}})
+        dummy.update({'$unset': {'c': ''}})
+        assert Buffered._write_buffer.count == 0
+        assert Buffered.find({'a': 1}) == other
+        assert Buffered.find({'a': 0}) == dummy
+        # Write concern (can not be acknowledged when buffered)
+        with pytest.raises(ValueError):
+            dummy.update({'$set': {'b': 0}}, write_concern={'w': 1})
+        # Flushed before server side writes (so applied in order)
+        dummy.update({'$set': {'b': 10}})
+        assert Buffered.update_many(
+            {'a': 0}, {'$inc': {'b': 1}}).modified_count == 1
+        assert Buffered.find({'a': 0}).b == 11
+        dummy.update({'$set': {'b': 20}})
+        assert Buffered.delete_many({'b': 20}).deleted_count == 1
+        assert Buffered._write_buffer.count == 0
+
+    def test_write_behind_failed(self):
+        class Buffered(self.Dummy):
+            config = dict(self.Dummy.config, write_behind={'size': 10})
+
+        class Failing(object):
+            def bulk_write(self, requests):
+                raise AutoReconnect('failed')
+        # Flush (failed, so updates restored in front of newer updates)
+        dummy = Buffered(self.dummy)
+        dummy.save()
+        dummy.update({'$inc': {'b': 1}})
+        buffer = Buffered._write_buffer
+        collection, buffer.collection = buffer.collection, Failing()
+        with pytest.raises(AutoReconnect):
+            Buffered.flush()
+        buffer.collection = collection
+        dummy.update({'$push': {'f': 1}})
+        assert buffer.pending[dummy._id] == [
+            {'$inc': {'b': 1}, '$push': {'f': {'$each': [1]}}}]
+        assert buffer.count == 1
+        # Flush (retried)
+        Buffered.flush()
+        assert Buffered.find({'a': 0}) == dummy
+
+    def test_write_concern(self):
+        # Write concern (per call)
+        assert self.Dummy._get_collection() is self.Dummy.collection
+        collection = self.Dummy._get_collection({'w': 0})
+        assert not collection.write_concern.acknowledged
+        dummy = self.Dummy.insert({'a': 0}, write_concern={'w': 1, 'j': False})
+        res = dummy.update({'$set': {'b': 1}}, write_concern={'w': 1})
+        assert res.acknowledged
+        assert self.Dummy.find({'a': 0}) == dummy
+
+    def test_read_concern(self):
+        # Read concern (per call)
+        collection = self.Dummy._get_collection(
+            read_concern={'level': 'majority'})
+        assert collection.read_concern.level == 'majority'
+        dummy = self.Dummy.insert({'a': 0})
+        concern = {'level': 'local'}
+        assert self.Dummy.find({'a': 0}, read_concern=concern) == dummy
+        assert list(self.Dummy.find_many(read_concern=concern)) == [dummy]
+        assert self.Dummy.count({'a': 0}, read_concern=concern,
+                                max_age=60) == 1
+        assert list(self.Dummy.aggregate(
+            [{'$match': {'a': 0}}], read_concern=concern)) == [dummy]
+        self.Dummy._count_cache.clear()
+
+    def test_client_config(self, monkeypatch):
+        # Client options (passed to MongoClient)
+        clients = []
+        client_class = pymongo.MongoClient
+
+        def MongoClient(*args, **kwargs):
+            clients.append(kwargs)
+            return client_class(*args, **kwargs)
+        monkeypatch.setattr(pymongo, 'MongoClient', MongoClient)
+
+        class Pooled(self.Dummy):
+            config = dict(self.Dummy.config, client={'maxPoolSize': 5})
+        assert clients[-1]['maxPoolSize'] == 5
+        assert 'host' in clients[-1]
+        # Client options (merged recursively without modifying defaults)
+        assert Pooled.config['client'] == {'maxPoolSize': 5}
+        assert self.Dummy.config['client'] == {}
+        assert Pooled.config['client'] is not self.Dummy.config['client']
+
+    def test_export_and_import(self):
+        # Insert many
+        dummies = self.Dummy.insert_many([{'a': i, 'b': {'c': i}}
+                                          for i in range(5)])
+        path = tempfile.mkdtemp()
+        for format in ['bson', 'jsonl']:
+            # Export
+            filename = os.path.join(path, 'dummies.' + format)
+            assert self.Dummy.export(filename, {'a': {'$gt': 0}}, format,
+                                     batch_size=2) == 4
+            self.Dummy.collection.delete_many({})
+            # Import
+            assert self.Dummy.import_(filename, batch_size=3) == 4
+            assert list(self.Dummy.find_many(sort=[('a', 1)])) == dummies[1:]
+        shutil.rmtree(path)
+
+    def test_mirror(self):
+        # Mirror (changes applied directly, as change streams need a replica
+        # set)
+        dummy = self.Dummy.insert({'a': 0})
+        mirror = self.Dummy.mirror(start=False, checkpoint_size=3,
+                                   checkpoint_interval=None)
+        mirror.load()
+        assert mirror.get(dummy._id) == dummy
+        other = self.Dummy.insert({'a': 1})
+        mirror.apply({'_id': {'_data': '1'}, 'operationType': 'insert',
+                      'documentKey': {'_id': other._id},
+                      'fullDocument': other})
+        mirror.apply({'_id': {'_data': '2'}, 'operationType': 'delete',
+                      'documentKey': {'_id': dummy._id}})
+        assert len(mirror) == 1
+        assert mirror.find({'a': {'$gt': 0}}) == other
+        # Resume token stored (every checkpoint_size changes, and on stop)
+        assert self.Dummy.mirror(start=False).token is None
+        mirror.apply({'_id': {'_data': '3'}, 'operationType': 'delete',
+                      'documentKey': {'_id': other._id}})
+        assert self.Dummy.mirror(start=False).token == {'_data': '3'}
+        mirror.apply({'_id': {'_data': '4'}, 'operationType': 'drop'})
+        assert self.Dummy.mirror(start=False).token == {'_data': '3'}
+        mirror.stop()
+        assert self.Dummy.mirror(start=False).token == {'_data': '4'}
+
+    def test_append_and_find_events(self):
+        class Events(self.Dummy):
+            config = dict(self.Dummy.config, collection='events', buckets={
+                'series': 'sensor', 'window': 60, 'size': 2, 'stats': ['v']})
+        times = [datetime(2020, 1, 1, 0, 0, s) for s in (30, 10, 20, 50)]
+        Events.append({'sensor': 'x', 'time': times[0], 'v': 3})
+        Events.append_many(
+            [{'sensor': 'x', 'time': t, 'v': i} for i, t in enumerate(
+                times[1:])] + [{'sensor': 'y', 'time': times[0], 'v': 0}])
+        # Buckets capped by size
+        assert Events.count({'sensor': 'x'}) == 2
+        bucket = Events.find({'sensor': 'x', 'max.v': 3})
+        assert bucket.start == datetime(2020, 1, 1) and bucket.n == 2
+        assert bucket.min.v == 0
+        assert bucket.min.time == times[1]
+        # Events unrolled (sorted by time)
+        events = list(Events.find_events('x', times[1], times[3]))
+        assert [e.time for e in events] == [times[1], times[2], times[0]]
+        assert events[0] == {'sensor': 'x', 'time': times[1], 'v': 0}
+        assert len(list(Events.find_events('x'))) == 4
+        # Aware bounds (and event times) converted to naive UTC
+        tz = timezone(timedelta(hours=2))
+        events = list(Events.find_events(
+            'x', times[1].replace(hour=2, tzinfo=tz),
+            times[3].replace(hour=2, tzinfo=tz)))
+        assert [e.time for e in events] == [times[1], times[2], times[0]]
+        Events.append({'sensor': 'z', 'time': times[3].replace(
+            hour=2, tzinfo=tz)})
+        assert [e.time for e in Events.find_events('z')] == [times[3]]
+
+    def test_tail(self):
+        class Queue(self.Dummy):
+            config = dict(self.Dummy.config, collection='queue',
+                          capped={'size': 4096})
+        Queue.insert_many([{'a': i} for i in range(3)])
+        tail = Queue.tail({'a': {'$gt': 0}}, interval=0.01)
+        assert [next(tail).a for i in range(2)] == [1, 2]
+        # Cursor re-established from the last _id seen
+        Queue.insert({'a': 3})
+        assert next(tail).a == 3
+        tail.close()
+        # Key (must increase in insertion order)
+        tail = Queue.tail(interval=0.01, key='a')
+        assert [next(tail).a for i in range(4)] == [0, 1, 2, 3]
+        tail.close()
+        Queue.insert({'a': 1})
+        tail = Queue.tail({'a': {'$gt': 0}}, interval=0.01, key='a')
+        assert [next(tail).a for i in range(3)] == [1, 2, 3]
+        with pytest.raises(ValueError):
+            next(tail)
+        # Network errors retried, other errors (e.g. not capped) raised
+        errors = [AutoReconnect('failed'), OperationFailure(
+            'tailable cursor requested on non capped collection', 2)]
+
+        class Uncapped(object):
+            def find(self, *args, **kwargs):
+                error = errors.pop(0)
+
+                def cursor():
+                    raise error
+                    yield
+                return cursor()
+        collection, Queue.collection = Queue.collection, Uncapped()
+        try:
+            with pytest.raises(OperationFailure):
+                next(Queue.tail(interval=0.01))
+        finally:
+            Queue.collection = collection
+        assert not errors
+
+    def test_large_fields(self):
+        class Blob(self.Dummy):
+            config = dict(self.Dummy.config, collection='blobs',
+                          large_fields=['data'])
+        data = b'x' * 600000
+        Blob.insert({'a': 0, 'data': data})
+        # Stored out of line (in chunks) with a reference in the document
+        assert list(Blob.collection.find_one()['data']) == ['_large']
+        assert Blob._chunks.count_documents({}) == 3
+        # Loaded on first attribute access
+        blob = Blob.find({'a': 0})
+        assert list(blob['data']) == ['_large']
+        assert blob.data == data and blob['data'] == data
+        # Unchanged values are not stored again
+        blob.a = 1
+        blob.save()
+        assert Blob._chunks.count_documents({}) == 3
+        blob.data = b'y'
+        blob.save()
+        assert Blob._chunks.count_documents({}) == 1
+        assert Blob.find({'a': 1}).data == b'y'
+        blob.delete()
+        assert Blob._chunks.count_documents({}) == 0
+        # Streamed (bytes only)
+        blob = Blob.insert({'a': 2, 'data': data, 'other': 0})
+        with Blob.find({'a': 2}).open_large('data') as f:
+            assert f.read(10) == b'x' * 10
+            assert len(f.read()) == len(data) - 10
+        with blob.open_large('data') as f:
+            assert f.read() == data
+        # Updated ($set and $unset as a whole, replaced chunks deleted)
+        blob.update({'$set': {'data': {'y': 1}, 'other': 1}})
+        assert Blob._chunks.count_documents({}) == 1
+        assert Blob.find({'a': 2}).data == {'y': 1}
+        with pytest.raises(ValueError):
+            Blob.find({'a': 2}).open_large('data')
+        blob.update({'$unset': {'data': ''}})
+        assert Blob._chunks.count_documents({}) == 0
+        assert 'data' not in Blob.find({'a': 2})
+        for update in [{'$inc': {'data': 1}}, {'$set': {'data.y': 2}}]:
+            with pytest.raises(UpdateError):
+                blob.update(update)
+        with pytest.raises(UpdateError):
+            Blob.update_many({}, {'$set': {'data': b''}})
+        # Deleted (only the chunks of the objects deleted)
+        Blob.insert_many([{'a': 3, 'data': data}, {'a': 4, 'data': b'z'}])
+        assert Blob._chunks.count_documents({}) == 4
+        assert Blob.delete_many({'a': 3}).deleted_count == 1
+        assert Blob._chunks.count_documents({}) == 1
+        assert Blob.find({'a': 4}).data == b'z'
+        assert Blob.delete_many({'a': {'$gte': 3}}).deleted_count == 1
+        assert Blob._chunks.count_documents({}) == 0
+        # Chunks deleted if the insert fails
+        with pytest.raises(Exception):
+            Blob.insert({'_id': blob._id, 'data': data})
+        assert Blob._chunks.count_documents({}) == 0
+        # Not deferred
+        with pytest.raises(ValueError):
+            class Buffered(Blob):
+                config = dict(Blob.config, write_behind={'size': 2})
+
+    def test_pickle_and_bson(self):
+        self.dummy.insert(self.dummy)
+        dummy = self.Dummy.find({'a': 0}, {'a': 1})
+        # Pickled with the projection
+        other = pickle.loads(pickle.dumps(dummy))
+        assert other == dummy and other.__class__ == self.Dummy
+        assert other._get_projection() == dummy._get_projection()
+        # Encoded to BSON
+        other = self.Dummy.from_bson(self.dummy.to_bson())
+        assert other == self.dummy and other.__class__ == self.Dummy
+        assert isinstance(other.c, AttrDictionary)
+
+    def test_fingerprint(self):
+        class Hashed(self.Dummy):
+            config = dict(self.Dummy.config, collection='hashed',
+                          fingerprint={})
+        hashed = Hashed.insert({'k': 0, 'a': {'b': 1, 'c': 2}})
+        stored = Hashed.find({'k': 0})
+        assert stored._fingerprint == hashed._fingerprint
+        # Unchanged objects are not saved, changed objects are
+        assert stored.save() is None
+        stored.a.b = 2
+        assert stored.save() is not None
+        assert Hashed.find({'k': 0})._fingerprint != hashed._fingerprint
+        # Updates drop the fingerprint (as it would be stale)
+        stored.update({'$inc': {'k': 1}})
+        assert '_fingerprint' not in Hashed.find({'k': 1})
+        stored.save()
+        # Fingerprints compared first (regardless of key order)
+        old = list(Hashed.find_many())
+        new = [{'k': 1, 'a': {'c': 2, 'b': 2}}, {'k': 2}]
+        diff = dict_list_diff(old, new, 'k', grab=['_id'],
+                              fingerprint='_fingerprint')
+        assert diff == {'created': [{'k': 2}]}
+
+    def test_sync(self):
+        class Target(self.Dummy):
+            config = dict(self.Dummy.config, collection='targets')
+        batches = []
+        self.Dummy.insert_many(
+            [{'a': i, 'updated_at': datetime(2020, 1, 1)} for i in range(3)])
+        assert self.Dummy.sync(batches.append, batch_size=2,
+                               name='batches') == 3
+        assert [len(batch) for batch in batches] == [2, 1]
+        # Only objects changed since the last sync (resumed from checkpoint)
+        dummy = self.Dummy.find({'a': 1})
+        dummy.updated_at = datetime(2020, 1, 2)
+        dummy.save()
+        assert self.Dummy.sync(batches.append, batch_size=2,
+                               name='batches') == 1
+        assert batches[-1] == [dummy]
+        assert self.Dummy.sync(batches.append, name='batches') == 0
+        # Upserted to another model
+        assert self.Dummy.sync(Target) == 3
+        assert Target.find({'a': 1}) == dummy
+        # Name required unless a model or named function
+        with pytest.raises(ValueError):
+            self.Dummy.sync(batches.append)
+        with pytest.raises(ValueError):
+            self.Dummy.sync(lambda batch: None)
+
+        def deliver(batch):
+            batches.append(batch)
+        assert self.Dummy.sync(deliver) == 3
+        # Fingerprinted by the target (unchanged objects not saved again)
+        class Hashed(self.Dummy):
+            config = dict(self.Dummy.config, collection='hashed',
+                          fingerprint={})
+        assert self.Dummy.sync(Hashed) == 3
+        hashed = Hashed.find({'a': 1})
+        assert '_fingerprint' in hashed and hashed.save() is None
+        # Large fields (references can not be synced between models)
+        class Blob(self.Dummy):
+            config = dict(self.Dummy.config, collection='blobs',
+                          large_fields=['data'])
+        for source, target in [(Blob, Target), (self.Dummy, Blob)]:
+            with pytest.raises(ValueError):
+                source.sync(target)
+
+    def test_sync_null(self):
+        batches = []
+        # Objects without the key (null) are synced first
+        self.Dummy.insert_many([{'a': i} for i in range(3)])
+        self.Dummy.insert({'a': 3, 'updated_at': datetime(2020, 1, 1)})
+        assert self.Dummy.sync(batches.append, batch_size=2,
+                               name='batches') == 4
+        assert [len(batch) for batch in batches] == [2, 2]
+        assert self.Dummy.sync(batches.append, name='batches') == 0
+        # Resumed after a null watermark
+        self.Dummy.sync(batches.append, batch_size=1, name='nulls', query={
+            'updated_at': None})
+        self.Dummy.insert({'a': 4})
+        assert self.Dummy.sync(batches.append, name='nulls', query={
+            'updated_at': None}) == 1
+        assert batches[-1][0].a == 4
+
+    def test_partitions(self):
+        class Sharded(self.Dummy):
+            config = dict(self.Dummy.config, collection='sharded',
+                          partitions={'key': 'k', 'count': 3})
+        Sharded.insert_many([{'k': i, 'a': i % 2} for i in range(12)])
+        counts = [c.count_documents({}) for c in Sharded._partitions]
+        assert sum(counts) == 12 and all(counts)
+        # Scattered and gathered (sorted and limited)
+        objects = Sharded.find_many({'a': 0}, sort=[('k', -1)], limit=3)
+        assert [obj.k for obj in objects] == [10, 8, 6]
+        # Routed to one partition by shard key
+        assert len(Sharded._get_partitions({'k': 4})) == 1
+        assert len(Sharded._get_partitions({'k': {'$in': [4]}})) == 1
+        obj = Sharded.find({'k': 4})
+        obj.a = 5
+        obj.save()
+        assert Sharded.find({'k': 4}).a == 5
+        obj.delete()
+        assert len(list(Sharded.find_many())) == 11
+        # Global first by sort (merged across partitions)
+        assert Sharded.find({'a': 1}, sort=[('k', -1)]).k == 11
+        assert Sharded.find({'a': 1}, sort=[('k', 1)]).k == 1
+        assert [obj.k for obj in Sharded.find_many(
+            sort=[('k', 1)], skip=2, limit=3)] == [2, 3, 5]
+        # Equal numbers routed together (regardless of type)
+        assert Sharded._get_partition({'k': 1}) == \
+            Sharded._get_partition({'k': 1.0})
+        assert Sharded.find({'k': 1.0}).k == 1
+        # Shard key can not be changed
+        obj = Sharded.find({'k': 5})
+        obj.k = 13
+        with pytest.raises(ValueError):
+            obj.save()
+        with pytest.raises(UpdateError):
+            Sharded.find({'k': 5}).update({'$set': {'k': 13}})
+        with pytest.raises(UpdateError):
+            Sharded.update_many({}, {'$inc': {'k': 1}})
+        # Global first by sort (updated in its own partition)
+        obj = Sharded.find_one_and_update(
+            {'a': 0}, {'$set': {'a': 2}}, sort=[('k', -1)])
+        assert obj.k == 10 and obj.a == 2
+        assert Sharded.find({'k': 10}).a == 2
+        obj = Sharded.find_one_and_update(
+            {'a': 0}, {'$set': {'a': 2}}, sort=[('k', 1)], return_new=False)
+        assert obj.k == 0 and obj.a == 0
+        assert Sharded.count({'a': 2}) == 2
+        assert Sharded.find_one_and_update({'a': 7}, {'$set': {'a': 8}}) \
+            is None
+        # Upserted (into the partition of the shard key only)
+        obj = Sharded.find_one_and_update(
+            {'k': 20}, {'$set': {'a': 3}}, upsert=True)
+        assert obj.k == 20 and obj.a == 3
+        partition = Sharded._get_partition({'k': 20})
+        assert Sharded._partitions[partition].count_documents({'k': 20}) == 1
+        for filter in [{'a': 3}, {'k': {'$in': [20]}}, {'k': {'$gt': 20}}]:
+            with pytest.raises(ValueError):
+                Sharded.find_one_and_update(
+                    filter, {'$set': {'a': 4}}, upsert=True)
+
+    def test_partitions_methods(self):
+        class Sharded(self.Dummy):
+            config = dict(self.Dummy.config, collection='sharded',
+                          partitions={'key': 'k', 'count': 3},
+                          fields={'k': Field(int)})
+        Sharded.insert_many([{'k': i, 'a': i % 2} for i in range(12)])
+        # Counted, paginated, and pivoted across partitions
+        assert Sharded.count() == 12
+        assert Sharded.count({'a': 0}) == 6
+        assert Sharded.count({'a': 0}, limit=4) == 4
+        objects, token = Sharded.paginate({'a': 0}, 'k', page_size=4)
+        assert [obj.k for obj in objects] == [0, 2, 4, 6]
+        objects, token = Sharded.paginate({'a': 0}, 'k', page_size=4,
+                                          after=token)
+        assert [obj.k for obj in objects] == [8, 10] and token is None
+        pivoted = Sharded.pivot({}, ['a', 'k'], projection={'_id': 0})
+        assert list(pivoted[1]) == [1, 3, 5, 7, 9, 11]
+        assert [obj.k for obj in Sharded.find_compact(
+            sort=[('k', -1)], limit=2)] == [11, 10]
+        # Updated (results combined across partitions)
+        res = Sharded.update_many({'a': 0}, {'$inc': {'b': 1}})
+        assert res.matched_count == res.modified_count == 6
+        # Exported, imported, and synced (routed to partitions)
+        path = tempfile.mkdtemp()
+        for format in ['bson', 'jsonl']:
+            filename = os.path.join(path, 'sharded.' + format)
+            assert Sharded.export(filename, {'a': 1}, format) == 6
+            assert Sharded.delete_many({'a': 1}).deleted_count == 6
+            assert Sharded.import_(filename) == 6
+            assert Sharded.count({'a': 1}) == 6
+            assert Sharded.find({'k': 3}).a == 1
+        shutil.rmtree(path)
+
+        class Target(self.Dummy):
+            config = dict(self.Dummy.config, collection='target',
+                          partitions={'key': 'k', 'count': 2})
+        assert Sharded.sync(Target, key='k') == 12
+        assert Target.count() == 12
+        assert Target.find({'k': 7}).a == 1
+        # First batches fetched by the workers (cursors are lazy)
+        threads = []
+
+        class Lazy(object):
+            def __init__(self, collection):
+                self.collection = collection
+
+            def find(self, *args, **kwargs):
+                def cursor():
+                    threads.append(threading.get_ident())
+                    yield from self.collection.find(*args, **kwargs)
+                return cursor()
+
+        partitions = Sharded._partitions
+        Sharded._partitions = [Lazy(c) for c in partitions]
+        try:
+            assert len(list(Sharded.find_many(sort=[('k', 1)]))) == 12
+        finally:
+            Sharded._partitions = partitions
+        assert len(threads) == 3
+        assert threading.get_ident() not in threads
+        # Not supported
+        for method in [lambda: list(Sharded.aggregate([])),
+                       lambda: next(Sharded.tail()),
+                       lambda: Sharded.mirror(start=False)]:
+            with pytest.raises(NotImplementedError):
+                method()
+        with pytest.raises(ValueError):
+            class Buffered(self.Dummy):
+                config = dict(self.Dummy.config, write_behind={'size': 2},
+                              partitions={'key': 'k'})
+
+    def test_partitions_indexes(self):
+        class Sharded(self.Dummy):
+            config = dict(self.Dummy.config, collection='sharded',
+                          partitions={'key': 'k', 'count': 2},
+                          indexes=[IndexModel([('a', 1)], name='a')])
+        # Created in each partition (not the base collection)
+        for collection in Sharded._partitions:
+            assert 'a' in collection.index_information()
+        assert 'a' not in Sharded.collection.index_information()
+        assert Sharded.diff_indexes() == {}
+        # Differences in any partition (synced in each)
+        Sharded._partitions[0].drop_index('a')
+        Sharded._partitions[1].create_index([('b', 1)], name='b')
+        summary = Sharded.diff_indexes()
+        assert [i.document['name'] for i in summary['created']] == ['a']
+        assert summary['deleted'] == ['b']
+        assert Sharded.sync_indexes(drop=True)['deleted'] == ['b']
+        assert Sharded.diff_indexes() == {}
+        for collection in Sharded._partitions:
+            assert sorted(collection.index_information()) == ['_id_', 'a']
+
+    def test_partitions_range(self):
+        class Ranged(self.Dummy):
+            config = dict(self.Dummy.config, partitions={
+                'key': 'k', 'method': 'range', 'bounds': [5],
+                'targets': [{'collection': 'low'}, {'collection': 'high'}]})
+        Ranged.insert({'k': 1})
+        Ranged.insert_many([{'k': 5}, {'k': 9}])
+        assert Ranged._partitions[0].count_documents({}) == 1
+        assert Ranged._partitions[1].count_documents({}) == 2
+        assert Ranged.find({'k': 9}).k == 9
+        # Dotted shard key
+        class Nested(self.Dummy):
+            config = dict(self.Dummy.config, collection='nested',
+                          partitions={'key': 'k.v', 'count': 3})
+        Nested.insert_many([{'k': {'v': i}} for i in range(6)])
+        assert len(Nested._get_partitions({'k.v': 4})) == 1
+        assert Nested.find({'k.v': 4}).k.v == 4
+
+    def test_update_many_and_delete_many(self):
+        self.Dummy.insert_many([{'a': i, 'b': i % 2} for i in range(6)])
+        res = self.Dummy.update_many({'b': 0}, {'$inc': {'a': 10}})
+        assert res.matched_count == res.modified_count == 3
+        assert self.Dummy.count({'a': {'$gte': 10}}) == 3
+        assert self.Dummy.delete_many({'b': 1}).deleted_count == 3
+        assert self.Dummy.count() == 3
+        # Error
+        with pytest.raises(UpdateError):
+            self.Dummy.update_many({}, {'a': 0})
+
+    def test_find_one_and_update(self):
+        self.Dummy.insert_many([{'a': i, 'claimed': False} for i in range(3)])
+        # Claim the first object
+        dummy = self.Dummy.find_one_and_update(
+            {'claimed': False}, {'$set': {'claimed': True}}, sort=[('a', 1)])
+        assert dummy.a == 0 and dummy.claimed
+        assert dummy.__class__ == self.Dummy
+        dummy = self.Dummy.find_one_and_update(
+            {'claimed': False}, {'$set': {'claimed': True}},
+            return_new=False, sort=[('a', -1)])
+        assert dummy.a == 2 and not dummy.claimed
+        assert self.Dummy.count({'claimed': True}) == 2
+        assert self.Dummy.find_one_and_update(
+            {'a': 3}, {'$set': {'claimed': True}}) is None
+        # Error
+        with pytest.raises(UpdateError):
+            self.Dummy.find_one_and_update({}, {'$rename': {'a': 'b'}})
@@ -0,0 +1,122 @@
+"""
+Tests classes and methods for spooling writes to disk.
+
+See :mod:`test_repository` for the MongoDB user required prior to testing.
+"""
+
+import os
+import pytest
+import shutil
+import tempfile
+
+from minimongo.repository import Model, UpdateError
+from minimongo.spool import Spool, read_segment
+
+
+# ----------------------------------------------------------------------------
+# Spool
+# ----------------------------------------------------------------------------
+
+class TestSpool(object):
+
+    class Spooled(Model):
+        # Set config attr to configure binding by metaclass constructor
+        config = {
+            'host': '127.0.0.1',
+            'port': 27017,
+            'username': 'minimongoTester',
+            'password': 'minimongoTester',
+            'database': 'minimongo_testing',
+            'collection': 'spooled',
+            'spool': {'path': tempfile.mkdtemp(), 'fsync': 'never'},
+        }
+
+    def setup(self):
+        self.Spooled.connection.drop_database(self.Spooled.database)
+        self.path = tempfile.mkdtemp()
+        self.spool = Spool(self.path, segment_size=64, fsync='always')
+
+    def teardown(self):
+        self.spool.close()
+        shutil.rmtree(self.path)
+        self.Spooled.replay()
+        self.Spooled.connection.drop_database(self.Spooled.database)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.Spooled._spool.close()
+        shutil.rmtree(cls.Spooled._spool.path)
+
+    def test_append_and_rotate(self):
+        # Append (rotates once segment exceeds segment_size)
+        self.spool.insert({'_id': 0, 'a': 'x' * 64})
+        self.spool.update(0, {'$set': {'a': 0}})
+        segments = self.spool.segments()
+        assert len(segments) == 1
+        assert list(read_segment(segments[0])) == [
+            {'op': 'insert', 'doc': {'_id': 0, 'a': 'x' * 64}}]
+
+    def test_update_idempotent(self):
+        # Update (only idempotent operators, as replay is at least once)
+        self.spool.update(0, {'$set': {'a': 0}, '$unset': {'b': ''}})
+        for update in [{'$inc': {'a': 1}}, {'$push': {'a': 1}}, {}]:
+            with pytest.raises(ValueError):
+                self.spool.update(0, update)
+        spooled = self.Spooled.insert({'a': 0})
+        with pytest.raises(UpdateError):
+            spooled.update({'$inc': {'a': 1}})
+        assert spooled.a == 0
+        # Write concern (can not be acknowledged when spooled)
+        with pytest.raises(ValueError):
+            spooled.update({'$set': {'a': 1}}, write_concern={'w': 1})
+
+    def test_fingerprint(self):
+        class Hashed(self.Spooled):
+            config = dict(self.Spooled.config, collection='hashed',
+                          fingerprint={}, spool={'path': tempfile.mkdtemp()})
+        try:
+            # Inserts spooled with the fingerprint (as saves)
+            hashed = Hashed.insert({'a': 0})
+            others = Hashed.insert_many([{'a': 1}, {'a': 2}])
+            assert Hashed.replay() == 3
+            for obj in [hashed] + others:
+                stored = Hashed.collection.find_one({'_id': obj._id})
+                assert stored['_fingerprint'] == obj._fingerprint
+        finally:
+            Hashed._spool.close()
+            shutil.rmtree(Hashed._spool.path)
+
+    def test_read_segment_truncated(self):
+        # Append and truncate the last record (e.g. crash during write)
+        self.spool.delete(0)
+        self.spool.delete(1)
+        path = self.spool.file.name
+        self.spool.close()
+        with open(path, 'rb+') as f:
+            f.truncate(os.path.getsize(path) - 1)
+        assert list(read_segment(path)) == [{'op': 'delete', '_id': 0}]
+
+    def test_replay(self):
+        # Spool (MongoDB is not written)
+        spooled = self.Spooled.insert({'a': 0})
+        assert '_id' in spooled
+        spooled.update({'$set': {'b': 1}})
+        others = self.Spooled.insert_many([{'a': 1}, {'a': 2}])
+        others[0].delete()
+        others[1].c = 2
+        others[1].save()
+        assert not self.Spooled.find({})
+        # Replay (segments are removed once replayed)
+        assert self.Spooled.replay() == 6
+        assert self.Spooled.replay() == 0
+        assert self.Spooled.find({'a': 0}) == spooled
+        assert self.Spooled.find({'a': 2}) == others[1]
+        assert self.Spooled.count({}) == 2
+        # Server side writes (would be overwritten by spooled writes)
+        for method in [
+                lambda: self.Spooled.update_many({}, {'$set': {'a': 0}}),
+                lambda: self.Spooled.delete_many({}),
+                lambda: self.Spooled.find_one_and_update(
+                    {}, {'$set': {'a': 0}})]:
+            with pytest.raises(NotImplementedError):
+                method()